@@ -4,6 +4,8 @@ from nmigen.lib.cdc import *
 from nmigen.lib.io import *
 from nmigen.hdl.rec import Direction
 
+from utility.cdc import Mailbox
+
 # AC97 is a 16 bit "Tag" followed by 12 20-bit (signed) data backets,
 # with the interface written to on rising edges of audio_bit_clk,
 # and sampled on the falling edge
@@ -45,13 +47,20 @@ class AC97_ADC_Channels(Record):
 def ac97_adc_connect(domain, source, sink):
     domain += [
         sink.adc_tag.eq(source.adc_tag),
-        sink.adc_left.eq(source.adc_right),
+        sink.adc_left.eq(source.adc_left),
         sink.adc_right.eq(source.adc_right),
     ]
 
+def ac97_dac_handshake(m, mailbox, valid, written):
+    # sync side of the dac mailbox, also checked on its own by utility/formal.py
+    m.d.comb += [
+        mailbox.w_stb.eq(mailbox.w_rdy & ~mailbox.w_done & valid),
+        written.eq(mailbox.w_done),
+    ]
+
 class AC97_Controller(Elaboratable):
     # 
-    def __init__(self):
+    def __init__(self, instrument=False):
         #AC97 signals
         self.sdata_in = Pin(width=1, dir="i", xdr = 2)
         self.sdata_out = Pin(width=1, dir="o")
@@ -60,44 +69,57 @@ class AC97_Controller(Elaboratable):
 
         # signed pcm inputs to dac
         self.dac_channels_i = AC97_DAC_Channels(name="dac_channels_i")
+        self.dac_sample_valid_i = Signal(reset=1)   # dac_channels_i holds a new sample
         self.dac_sample_written_o = Signal()    # asserted for one cycle when inputs sampled
       
         # signed pcm outputs from adc
         self.adc_channels_o = AC97_ADC_Channels(name="adc_channels_o")
         self.adc_out_valid = Signal()           # indicates the window in which  the adc_ outputs can be read
         self.adc_sample_received = Signal()     # asserted for one cycle when acd_out becomes valid
+        self.adc_sample_ready_i = Signal(reset=1)   # the last adc sample has been read
 
         # Read or write to control register. Defaults to write
         self.reg_read = Signal()
         # Asserted if the echoed register address is the same as the written address
         self.addr_echo = Signal()
 
+        # Samples cross between sync and audio_bit_clk through mailboxes
+        self.dac_mailbox = Mailbox(len(self.dac_channels_i), w_domain="sync", r_domain="audio_bit_clk")
+        self.adc_mailbox = Mailbox(len(self.adc_channels_o), w_domain="audio_bit_clk", r_domain="sync")
+        # latency they add, in audio_bit_clk cycles for the dac and sync cycles for the adc
+        self.dac_cdc_latency = self.dac_mailbox.latency
+        self.adc_cdc_latency = self.adc_mailbox.latency
+
+        # Optional counters, see utility/instrumentation.py
+        self.dac_underrun = Signal()    # a frame went out without a new dac sample (repeats the last)
+        self.adc_overrun = Signal()     # an adc sample was dropped, the last wasn't read yet
+        self.instrumentation = None
+        if instrument:
+            from utility.instrumentation import Instrumentation
+            self.instrumentation = Instrumentation()
+            self.instrumentation.counter("dac_samples", self.dac_sample_written_o)
+            self.instrumentation.counter("dac_underruns", self.dac_underrun, domain="audio_bit_clk")
+            self.instrumentation.counter("adc_samples", self.adc_sample_received)
+            self.instrumentation.counter("adc_overruns", self.adc_overrun, domain="audio_bit_clk")
+            # how long the source takes to present the next sample
+            self.instrumentation.max_latency("dac_source_cycles",
+                self.dac_sample_written_o, self.dac_mailbox.w_stb & self.dac_mailbox.w_rdy)
+
     def elaborate(self, platform):
         m = Module()
 
-        dac_inputs_valid = Signal()
-        dac_valid_ack_sync = Signal()
-        
-        #input buffers
-        dac_channels = AC97_DAC_Channels(name="dac_channels")
-             
-        with m.If (~dac_inputs_valid & ~dac_valid_ack_sync):    
-            m.d.sync += [
-                dac_inputs_valid.eq(1),
-            ]
-            ac97_dac_connect(m.d.sync, self.dac_channels_i, dac_channels)
-
-        with m.If (dac_inputs_valid & dac_valid_ack_sync):
-            m.d.comb += self.dac_sample_written_o.eq(1)
-            m.d.sync += dac_inputs_valid.eq(0)
+        #dac inputs to the audio_bit_clk domain. A new sample is written the cycle after
+        #the last one was taken, so the inputs can be updated on dac_sample_written_o.
+        #A source that has no new sample by then drops dac_sample_valid_i until it has
+        #(NCO_AC97_Source and AC97_DAC_Interpolator do, through dac_sample_valid_o),
+        #and if that's after the next frame starts the frame repeats the last sample
+        m.submodules.dac_mailbox = dac_mailbox = self.dac_mailbox
+        m.d.comb += dac_mailbox.w_data.eq(self.dac_channels_i)
+        ac97_dac_handshake(m, dac_mailbox, self.dac_sample_valid_i, self.dac_sample_written_o)
 
         #audio_bit_clk domain
-        dac_valid_ack = Signal()
-        dac_inputs_valid_sync = Signal()
-        m.submodules.dac_input_valid_2ff = FFSynchronizer(dac_inputs_valid,
-            dac_inputs_valid_sync, o_domain="audio_bit_clk")
-        m.submodules.dac_ack_2ff = FFSynchronizer(dac_valid_ack,
-            dac_valid_ack_sync, o_domain="sync")
+        dac_channels = AC97_DAC_Channels(name="dac_channels")
+        m.d.comb += dac_channels.eq(dac_mailbox.r_data)
 
         dac_channels_sync = AC97_DAC_Channels(name="dac_channels_sync")     
 
@@ -118,25 +140,20 @@ class AC97_Controller(Elaboratable):
 
         
 
-        #adc data from deserialiser to outputs        
-        adc_outputs_valid = Signal()
-        adc_outputs_valid_sync = Signal()
-        m.submodules.adc_output_valid_2ff = FFSynchronizer(adc_outputs_valid,
-            adc_outputs_valid_sync, o_domain="sync")   
-        adc_valid_ack = Signal()
-        adc_valid_ack_sync = Signal()
-        m.submodules.adc_valid_ack_2ff = FFSynchronizer(adc_valid_ack,
-            adc_valid_ack_sync, o_domain="audio_bit_clk")
-
+        #adc data from deserialiser to outputs, written once a frame in IO_CTRL.
+        #A sample is only delivered while adc_sample_ready_i is set, the next frame's
+        #sample is dropped if the last one is still waiting
+        m.submodules.adc_mailbox = adc_mailbox = self.adc_mailbox
         adc_channels_bit_clk = AC97_ADC_Channels(name="adc_channels_bit_clk")
-        m.d.comb += self.adc_sample_received.eq(0)
-        
-        with m.If(~adc_valid_ack & adc_outputs_valid_sync):
-            m.d.comb += self.adc_sample_received.eq(1)
-            m.d.sync += adc_valid_ack.eq(1)
-            ac97_adc_connect(m.d.sync, adc_channels_bit_clk, self.adc_channels_o)
-        with m.If(~adc_outputs_valid_sync):
-            m.d.sync += adc_valid_ack.eq(0)
+        adc_channels_received = AC97_ADC_Channels(name="adc_channels_received")
+        m.d.comb += [
+            adc_mailbox.w_data.eq(adc_channels_bit_clk),
+            adc_channels_received.eq(adc_mailbox.r_data),
+            adc_mailbox.r_stb.eq(adc_mailbox.r_rdy & self.adc_sample_ready_i),
+            self.adc_sample_received.eq(adc_mailbox.r_stb),
+        ]
+        with m.If(adc_mailbox.r_stb):
+            ac97_adc_connect(m.d.sync, adc_channels_received, self.adc_channels_o)
 
         # AC97 interface
         command_select = Signal(2)
@@ -145,8 +162,11 @@ class AC97_Controller(Elaboratable):
         m.d.comb += self.addr_echo.eq( ~((write_address ^ address_echo).any()) )
         with m.FSM(domain="audio_bit_clk") as ac97_if:
             with m.State("IO_CTRL"):
-                m.d.audio_bit_clk += adc_outputs_valid.eq(1)
                 with m.If(~bit_count.any()):
+                    m.d.comb += [
+                        adc_mailbox.w_stb.eq(1),
+                        self.adc_overrun.eq(~adc_mailbox.w_rdy),
+                    ]
                     m.d.audio_bit_clk += [
                         bit_count.eq(15),
                         shift_out.eq(0xf9800),  #valid command address, command data, line out, l/r surround out
@@ -155,13 +175,12 @@ class AC97_Controller(Elaboratable):
                     m.next = "TAG"
             with m.State("TAG"):
                 m.d.comb += self.sync_o.o.eq(1)
-                with m.If(adc_valid_ack_sync):
-                    m.d.audio_bit_clk += adc_outputs_valid.eq(0)
-                with m.If(~dac_valid_ack & dac_inputs_valid_sync):
-                    m.d.audio_bit_clk += [
-                        dac_valid_ack.eq(1),                               
-                    ]
+                # one dac sample per frame
+                with m.If(~bit_count.any() & dac_mailbox.r_rdy):
+                    m.d.comb += dac_mailbox.r_stb.eq(1)
                     ac97_dac_connect(m.d.audio_bit_clk, dac_channels, dac_channels_sync)
+                with m.Elif(~bit_count.any()):
+                    m.d.comb += self.dac_underrun.eq(1)
                 with m.If(~bit_count.any()):
                     m.d.audio_bit_clk += [
                         bit_count.eq(19),
@@ -191,8 +210,6 @@ class AC97_Controller(Elaboratable):
                             ]
                     m.next = "CMD_ADDR"
             with m.State("CMD_ADDR"):
-                with m.If(dac_valid_ack & ~dac_inputs_valid_sync):
-                    m.d.audio_bit_clk += dac_valid_ack.eq(0)
                 with m.If(~bit_count.any()):
                     m.d.audio_bit_clk += bit_count.eq(19)
                     # don't need specifics since writing zeroes to these registers should unmute the channels
@@ -253,13 +270,88 @@ class AC97_Controller(Elaboratable):
                 with m.If(~bit_count.any()):
                     m.d.audio_bit_clk += bit_count.eq(19)
                     m.next = "IO_CTRL"
+
+        if self.instrumentation is not None:
+            m.submodules.instrumentation = self.instrumentation
                    
         return m
 
 
+def check_underrun_overrun(frames=8):
+    # A dac source that misses two frames and an adc reader that stops reading for
+    # two, checked against the instrumentation counters
+    dut = AC97_Controller(instrument=True)
+    bank = dut.instrumentation
+    sim = Simulator(dut)
+    sim.add_clock(10e-9)
+    sim.add_clock(81e-9, domain="audio_bit_clk")
+    frame_cycles = 256 * 81 // 10
+    sent = []
+    counts = {}
+
+    def dac_source():
+        sample = 0
+        while len(sent) < frames:
+            yield
+            if (yield dut.dac_sample_written_o):
+                sample += 1
+                yield dut.dac_channels_i.dac_left_front.eq(sample)
+                if sample == 3:
+                    # the next sample is late
+                    yield dut.dac_sample_valid_i.eq(0)
+                    for _ in range(2 * frame_cycles):
+                        yield
+                    yield dut.dac_sample_valid_i.eq(1)
+
+    def adc_reader():
+        for _ in range(3 * frame_cycles):
+            yield
+        yield dut.adc_sample_ready_i.eq(0)
+        for _ in range(2 * frame_cycles + frame_cycles // 2):
+            yield
+        yield dut.adc_sample_ready_i.eq(1)
+
+    def codec():
+        previous_sync = 0
+        while len(sent) < frames:
+            sync = (yield dut.sync_o.o)
+            if sync and not previous_sync:
+                sent.append(len(sent))
+            previous_sync = sync
+            yield
+
+    def read_counters():
+        while len(sent) < frames:
+            yield
+        # let the last frame's counts cross over
+        for _ in range(200):
+            yield
+        for name in bank.names:
+            yield bank.address.eq(bank.register(name))
+            yield
+            yield
+            counts[name] = (yield bank.read_data)
+
+    sim.add_sync_process(dac_source)
+    sim.add_sync_process(adc_reader)
+    sim.add_sync_process(codec, domain="audio_bit_clk")
+    sim.add_sync_process(read_counters)
+    sim.run()
+    return counts
+
+
 if __name__=="__main__":
 
+    counts = check_underrun_overrun(frames=8)
+    print(counts)
+    assert counts["dac_underruns"] == 2 and counts["adc_overruns"] == 2, counts
+    assert counts["dac_samples"] + counts["dac_underruns"] == 8, counts
+    # the late sample is the longest wait
+    assert counts["dac_source_cycles"] > 256 * 81 // 10, counts
+
     dut = AC97_Controller()
+    print("cdc latency: dac {} audio_bit_clk cycles, adc {} sync cycles".format(
+        dut.dac_cdc_latency, dut.adc_cdc_latency))
     sim = Simulator(dut)
     sim.add_clock(10e-9) #100MHz
     sim.add_clock(81e-9, domain="audio_bit_clk")
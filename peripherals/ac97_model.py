@@ -0,0 +1,343 @@
+import collections
+import math
+
+from nmigen import *
+from nmigen.sim import *
+from nmigen.lib.io import Pin
+
+from peripherals.ac97 import AC97_DAC_Channels, AC97_ADC_Channels
+
+# Models of AC97_Controller.
+#
+# AC97_Model is the frame level one, for system models running minutes of audio: each
+# step() is one 48 kHz frame, taking the dac sample for it and returning the adc
+# sample the controller delivers at its end. Nothing is clocked, so it runs much faster
+# than real time.
+#
+#   model = AC97_Model()
+#   adc_sample = model.step(dac_sample, input_slots)
+#
+# AC97_CycleModel is a cycle accurate stand-in for co-simulation. It has the controller's
+# record ports and is used in its place, with its process added to the simulator:
+#
+#   m.submodules.ac97 = ac97 = AC97_CycleModel(codec_input=lambda frame: slots)
+#   ...
+#   sim.add_process(ac97.process)
+#
+# Nothing runs in audio_bit_clk. The process works out, a frame at a time, the sync
+# cycles on which the controller would take the dac inputs, pulse dac_sample_written_o
+# and adc_sample_received, including the two flop synchronizers each way, and wakes
+# the simulator only for those. A few registers in sync do the rest as the
+# controller does: inputs are taken when dac_sample_valid_i is set and the last
+# sample has gone, adc samples wait while adc_sample_ready_i is low. The sync side
+# still ticks every cycle, so it's no faster than the controller, only easier to check.
+#
+# Both give the 13 slot values the controller sends in each frame:
+#   tag 0xf980 (frame, command address/data, slots 3, 4, 7 and 8 valid)
+#   slot 1: command address, cycling master, headphone, line out and mic volume,
+#           with reg_read in bit 19. slot 2: command data, always 0
+#   slots 3, 4, 7, 8: left/right front, left/right surround. Centre and lfe aren't sent
+# The codec's input is 13 slots a frame (None is silence), adc_left/adc_right come
+# from slots 3 and 4, adc_tag from tag bits 0 and 11. Frames with no new dac sample
+# repeat the last one and are counted in dac_underruns, adc samples dropped while the
+# last wasn't read in adc_overruns.
+#
+# The cycle model's clock periods have to be the ones the testbench uses for sync,
+# and the codec's bit clock for the controller.
+
+FRAME_BITS = 256
+TAG = 0xf980
+COMMANDS = [0x02000, 0x04000, 0x18000, 0x0e000]
+DAC_SLOTS = {3: "dac_left_front", 4: "dac_right_front", 7: "dac_left_surround", 8: "dac_right_surround"}
+
+# bit clock cycles into a frame the controller takes a dac sample (end of the tag)
+DAC_TAKE_BIT = 16
+
+DAC_FIELDS = {name: len(field) for (name, field) in AC97_DAC_Channels().fields.items()}
+ADC_FIELDS = {name: len(field) for (name, field) in AC97_ADC_Channels().fields.items()}
+
+AC97Frame = collections.namedtuple("AC97Frame", ["slots", "dac_channels"])
+
+def frame_to_bits(slots):
+    # 13 slot values (16 bit tag, 12 20 bit slots) -> 256 bits, msb first
+    bits = [(slots[0] >> (15 - n)) & 1 for n in range(16)]
+    for slot in slots[1:]:
+        bits += [(slot >> (19 - n)) & 1 for n in range(20)]
+    return bits
+
+def bits_to_frame(bits):
+    slots = [int("".join(str(b) for b in bits[0:16]), 2)]
+    for n in range(12):
+        slots.append(int("".join(str(b) for b in bits[16 + 20*n:36 + 20*n]), 2))
+    return slots
+
+def dac_frame_slots(frame, dac_channels, reg_read=0):
+    # slots sent in a frame, dac_channels a {field: value} dict
+    slots = [TAG, COMMANDS[(frame + 1) % 4] | (reg_read << 19)] + [0] * 11
+    for (slot, name) in DAC_SLOTS.items():
+        slots[slot] = dac_channels.get(name, 0) & 0xfffff
+    return slots
+
+def adc_channels_from_slots(slots):
+    return {
+        "adc_tag": (slots[0] & 1) | ((slots[0] >> 11) & 1) << 1,
+        "adc_left": slots[3] & 0xfffff,
+        "adc_right": slots[4] & 0xfffff,
+    }
+
+class AC97_Model:
+    def __init__(self, reg_read=0):
+        self.reg_read = reg_read
+        self.frame = 0
+        self.slots = None           # sent in the last frame
+        self.dac_channels = {name: 0 for name in DAC_FIELDS}
+        self.dac_underruns = 0
+        self.adc_overruns = 0
+
+    def step(self, dac_sample=None, input_slots=None, adc_ready=True):
+        # One frame. dac_sample ({field: value}) is the sample the source had ready for
+        # it, None if it had none and the last one is sent again. input_slots is what
+        # the codec sends. adc_ready is False if the last adc sample returned hasn't
+        # been read, then this frame's is dropped.
+        # Returns the adc sample ({field: value}) delivered at the end of the frame, or None
+        if dac_sample is None:
+            self.dac_underruns += 1
+        else:
+            self.dac_channels = dac_sample
+        self.slots = dac_frame_slots(self.frame, self.dac_channels, self.reg_read)
+        self.frame += 1
+        if not adc_ready:
+            self.adc_overruns += 1
+            return None
+        if input_slots is None:
+            return {name: 0 for name in ADC_FIELDS}
+        return adc_channels_from_slots(input_slots)
+
+class AC97_CycleModel(Elaboratable):
+    def __init__(self, codec_input=None, sync_period=10e-9, bit_clk_period=81e-9, stages=2):
+        # same ports as AC97_Controller
+        self.sdata_in = Pin(width=1, dir="i", xdr = 2)
+        self.sdata_out = Pin(width=1, dir="o")
+        self.sync_o = Pin(width=1, dir="o")
+        self.reset_o = Pin(width=1, dir="o")
+
+        self.dac_channels_i = AC97_DAC_Channels(name="dac_channels_i")
+        self.dac_sample_valid_i = Signal(reset=1)
+        self.dac_sample_written_o = Signal()
+
+        self.adc_channels_o = AC97_ADC_Channels(name="adc_channels_o")
+        self.adc_out_valid = Signal()
+        self.adc_sample_received = Signal()
+        self.adc_sample_ready_i = Signal(reset=1)
+
+        self.reg_read = Signal()
+        self.addr_echo = Signal()
+
+        self.codec_input = codec_input
+        self.sync_period = sync_period
+        self.bit_clk_period = bit_clk_period
+        self.stages = stages
+        self.dac_cdc_latency = stages + 1
+        self.adc_cdc_latency = stages + 1
+
+        self.frames = []
+        self.dac_underruns = 0
+        self.adc_overruns = 0
+
+        # driven by process()
+        self._written_stb = Signal()
+        self._adc_stb = Signal()
+        self._adc_next = AC97_ADC_Channels(name="adc_next")
+        # read by process()
+        self._cycle = Signal(48)
+        self._dac_full = Signal()
+        self._dac_data = AC97_DAC_Channels(name="dac_data")
+        self._capture_cycle = Signal(48)
+        self._adc_full = Signal()
+        self._read_cycle = Signal(48)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.d.sync += self._cycle.eq(self._cycle + 1)
+
+        # the dac mailbox, emptied by the process when the sample is taken
+        capture = Signal()
+        m.d.comb += capture.eq(~self._dac_full & ~self.dac_sample_written_o & self.dac_sample_valid_i)
+        m.d.sync += self.dac_sample_written_o.eq(self._written_stb)
+        with m.If(capture):
+            m.d.sync += [
+                self._dac_data.eq(self.dac_channels_i),
+                self._dac_full.eq(1),
+                self._capture_cycle.eq(self._cycle),
+            ]
+        with m.If(self._written_stb):
+            m.d.sync += self._dac_full.eq(0)
+
+        # the adc mailbox, filled by the process
+        adc_data = AC97_ADC_Channels(name="adc_data")
+        m.d.comb += self.adc_sample_received.eq(self._adc_full & self.adc_sample_ready_i)
+        with m.If(self._adc_stb):
+            m.d.sync += [
+                adc_data.eq(self._adc_next),
+                self._adc_full.eq(1),
+            ]
+        with m.If(self.adc_sample_received):
+            m.d.sync += [
+                self.adc_channels_o.eq(adc_data),
+                self._adc_full.eq(0),
+                self._read_cycle.eq(self._cycle),
+            ]
+
+        return m
+
+    # Time is counted in cycles of each clock: sync cycle n is the one after its n'th
+    # rising edge, which the simulator puts at (n - 1/2) periods (so cycle 0 is before
+    # the first edge), likewise for the bit clock
+    def _edge_time(self, period, cycle):
+        # end of cycle n of a clock
+        return period * (cycle + 0.5)
+
+    def _first_cycle_after(self, period, time):
+        # the first cycle of a clock starting after time
+        return math.floor(time / period - 0.5) + 2
+
+    def _visible_in(self, from_period, to_period, cycle):
+        # a flop toggled at the end of cycle of one clock, seen through the
+        # synchronizer, in which cycle of the other
+        return self._first_cycle_after(to_period, self._edge_time(from_period, cycle)) + self.stages - 1
+
+    def process(self):
+        yield Passive()
+        Ts = self.sync_period
+        Tb = self.bit_clk_period
+        now = [0]
+
+        def advance(cycle):
+            # to the start of a sync cycle, with everything settled
+            middle = Ts * (cycle - 1) if cycle > 1 else Ts / 4
+            start = Ts * (now[0] - 0.5) if now[0] else 0
+            yield Delay(middle - start)
+            yield Tick("sync")
+            yield Settle()
+            now[0] = cycle
+
+        def read_record(rec):
+            values = {}
+            for name in rec.fields:
+                values[name] = (yield rec[name])
+            return values
+
+        dac_channels = {name: 0 for name in DAC_FIELDS}
+        adc_written_cycle = None    # bit clock cycle of the last adc mailbox write
+        frame = 0
+        while True:
+            # the adc sample of the last frame (reset values the first time), then a
+            # dac sample at the end of this frame's tag
+            for (bit, is_adc) in ((FRAME_BITS * frame, True), (FRAME_BITS * frame + DAC_TAKE_BIT, False)):
+                # the process wakes in the sync cycle that sees what the controller did
+                # at the end of bit clock cycle `bit`, one cycle before the synchronizer output
+                wake = self._visible_in(Tb, Ts, bit) - 1
+                yield from advance(wake)
+
+                if is_adc:
+                    # the last sample has to have been read, and the ack seen
+                    free = adc_written_cycle is None or (not (yield self._adc_full) and
+                        self._visible_in(Ts, Tb, (yield self._read_cycle)) <= bit)
+                    if free:
+                        if frame == 0 or self.codec_input is None:
+                            slots = None
+                        else:
+                            slots = self.codec_input(frame - 1)
+                        adc = adc_channels_from_slots(slots) if slots is not None else \
+                            {name: 0 for name in ADC_FIELDS}
+                        for (name, value) in adc.items():
+                            yield self._adc_next[name].eq(value)
+                        yield self._adc_stb.eq(1)
+                        adc_written_cycle = bit
+                    else:
+                        self.adc_overruns += 1
+                else:
+                    taken = (yield self._dac_full) and \
+                        self._visible_in(Ts, Tb, (yield self._capture_cycle)) <= bit
+                    if taken:
+                        dac_channels = yield from read_record(self._dac_data)
+                        yield self._written_stb.eq(1)
+                    else:
+                        self.dac_underruns += 1
+                    slots = dac_frame_slots(frame, dac_channels, (yield self.reg_read))
+                    self.frames.append(AC97Frame(slots, dict(dac_channels)))
+
+                yield from advance(wake + 1)
+                yield self._adc_stb.eq(0)
+                yield self._written_stb.eq(0)
+            frame += 1
+
+
+if __name__ == "__main__":
+    import random
+    import time
+
+    # the frame model against the cycle model, with a source that always has the next
+    # sample ready and a reader that takes every adc sample
+    rng = random.Random(1)
+    frames = 8
+    dac_samples = [{name: rng.getrandbits(width) for (name, width) in DAC_FIELDS.items()}
+        for _ in range(frames)]
+    input_slots = [[rng.getrandbits(16)] + [rng.getrandbits(20) for _ in range(12)] for _ in range(frames)]
+
+    cycle_model = AC97_CycleModel(codec_input=lambda frame: input_slots[frame] if frame < frames else None)
+    sim = Simulator(cycle_model)
+    sim.add_clock(10e-9)
+    sim.add_process(cycle_model.process)
+    received = []
+
+    def source():
+        for sample in dac_samples[1:]:
+            yield
+            while not (yield cycle_model.dac_sample_written_o):
+                yield
+            for (name, value) in sample.items():
+                yield cycle_model.dac_channels_i[name].eq(value)
+
+    def reader():
+        while len(received) < frames:
+            yield
+            if (yield cycle_model.adc_sample_received):
+                yield
+                sample = {}
+                for name in ADC_FIELDS:
+                    sample[name] = (yield cycle_model.adc_channels_o[name])
+                received.append(sample)
+
+    sim.add_sync_process(source)
+    sim.add_sync_process(reader)
+    sim.run()
+
+    # the controller sends zeros in the first frame (taken out of reset) and delivers
+    # the reset adc sample first, the cycle model has both
+    model = AC97_Model()
+    expected_adc = [{name: 0 for name in ADC_FIELDS}]
+    dac = [{name: 0 for name in DAC_FIELDS}] + dac_samples[1:]
+    for n in range(frames - 1):
+        expected_adc.append(model.step(dac[n], input_slots[n]))
+        assert model.slots == cycle_model.frames[n].slots, n
+    assert received == expected_adc
+
+    # underruns and overruns
+    model = AC97_Model()
+    model.step(dac_samples[0])
+    model.step(None)
+    assert model.slots[3] == dac_samples[0]["dac_left_front"]
+    assert model.step(dac_samples[1], input_slots[0], adc_ready=False) is None
+    assert (model.dac_underruns, model.adc_overruns) == (1, 1)
+
+    # a second of audio has to take less than a second
+    model = AC97_Model()
+    rate = 48000
+    start = time.perf_counter()
+    for n in range(rate):
+        dac_samples[0]["dac_left_front"] = n & 0xfffff
+        model.step(dac_samples[0], input_slots[n & 7])
+    elapsed = time.perf_counter() - start
+    print("{} frames (1 s of audio) in {:.3f} s, {:.0f}x real time".format(rate, elapsed, 1 / elapsed))
+    assert elapsed < 1.0
@@ -20,4 +20,18 @@ Reg | <65MHz | >65MHz
 34h | 16h    | 26h
 36h | 60h    | A0h
 Device starts in full power down mode so will need to write C0h to register 49h.
-"""
\ No newline at end of file
+"""
+
+# 7 bit I2C address of the CH7301C on the ML505
+CH7301C_I2C_ADDRESS = 0x76
+
+def ch7301c_init_writes(pixel_clock=65e6, i2c_address=CH7301C_I2C_ADDRESS):
+    # (device address, register, value) writes to bring the CH7301C out of power down,
+    # with the PLL settings from table 10 chosen by the pixel clock
+    fast = pixel_clock > 65e6
+    return [
+        (i2c_address, 0x49, 0xC0),
+        (i2c_address, 0x33, 0x06 if fast else 0x08),
+        (i2c_address, 0x34, 0x26 if fast else 0x16),
+        (i2c_address, 0x36, 0xA0 if fast else 0x60),
+    ]
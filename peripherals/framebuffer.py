@@ -0,0 +1,215 @@
+from nmigen import *
+from nmigen.sim import *
+from nmigen.lib.cdc import PulseSynchronizer
+
+from utility.bram_inst import BRAMWrapper
+
+# Double buffered line/tile framebuffer for the DVI path.
+# Each page holds `lines` lines of `width` pixels packed into 32 bit words:
+#   8bpp: 4 palette indices per word, through a 256 entry 24 bit palette
+#   16bpp: 2 RGB565 pixels per word
+#   24bpp: 1 RGB888 pixel per word
+# Pixels are written a word at a time in the sync domain to the back page,
+# and read in the pixel domain from the front page. Frames larger than the
+# buffer repeat it as a tile (x modulo width, y modulo lines).
+#
+# The read side is addressed by the x/y counters of the video timing and
+# returns the pixel a fixed `latency` pixel clocks later, so it can't underrun:
+# delay hsync/vsync/data enable by the same amount.
+
+class StreamingFramebuffer(Elaboratable):
+    def __init__(self, width=1024, lines=2, bpp=24, pixel_domain="pixel"):
+        if bpp not in (8, 16, 24):
+            raise ValueError("bpp must be one of 8, 16 or 24")
+        if lines & (lines - 1):
+            raise ValueError("lines must be a power of 2")
+        self.width = width
+        self.lines = lines
+        self.bpp = bpp
+        self.pixel_domain = pixel_domain
+
+        self.pixels_per_word = {8: 4, 16: 2, 24: 1}[bpp]
+        self.words_per_line = -(-width // self.pixels_per_word)
+        self._word_bits = max(1, (self.words_per_line - 1).bit_length())
+        self._line_bits = (lines - 1).bit_length()
+
+        # write port, sync domain. write_address is Cat(word in line, line)
+        self.write_address = Signal(self._word_bits + self._line_bits)
+        self.write_data = Signal(32)
+        self.write_en = Signal()
+        self.swap = Signal()            # strobe when the back page is complete
+        self.swap_pending = Signal()    # high from swap until the next vsync has shown the new page
+
+        # palette write port for 8bpp, sync domain
+        self.palette_address = Signal(8)
+        self.palette_data = Signal(24)
+        self.palette_en = Signal()
+
+        # read port, pixel domain
+        self.x = Signal(range(width))
+        self.y = Signal(16)
+        self.vsync = Signal()
+        self.rgb = Signal(24)
+
+        # pixel clocks from x/y to rgb
+        self.latency = 2 + 1 + int(bpp == 8)
+
+    def elaborate(self, platform):
+        m = Module()
+        pix = m.d[self.pixel_domain]
+
+        depth = 2 << (self._word_bits + self._line_bits)
+        m.submodules.ram = ram = BRAMWrapper(width=32, depth=depth,
+            write_domain="sync", read_domain=self.pixel_domain)
+        assert ram.latency == 2
+
+        # Page flipping. The pixel domain owns the front page and only flips on vsync
+        m.submodules.swap_ps = swap_ps = PulseSynchronizer(i_domain="sync", o_domain=self.pixel_domain)
+        m.submodules.swapped_ps = swapped_ps = PulseSynchronizer(i_domain=self.pixel_domain, o_domain="sync")
+        front_page = Signal()
+        back_page = Signal(reset=1)
+        flip_pending = Signal()
+        vsync_prev = Signal()
+        m.d.comb += swap_ps.i.eq(self.swap & ~self.swap_pending)
+        with m.If(self.swap):
+            m.d.sync += self.swap_pending.eq(1)
+        with m.If(swapped_ps.o):
+            m.d.sync += [
+                self.swap_pending.eq(0),
+                back_page.eq(~back_page),
+            ]
+        pix += vsync_prev.eq(self.vsync)
+        with m.If(swap_ps.o):
+            pix += flip_pending.eq(1)
+        with m.If(flip_pending & self.vsync & ~vsync_prev):
+            pix += [
+                flip_pending.eq(0),
+                front_page.eq(~front_page),
+            ]
+            m.d.comb += swapped_ps.i.eq(1)
+
+        m.d.comb += [
+            ram.write_address.eq(Cat(self.write_address, back_page)),
+            ram.write_data.eq(self.write_data),
+            ram.write_en.eq(self.write_en),
+        ]
+
+        # Read address from the pixel position, keeping the pixel index in the word
+        # lined up with the BRAM output
+        sub_pixel_bits = self.pixels_per_word.bit_length() - 1
+        word = self.x >> sub_pixel_bits
+        sub_pixel = self.x[0:max(1, sub_pixel_bits)]
+        m.d.comb += ram.read_address.eq(Cat(word[0:self._word_bits],
+            self.y[0:self._line_bits], front_page))
+        for stage in range(ram.latency):
+            sub_pixel_delayed = Signal.like(sub_pixel, name="sub_pixel_{}".format(stage))
+            pix += sub_pixel_delayed.eq(sub_pixel)
+            sub_pixel = sub_pixel_delayed
+
+        data = ram.read_port
+        if self.bpp == 24:
+            pix += self.rgb.eq(data[0:24])
+        elif self.bpp == 16:
+            rgb565 = Signal(16)
+            m.d.comb += rgb565.eq(Mux(sub_pixel, data[16:32], data[0:16]))
+            # expand by repeating the MSBs into the LSBs
+            pix += self.rgb.eq(Cat(
+                rgb565[0:5][2:5], rgb565[0:5],          # blue
+                rgb565[5:11][4:6], rgb565[5:11],        # green
+                rgb565[11:16][2:5], rgb565[11:16],      # red
+            ))
+        else:
+            palette = Memory(width=24, depth=256)
+            m.submodules.palette_w = palette_w = palette.write_port(domain="sync")
+            m.submodules.palette_r = palette_r = palette.read_port(domain=self.pixel_domain, transparent=False)
+            m.d.comb += [
+                palette_w.addr.eq(self.palette_address),
+                palette_w.data.eq(self.palette_data),
+                palette_w.en.eq(self.palette_en),
+                palette_r.addr.eq(data.word_select(sub_pixel, 8)),
+            ]
+            pix += self.rgb.eq(palette_r.data)
+
+        return m
+
+
+if __name__=="__main__":
+    import random
+
+    for bpp in (8, 16, 24):
+        m = Module()
+        m.domains.pixel = ClockDomain()
+        m.submodules.fb = fb = StreamingFramebuffer(width=16, lines=2, bpp=bpp)
+        sim = Simulator(m)
+        sim.add_clock(10e-9) #100MHz
+        sim.add_clock(15.4e-9, domain="pixel") #65MHz
+
+        def expected_rgb(words, palette, x, y):
+            word = words[y % fb.lines][x // fb.pixels_per_word]
+            sub = x % fb.pixels_per_word
+            if bpp == 24:
+                return word & 0xffffff
+            if bpp == 16:
+                p = (word >> 16*sub) & 0xffff
+                b, g, r = p & 0x1f, (p >> 5) & 0x3f, p >> 11
+                return ((r << 3 | r >> 2) << 16) | ((g << 2 | g >> 4) << 8) | (b << 3 | b >> 2)
+            return palette[(word >> 8*sub) & 0xff]
+
+        pages = [[[random.getrandbits(32) for _ in range(fb.words_per_line)]
+            for _ in range(fb.lines)] for _ in range(2)]
+        palette = [random.getrandbits(24) for _ in range(256)]
+        shown = []
+
+        def writer():
+            for n in range(256):
+                yield fb.palette_address.eq(n)
+                yield fb.palette_data.eq(palette[n])
+                yield fb.palette_en.eq(1)
+                yield
+            yield fb.palette_en.eq(0)
+            for words in pages:
+                for line in range(fb.lines):
+                    for word in range(fb.words_per_line):
+                        yield fb.write_address.eq(word | (line << fb._word_bits))
+                        yield fb.write_data.eq(words[line][word])
+                        yield fb.write_en.eq(1)
+                        yield
+                yield fb.write_en.eq(0)
+                yield fb.swap.eq(1)
+                yield
+                yield fb.swap.eq(0)
+                yield
+                while (yield fb.swap_pending):
+                    yield
+                shown.append(words)
+
+        def scanout():
+            # frames of 16x4 pixels with a short blanking period
+            history = []
+            checked = 0
+            for frame in range(8):
+                yield fb.vsync.eq(1)
+                for _ in range(20):
+                    yield
+                yield fb.vsync.eq(0)
+                # frame shows the page swapped at the start of this vsync
+                words = shown[-1] if shown else None
+                for y in range(4):
+                    for x in range(16):
+                        yield fb.x.eq(x)
+                        yield fb.y.eq(y)
+                        yield
+                        history.append((x, y))
+                        if len(history) > fb.latency:
+                            (hx, hy) = history[-fb.latency-1]
+                            if words is not None:
+                                assert (yield fb.rgb) == expected_rgb(words, palette, hx, hy), (bpp, hx, hy)
+                                checked += 1
+                history = []
+            print("{}bpp: {} pages shown, {} pixels checked".format(bpp, len(shown), checked))
+
+        sim.add_sync_process(writer)
+        sim.add_sync_process(scanout, domain="pixel")
+
+        with sim.write_vcd("framebuffer_{}bpp.vcd".format(bpp)):
+            sim.run_until(3e-5)
@@ -0,0 +1,252 @@
+from nmigen import *
+from nmigen.sim import *
+from nmigen.lib.io import Pin
+
+from utility.bram_inst import BROMWrapper, generate_init_data
+
+# A write-only I2C master, enough to set up register based peripherals.
+# Each transaction is START, device address + W, register, data, STOP,
+# with the ACK after every byte checked.
+# SCL and SDA are open drain: the pins are only ever driven low.
+
+class I2C_Master(Elaboratable):
+    def __init__(self, fclk=None, i2c_freq=100e3):
+        self.scl = Pin(width=1, dir="io")
+        self.sda = Pin(width=1, dir="io")
+
+        self.start      = Signal()      # begin a write when not busy
+        self.dev_addr   = Signal(7)
+        self.reg_addr   = Signal(8)
+        self.data       = Signal(8)
+        self.busy       = Signal()
+        self.done       = Signal()      # asserted for one cycle at the end of the STOP
+        self.ack_error  = Signal()      # set if any byte of the last write was not acknowledged
+
+        if(fclk==None):
+            raise ValueError("Please specify fclk")
+        else:
+            # SCL is generated from 4 quarter periods
+            self.divider = max(int(fclk/(4*i2c_freq)), 1)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        scl_level = Signal(reset=1)
+        sda_level = Signal(reset=1)
+        m.d.comb += [
+            self.scl.o.eq(0),
+            self.scl.oe.eq(~scl_level),
+            self.sda.o.eq(0),
+            self.sda.oe.eq(~sda_level),
+        ]
+
+        # Quarter period strobe, only runs during a transaction
+        quarter_count = Signal(range(self.divider))
+        tick = Signal()
+        m.d.comb += tick.eq(quarter_count==(self.divider-1))
+        with m.If(self.busy):
+            m.d.sync += quarter_count.eq(quarter_count+1)
+            with m.If(tick):
+                m.d.sync += quarter_count.eq(0)
+
+        # address, r/w, and data bytes with a released SDA in each ACK slot, MSB first
+        shift_out = Signal(27)
+        bit_count = Signal(range(27))
+        phase = Signal(2)
+        ack_slot = Signal()
+        m.d.comb += ack_slot.eq((bit_count==8) | (bit_count==17) | (bit_count==26))
+
+        with m.FSM():
+            with m.State("IDLE"):
+                with m.If(self.start):
+                    m.d.sync += [
+                        shift_out.eq(Cat(Const(1, 1), self.data, Const(1, 1),
+                            self.reg_addr, Const(1, 1), Const(0, 1), self.dev_addr)),
+                        bit_count.eq(0),
+                        phase.eq(0),
+                        self.ack_error.eq(0),
+                        quarter_count.eq(0),
+                    ]
+                    m.next = "START"
+            with m.State("START"):
+                m.d.comb += self.busy.eq(1)
+                # SDA falls while SCL is high, then SCL falls
+                with m.If(tick):
+                    m.d.sync += phase.eq(phase+1)
+                    with m.If(phase==0):
+                        m.d.sync += sda_level.eq(0)
+                    with m.If(phase==1):
+                        m.d.sync += [
+                            scl_level.eq(0),
+                            phase.eq(0),
+                        ]
+                        m.next = "BITS"
+            with m.State("BITS"):
+                m.d.comb += self.busy.eq(1)
+                with m.If(tick):
+                    m.d.sync += phase.eq(phase+1)
+                    with m.Switch(phase):
+                        with m.Case(0):
+                            m.d.sync += sda_level.eq(shift_out[26])
+                        with m.Case(1):
+                            m.d.sync += scl_level.eq(1)
+                        with m.Case(2):
+                            with m.If(ack_slot & self.sda.i):
+                                m.d.sync += self.ack_error.eq(1)
+                        with m.Case(3):
+                            m.d.sync += [
+                                scl_level.eq(0),
+                                shift_out.eq(shift_out << 1),
+                                bit_count.eq(bit_count+1),
+                            ]
+                            with m.If(bit_count==26):
+                                m.next = "STOP"
+            with m.State("STOP"):
+                m.d.comb += self.busy.eq(1)
+                # SDA rises while SCL is high
+                with m.If(tick):
+                    m.d.sync += phase.eq(phase+1)
+                    with m.Switch(phase):
+                        with m.Case(0):
+                            m.d.sync += sda_level.eq(0)
+                        with m.Case(1):
+                            m.d.sync += scl_level.eq(1)
+                        with m.Case(2):
+                            m.d.sync += sda_level.eq(1)
+                        with m.Case(3):
+                            m.d.comb += self.done.eq(1)
+                            m.next = "IDLE"
+
+        return m
+
+# Each ROM word is one register write:
+# [31] valid, [22:16] device address, [15:8] register, [7:0] data.
+# The first word without the valid bit ends the sequence, so unused BRAM (zeroes) terminates it.
+def generate_i2c_init_data(writes, size=16):
+    words = [(1 << 31) | (dev_addr << 16) | (reg << 8) | data for (dev_addr, reg, data) in writes]
+    assert len(words) < 32*size
+    words += [0] * (32*size - len(words))
+    return generate_init_data(size, words, signed_output=False)
+
+# Streams a whole table of register writes out of a block ROM with no CPU involved.
+# Runs once after reset (or on start), asserting done when the table has been written.
+class I2C_InitSequencer(Elaboratable):
+    def __init__(self, writes, fclk=None, i2c_freq=100e3, size=16, startup_delay=0, auto_start=True):
+        self.i2c = I2C_Master(fclk=fclk, i2c_freq=i2c_freq)
+        self.scl = self.i2c.scl
+        self.sda = self.i2c.sda
+
+        self.start  = Signal()      # rerun the sequence
+        self.busy   = Signal()
+        self.done   = Signal()      # held high once the table has been written
+        self.error  = Signal()      # held high if any write was not acknowledged
+
+        self.ROM_data = generate_i2c_init_data(writes, size=size)
+        self.size = size
+        self.startup_delay = startup_delay
+        self.auto_start = auto_start
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.i2c = i2c = self.i2c
+        m.submodules.rom = rom = BROMWrapper(self.ROM_data, size=self.size)
+
+        entry = rom.read_port
+        address = Signal.like(rom.address)
+        m.d.comb += [
+            rom.address.eq(address),
+            i2c.dev_addr.eq(entry[16:23]),
+            i2c.reg_addr.eq(entry[8:16]),
+            i2c.data.eq(entry[0:8]),
+        ]
+
+        # covers the ROM latency after the address changes
+        wait = Signal(range(max(self.startup_delay, rom.latency) + 2))
+        with m.FSM():
+            with m.State("RESET"):
+                m.d.sync += wait.eq(wait+1)
+                with m.If(wait==self.startup_delay):
+                    m.d.sync += wait.eq(0)
+                    m.next = "FETCH" if self.auto_start else "IDLE"
+            with m.State("IDLE"):
+                with m.If(self.start):
+                    m.d.sync += [
+                        address.eq(0),
+                        wait.eq(0),
+                        self.done.eq(0),
+                        self.error.eq(0),
+                    ]
+                    m.next = "FETCH"
+            with m.State("FETCH"):
+                m.d.comb += self.busy.eq(1)
+                m.d.sync += wait.eq(wait+1)
+                with m.If(wait==rom.latency):
+                    m.d.sync += wait.eq(0)
+                    with m.If(entry[31]):
+                        m.d.comb += i2c.start.eq(1)
+                        m.next = "WRITE"
+                    with m.Else():
+                        m.d.sync += self.done.eq(1)
+                        m.next = "IDLE"
+            with m.State("WRITE"):
+                m.d.comb += self.busy.eq(1)
+                with m.If(i2c.done):
+                    m.d.sync += [
+                        address.eq(address+1),
+                        self.error.eq(self.error | i2c.ack_error),
+                    ]
+                    m.next = "FETCH"
+
+        return m
+
+
+if __name__=="__main__":
+    from peripherals.dvi_transmitter import ch7301c_init_writes
+
+    writes = ch7301c_init_writes(pixel_clock=65e6)
+    dut = I2C_InitSequencer(writes, fclk=100e6, i2c_freq=400e3)
+    sim = Simulator(dut)
+    sim.add_clock(10e-9) #100MHz
+
+    # Open drain bus: a line is low if anything pulls it low
+    def bus():
+        while True:
+            yield dut.scl.i.eq(~(yield dut.scl.oe))
+            yield dut.sda.i.eq(~(yield dut.sda.oe) & ~(yield slave_sda_low))
+            yield
+
+    # Slave that acknowledges every byte and records what it received
+    slave_sda_low = Signal()
+    received = []
+    def slave():
+        scl = sda = 1
+        while True:
+            yield
+            scl_prev, sda_prev = scl, sda
+            scl = yield dut.scl.i
+            sda = yield dut.sda.i
+            if scl and scl_prev and sda_prev and not sda:   # START
+                bits = []
+            elif scl and not scl_prev:                      # SCL rising, sample
+                bits.append(sda)
+            elif not scl and scl_prev:                      # SCL falling, drive ACK
+                ack = (len(bits) % 9 == 8)
+                yield slave_sda_low.eq(ack)
+                if len(bits) == 27:
+                    byte = lambda n: int("".join(str(b) for b in bits[9*n:9*n+8]), 2)
+                    received.append((byte(0) >> 1, byte(1), byte(2)))
+
+    def check():
+        while not (yield dut.done):
+            yield
+        assert not (yield dut.error)
+        assert received == writes, received
+        print("wrote", ["{:02x}={:02x}".format(r, d) for (_, r, d) in received])
+
+    sim.add_sync_process(bus)
+    sim.add_sync_process(slave)
+    sim.add_sync_process(check)
+
+    with sim.write_vcd("i2c_waves.vcd"):
+        sim.run_until(5e-4)
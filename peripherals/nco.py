@@ -0,0 +1,283 @@
+from nmigen import *
+from nmigen.sim import *
+
+from utility.bram_inst import BROMWrapper, generate_init_data
+from peripherals.ac97 import AC97_DAC_Channels
+
+import math
+
+# Phase accumulator NCO/DDS using a quarter-wave sine table in block ROM.
+# The top 2 phase bits pick the quadrant, the next table_bits address the table
+# (mirrored in quadrants 1 and 3, negated in 2 and 3). Table entry i holds the sine
+# at the centre of its step, (i + 0.5) * pi/2 / 2**table_bits, so mirroring is exact.
+#
+# With taylor=True the remaining phase bits interpolate, sin(x + d) ~= sin(x) + d*cos(x),
+# using a second table of cos(x) pre-scaled by the table step so only one 25x18
+# multiply is needed. It is registered on both sides so XST maps it into a DSP48E
+# with its input, M and P registers.
+#
+# Every stage is registered for one sample per clock. With channels > 1 the
+# channels are time multiplexed: each enabled cycle advances the next channel,
+# and `channel` tags which one `sample` belongs to.
+
+def nco_frequency_word(frequency, sample_rate, phase_bits=32):
+    # phase increment per enabled cycle
+    return int(round(frequency / sample_rate * 2**phase_bits)) % 2**phase_bits
+
+class NCO(Elaboratable):
+    def __init__(self, phase_bits=32, table_bits=9, output_width=20, taylor=False, taylor_bits=10, channels=1):
+        # one RAMB18SDP per table, 512x32. The 32k RAMB36SDP is 512x64 with the same
+        # 9 bit address, so it doesn't give a deeper 32 bit table
+        if table_bits != 9:
+            raise ValueError("table_bits must be 9 (a 512x32 BRAM)")
+        self.phase_bits = phase_bits
+        self.table_bits = table_bits
+        self.output_width = output_width
+        self.taylor = taylor
+        self.taylor_bits = min(taylor_bits, phase_bits - 2 - table_bits)
+        self.channels = channels
+
+        self.frequency = [Signal(phase_bits, name="frequency_{}".format(n)) for n in range(channels)]
+        self.en = Signal(reset=1)
+        self.sample = Signal(signed(output_width))
+        self.channel = Signal(range(max(2, channels)))
+        self.valid = Signal()
+
+        size = 16
+        entries = 2**table_bits
+        self.amplitude = 2**(output_width - 1) - 1
+        step = math.pi / 2 / entries
+        angles = [(i + 0.5) * step for i in range(entries)]
+        self.sin_table = generate_init_data(size, [int(round(self.amplitude * math.sin(a))) for a in angles])
+        # cos(x) * step, scaled up as far as an 18 bit multiplier input allows
+        self.cos_gain = int(math.floor(math.log2((2**17 - 1) / (self.amplitude * step))))
+        self.cos_table = generate_init_data(size,
+            [int(round(self.amplitude * step * math.cos(a) * 2**self.cos_gain)) for a in angles])
+        self.table_size = size
+
+        self.latency = 1 + 1 + 2 + (3 if taylor else 0) + 1
+
+    def elaborate(self, platform):
+        m = Module()
+
+        # Stage 1: phase accumulators
+        channel = Signal.like(self.channel)
+        phase = Signal(self.phase_bits)
+        valid = Signal()
+        if self.channels == 1:
+            accumulator = Signal(self.phase_bits)
+            with m.If(self.en):
+                m.d.sync += [
+                    accumulator.eq(accumulator + self.frequency[0]),
+                    phase.eq(accumulator),
+                ]
+        else:
+            accumulators = Array(Signal(self.phase_bits, name="accumulator_{}".format(n))
+                for n in range(self.channels))
+            frequencies = Array(self.frequency)
+            next_channel = Signal.like(self.channel)
+            with m.If(self.en):
+                m.d.sync += [
+                    accumulators[next_channel].eq(accumulators[next_channel] + frequencies[next_channel]),
+                    phase.eq(accumulators[next_channel]),
+                    channel.eq(next_channel),
+                    next_channel.eq(Mux(next_channel == self.channels - 1, 0, next_channel + 1)),
+                ]
+        m.d.sync += valid.eq(self.en)
+
+        # Stage 2: quadrant and table address
+        quadrant = phase[-2:]
+        index = phase[-2-self.table_bits:-2]
+        frac = phase[-2-self.table_bits-self.taylor_bits:-2-self.table_bits]
+        address = Signal(self.table_bits)
+        pipe = [(Signal(2, name="quadrant_0"), Signal(len(frac), name="frac_0"),
+            Signal.like(channel, name="channel_0"), Signal(name="valid_0"))]
+        m.d.sync += [
+            address.eq(Mux(quadrant[0], ~index, index)),
+            pipe[0][0].eq(quadrant),
+            pipe[0][1].eq(Mux(quadrant[0], ~frac, frac)),
+            pipe[0][2].eq(channel),
+            pipe[0][3].eq(valid),
+        ]
+
+        # Stages 3-4: tables
+        m.submodules.sin_rom = sin_rom = BROMWrapper(self.sin_table, size=self.table_size)
+        m.d.comb += sin_rom.address.eq(address)
+        value = Signal(signed(self.output_width + 1))
+
+        def delay(stages):
+            for n in range(stages):
+                stage = tuple(Signal.like(s, name="{}_{}".format(s.name.rsplit("_", 1)[0], len(pipe)))
+                    for s in pipe[-1])
+                m.d.sync += [a.eq(b) for (a, b) in zip(stage, pipe[-1])]
+                pipe.append(stage)
+
+        delay(sin_rom.latency)
+
+        if not self.taylor:
+            m.d.comb += value.eq(sin_rom.read_port[0:self.output_width - 1])
+        else:
+            m.submodules.cos_rom = cos_rom = BROMWrapper(self.cos_table, size=self.table_size)
+            m.d.comb += cos_rom.address.eq(address)
+
+            # Stages 5-7: DSP48E, registered inputs, product, and sum
+            sin_reg = Signal(self.output_width - 1)
+            cos_reg = Signal(signed(18))
+            # phase offset from the centre of the table step, signed
+            delta = Signal(signed(len(frac)))
+            product = Signal(signed(18 + len(frac)))
+            sin_delayed = Signal(self.output_width - 1)
+            m.d.sync += [
+                sin_reg.eq(sin_rom.read_port[0:self.output_width - 1]),
+                cos_reg.eq(cos_rom.read_port[0:17]),
+                delta.eq(Cat(pipe[-1][1][:-1], ~pipe[-1][1][-1])),
+                product.eq(cos_reg * delta),
+                sin_delayed.eq(sin_reg),
+                value.eq(sin_delayed + (product >> (len(frac) + self.cos_gain))),
+            ]
+            delay(3)
+
+        # Final stage: sign from the quadrant
+        (quadrant, _, channel, valid) = pipe[-1]
+        m.d.sync += [
+            self.sample.eq(Mux(quadrant[1], -value, value)),
+            self.channel.eq(channel),
+            self.valid.eq(valid),
+        ]
+
+        return m
+
+# Streams NCO tones into the DAC slots of an AC97_Controller.
+# Connect sample_request to dac_sample_written_o, dac_channels_o to dac_channels_i and
+# dac_sample_valid_o to dac_sample_valid_i; each request computes the next sample of
+# all six channels, and dac_sample_valid_o is low until it's on dac_channels_o.
+class NCO_AC97_Source(Elaboratable):
+    def __init__(self, **kwargs):
+        self.nco = NCO(channels=6, output_width=20, **kwargs)
+        # left front, right front, centre, left surround, right surround, lfe
+        self.frequency = self.nco.frequency
+        self.sample_request = Signal()
+        self.dac_channels_o = AC97_DAC_Channels(name="dac_channels_o")
+        self.dac_sample_valid_o = Signal(reset=1)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.nco = nco = self.nco
+
+        steps = Signal(range(7))
+        m.d.comb += nco.en.eq(steps != 0)
+        with m.If(self.sample_request):
+            m.d.sync += steps.eq(6)
+        with m.Elif(steps != 0):
+            m.d.sync += steps.eq(steps - 1)
+
+        slots = [self.dac_channels_o.dac_left_front, self.dac_channels_o.dac_right_front,
+            self.dac_channels_o.dac_centre, self.dac_channels_o.dac_left_surround,
+            self.dac_channels_o.dac_right_surround, self.dac_channels_o.dac_lfe]
+        m.d.comb += self.dac_channels_o.dac_tag.eq(0b111111)
+        with m.If(nco.valid):
+            with m.Switch(nco.channel):
+                for (n, slot) in enumerate(slots):
+                    with m.Case(n):
+                        m.d.sync += slot.eq(nco.sample)
+        with m.If(self.sample_request):
+            m.d.sync += self.dac_sample_valid_o.eq(0)
+        with m.Elif(nco.valid & (nco.channel == len(slots) - 1)):
+            m.d.sync += self.dac_sample_valid_o.eq(1)
+
+        return m
+
+
+if __name__=="__main__":
+    for (taylor, tolerance) in ((False, 2**19 * math.pi / 2**10), (True, 8)):
+        channels = 3
+        dut = NCO(taylor=taylor, channels=channels)
+        sim = Simulator(dut)
+        sim.add_clock(5e-9) #200MHz
+        words = [nco_frequency_word(f, 200e6) for f in (1.3e6, 7.77e6, 31e6)]
+
+        def process():
+            for (n, word) in enumerate(words):
+                yield dut.frequency[n].eq(word)
+            phases = [0] * channels
+            errors = []
+            for _ in range(dut.latency):
+                yield
+            for cycle in range(600):
+                yield
+                if (yield dut.valid):
+                    n = (yield dut.channel)
+                    expected = dut.amplitude * math.sin(2 * math.pi * phases[n] / 2**32)
+                    errors.append(abs((yield dut.sample) - expected))
+                    phases[n] = (phases[n] + words[n]) % 2**32
+            print("taylor={}: max error {:.2f} LSB over {} samples".format(taylor, max(errors), len(errors)))
+            assert max(errors) < tolerance
+
+        sim.add_sync_process(process)
+        with sim.write_vcd("nco_waves.vcd"):
+            sim.run_until(5e-9 * 700)
+
+    # AC97 source: one sample of each channel per request
+    dut = NCO_AC97_Source(taylor=True)
+    sim = Simulator(dut)
+    sim.add_clock(10e-9)
+    words = [nco_frequency_word(f, 48e3) for f in (440, 880, 1000, 2000, 5000, 100)]
+
+    def process():
+        for (n, word) in enumerate(words):
+            yield dut.frequency[n].eq(word)
+        for sample in range(4):
+            yield dut.sample_request.eq(1)
+            yield
+            yield dut.sample_request.eq(0)
+            # valid drops until all six channels are out
+            cycles = 0
+            while True:
+                yield
+                cycles += 1
+                if (yield dut.dac_sample_valid_o):
+                    break
+            assert cycles > 6, cycles
+            lfe = (yield dut.dac_channels_o.dac_lfe)
+            lfe -= (lfe >> 19) << 20
+            expected = dut.nco.amplitude * math.sin(2 * math.pi * sample * words[5] / 2**32)
+            assert abs(lfe - expected) < 8, (sample, lfe, expected)
+        print("ac97 source: ok")
+
+    sim.add_sync_process(process)
+    sim.run()
+
+    # with the controller (its cycle accurate model), each frame carries the sample
+    # computed for it: the controller waits for dac_sample_valid_o
+    from peripherals.ac97_model import AC97_CycleModel
+    source = NCO_AC97_Source(taylor=True)
+    controller = AC97_CycleModel()
+    m = Module()
+    m.submodules.source = source
+    m.submodules.controller = controller
+    m.d.comb += [
+        source.sample_request.eq(controller.dac_sample_written_o),
+        controller.dac_channels_i.eq(source.dac_channels_o),
+        controller.dac_sample_valid_i.eq(source.dac_sample_valid_o),
+    ]
+    sim = Simulator(m)
+    sim.add_clock(10e-9)
+    sim.add_process(controller.process)
+    samples = []
+
+    def process():
+        yield source.frequency[5].eq(words[5])
+        while len(samples) < 4:
+            yield
+            if (yield controller.dac_sample_written_o):
+                yield
+                while not (yield source.dac_sample_valid_o):
+                    yield
+                samples.append((yield source.dac_channels_o.dac_lfe))
+
+    sim.add_sync_process(process)
+    sim.run()
+    sent = [frame.dac_channels["dac_lfe"] for frame in controller.frames[1:]]
+    assert sent[:3] == samples[:3], (sent, samples)
+    print("ac97 source with controller: ok")
+
@@ -0,0 +1,374 @@
+from nmigen import *
+from nmigen.sim import *
+
+from utility.bram_inst import BROMWrapper, BRAMWrapper, generate_init_data
+from peripherals.ac97 import AC97_DAC_Channels, AC97_ADC_Channels
+
+import math
+
+# Polyphase FIR interpolator / decimator for multiple channels with one multiplier.
+# The AC97 side only produces or wants a sample every 48 kHz frame, about 2000
+# sync cycles, so a single registered multiply-accumulate (mapped to a DSP48E) is
+# shared across every tap of every channel.
+#
+# Sample history for all channels lives in one BRAM ring (address = Cat(tap, channel)),
+# coefficients in a BROMWrapper ROM stored phase-major so each phase reads them in order.
+#
+#   interpolate: each output_request computes one output phase (taps/factor products per
+#       channel). Every factor requests one input sample is consumed (input_ready).
+#   decimate: every input_valid writes the history. Every factor inputs the full filter
+#       is computed and output_valid is pulsed.
+#
+# Coefficients are floats, quantized to coefficient_width bits with unity at
+# 2**(coefficient_width-1). Outputs are rounded and saturated to width bits.
+
+def lowpass_coefficients(taps, cutoff, gain=1.0):
+    # Hamming windowed sinc, cutoff as a fraction of the (high) sample rate, 0.5 = nyquist
+    centre = (taps - 1) / 2
+    h = []
+    for n in range(taps):
+        x = n - centre
+        sinc = 2 * cutoff if x == 0 else math.sin(2 * math.pi * cutoff * x) / (math.pi * x)
+        window = 0.54 - 0.46 * math.cos(2 * math.pi * n / (taps - 1))
+        h.append(sinc * window)
+    scale = gain / sum(h)
+    return [c * scale for c in h]
+
+class PolyphaseFIR(Elaboratable):
+    def __init__(self, coefficients, channels=2, factor=4, mode="interpolate", width=20, coefficient_width=18):
+        if mode not in ("interpolate", "decimate"):
+            raise ValueError("mode must be interpolate or decimate")
+        self.mode = mode
+        self.channels = channels
+        self.factor = factor
+        self.width = width
+        self.coefficient_width = coefficient_width
+
+        if mode == "interpolate":
+            # taps per phase, padded with zeros to a whole number of phases
+            self.taps = -(-len(coefficients) // factor)
+            padded = list(coefficients) + [0] * (self.taps * factor - len(coefficients))
+            ordered = [padded[k*factor + phase] for phase in range(factor) for k in range(self.taps)]
+        else:
+            self.taps = len(coefficients)
+            ordered = list(coefficients)
+        if len(ordered) > 1024:
+            raise ValueError("{} coefficients don't fit in a 32k BRAM".format(len(ordered)))
+        limit = 2**(coefficient_width - 1)
+        quantized = [max(-limit, min(limit - 1, int(round(c * limit)))) for c in ordered]
+        self.rom_size = 16 if len(quantized) <= 512 else 32
+        self.rom_data = generate_init_data(self.rom_size, quantized + [0] * (32*self.rom_size - len(quantized)))
+
+        self.tap_bits = max(1, (self.taps - 1).bit_length())
+        self.channel_bits = max(1, (channels - 1).bit_length())
+
+        self.inputs = [Signal(signed(width), name="input_{}".format(n)) for n in range(channels)]
+        self.outputs = [Signal(signed(width), name="output_{}".format(n)) for n in range(channels)]
+        # interpolate: request the next output, inputs are taken when input_ready pulses
+        self.output_request = Signal()
+        self.input_ready = Signal()
+        # decimate: inputs are taken when input_valid is pulsed
+        self.input_valid = Signal()
+        # pulsed when outputs are updated
+        self.output_valid = Signal()
+        self.busy = Signal()
+
+        # at most this many sync cycles from a request (or the factor-th input) to output_valid
+        self.compute_cycles = 1 + channels + channels * self.taps + 2 + 3 + 1
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.history = history = BRAMWrapper(width=self.width,
+            depth=2**(self.tap_bits + self.channel_bits))
+        m.submodules.coefficients = coefficients = BROMWrapper(self.rom_data, size=self.rom_size)
+
+        latched = Array(Signal(signed(self.width), name="latched_{}".format(n)) for n in range(self.channels))
+        newest = Signal(self.tap_bits)      # history index of the newest sample
+        phase = Signal(range(self.factor))
+        channel = Signal(self.channel_bits)
+        tap = Signal(self.tap_bits)
+        coefficient_base = Signal.like(coefficients.address)
+
+        # issue stage, delayed through the memories and the multiplier
+        issue = Signal()
+        issue_first = Signal()
+        issue_last = Signal()
+
+        m.d.comb += [
+            history.write_address.eq(Cat(newest, channel)),
+            history.write_data.eq(latched[channel]),
+            history.read_address.eq(Cat((newest - tap)[:self.tap_bits], channel)),
+            coefficients.address.eq(coefficient_base + tap),
+            issue_first.eq(tap == 0),
+            issue_last.eq(tap == self.taps - 1),
+        ]
+
+        with m.FSM() as fsm:
+            with m.State("IDLE"):
+                if self.mode == "interpolate":
+                    with m.If(self.output_request):
+                        m.d.sync += coefficient_base.eq(phase * self.taps)
+                        with m.If(phase == 0):
+                            m.d.comb += self.input_ready.eq(1)
+                            m.d.sync += [latched[n].eq(self.inputs[n]) for n in range(self.channels)]
+                            m.d.sync += newest.eq(newest + 1)
+                            m.next = "WRITE"
+                        with m.Else():
+                            m.next = "COMPUTE"
+                else:
+                    with m.If(self.input_valid):
+                        m.d.sync += [latched[n].eq(self.inputs[n]) for n in range(self.channels)]
+                        m.d.sync += newest.eq(newest + 1)
+                        m.next = "WRITE"
+            with m.State("WRITE"):
+                m.d.comb += history.write_en.eq(1)
+                m.d.sync += channel.eq(channel + 1)
+                with m.If(channel == self.channels - 1):
+                    m.d.sync += channel.eq(0)
+                    if self.mode == "interpolate":
+                        m.next = "COMPUTE"
+                    else:
+                        with m.If(phase == self.factor - 1):
+                            m.next = "COMPUTE"
+                        with m.Else():
+                            m.d.sync += phase.eq(phase + 1)
+                            m.next = "IDLE"
+            with m.State("COMPUTE"):
+                m.d.comb += issue.eq(1)
+                m.d.sync += tap.eq(tap + 1)
+                with m.If(tap == self.taps - 1):
+                    m.d.sync += [
+                        tap.eq(0),
+                        channel.eq(channel + 1),
+                    ]
+                    with m.If(channel == self.channels - 1):
+                        m.d.sync += channel.eq(0)
+                        m.next = "DRAIN"
+            with m.State("DRAIN"):
+                with m.If(self.output_valid):
+                    m.d.sync += phase.eq(Mux(phase == self.factor - 1, 0, phase + 1))
+                    m.next = "IDLE"
+        m.d.comb += self.busy.eq(~fsm.ongoing("IDLE"))
+
+        # control through the memory latency
+        control = Cat(issue, issue_first, issue_last, channel)
+        for stage in range(history.latency):
+            delayed = Signal(len(control), name="control_{}".format(stage))
+            m.d.sync += delayed.eq(control)
+            control = delayed
+
+        # DSP48E: registered inputs, product (M) and accumulator (P)
+        sample = Signal(signed(self.width))
+        coefficient = Signal(signed(self.coefficient_width))
+        product = Signal(signed(self.width + self.coefficient_width))
+        accumulator = Signal(signed(48))
+        control_a = Signal(len(control))
+        control_m = Signal(len(control))
+        control_p = Signal(len(control))
+        m.d.sync += [
+            sample.eq(history.read_port),
+            coefficient.eq(coefficients.read_port[0:self.coefficient_width]),
+            control_a.eq(control),
+            product.eq(sample * coefficient),
+            control_m.eq(control_a),
+            control_p.eq(control_m),
+        ]
+        with m.If(control_m[0]):
+            m.d.sync += accumulator.eq(Mux(control_m[1], product, accumulator + product))
+
+        # round, saturate and write back the result for the channel
+        shift = self.coefficient_width - 1
+        rounded = Signal(signed(48 - shift))
+        m.d.comb += rounded.eq((accumulator + (1 << (shift - 1))) >> shift)
+        result = Signal(signed(self.width))
+        limit = 2**(self.width - 1)
+        with m.If(rounded >= limit):
+            m.d.comb += result.eq(limit - 1)
+        with m.Elif(rounded < -limit):
+            m.d.comb += result.eq(-limit)
+        with m.Else():
+            m.d.comb += result.eq(rounded)
+
+        outputs = Array(self.outputs)
+        result_channel = control_p[3:]
+        last_channel = Signal()
+        with m.If(control_p[0] & control_p[2]):
+            m.d.sync += outputs[result_channel].eq(result)
+            m.d.comb += last_channel.eq(result_channel == self.channels - 1)
+        m.d.sync += self.output_valid.eq(last_channel)
+
+        return m
+
+# Fabric side sample rate is 48 kHz / factor. Connect dac_sample_written_i to the
+# controller's dac_sample_written_o, dac_channels_o to its dac_channels_i and
+# dac_sample_valid_o to its dac_sample_valid_i: each written computes the next output,
+# and dac_sample_valid_o is low until it's on dac_channels_o.
+# sample_consumed pulses when dac_channels_i has been taken, like the controller does.
+class AC97_DAC_Interpolator(Elaboratable):
+    def __init__(self, factor=4, taps=64, coefficients=None):
+        if coefficients is None:
+            coefficients = lowpass_coefficients(taps, 0.5 / factor, gain=factor)
+        self.fir = PolyphaseFIR(coefficients, channels=6, factor=factor, mode="interpolate")
+        self.dac_channels_i = AC97_DAC_Channels(name="dac_channels_i")
+        self.sample_consumed = Signal()
+        self.dac_channels_o = AC97_DAC_Channels(name="dac_channels_o")
+        self.dac_sample_valid_o = Signal(reset=1)
+        self.dac_sample_written_i = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.fir = fir = self.fir
+
+        inputs = [self.dac_channels_i.dac_left_front, self.dac_channels_i.dac_right_front,
+            self.dac_channels_i.dac_centre, self.dac_channels_i.dac_left_surround,
+            self.dac_channels_i.dac_right_surround, self.dac_channels_i.dac_lfe]
+        outputs = [self.dac_channels_o.dac_left_front, self.dac_channels_o.dac_right_front,
+            self.dac_channels_o.dac_centre, self.dac_channels_o.dac_left_surround,
+            self.dac_channels_o.dac_right_surround, self.dac_channels_o.dac_lfe]
+        m.d.comb += [fir_input.eq(sample) for (fir_input, sample) in zip(fir.inputs, inputs)]
+        m.d.comb += [output.eq(fir_output) for (output, fir_output) in zip(outputs, fir.outputs)]
+        m.d.comb += [
+            fir.output_request.eq(self.dac_sample_written_i),
+            self.sample_consumed.eq(fir.input_ready),
+        ]
+        with m.If(fir.input_ready):
+            m.d.sync += self.dac_channels_o.dac_tag.eq(self.dac_channels_i.dac_tag)
+        with m.If(self.dac_sample_written_i):
+            m.d.sync += self.dac_sample_valid_o.eq(0)
+        with m.Elif(fir.output_valid):
+            m.d.sync += self.dac_sample_valid_o.eq(1)
+
+        return m
+
+# Connect adc_channels_i and adc_sample_received_i to the controller's adc_channels_o
+# and adc_sample_received. adc_sample_valid pulses at 48 kHz / factor.
+class AC97_ADC_Decimator(Elaboratable):
+    def __init__(self, factor=4, taps=64, coefficients=None):
+        if coefficients is None:
+            coefficients = lowpass_coefficients(taps, 0.5 / factor)
+        self.fir = PolyphaseFIR(coefficients, channels=2, factor=factor, mode="decimate")
+        self.adc_channels_i = AC97_ADC_Channels(name="adc_channels_i")
+        self.adc_sample_received_i = Signal()
+        self.adc_channels_o = AC97_ADC_Channels(name="adc_channels_o")
+        self.adc_sample_valid = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.fir = fir = self.fir
+
+        m.d.comb += [
+            fir.inputs[0].eq(self.adc_channels_i.adc_left),
+            fir.inputs[1].eq(self.adc_channels_i.adc_right),
+            fir.input_valid.eq(self.adc_sample_received_i),
+            self.adc_channels_o.adc_left.eq(fir.outputs[0]),
+            self.adc_channels_o.adc_right.eq(fir.outputs[1]),
+            self.adc_sample_valid.eq(fir.output_valid),
+        ]
+        with m.If(self.adc_sample_received_i):
+            m.d.sync += self.adc_channels_o.adc_tag.eq(self.adc_channels_i.adc_tag)
+
+        return m
+
+
+if __name__=="__main__":
+    # checks both modes against a reference convolution in Python
+    factor = 3
+    h = lowpass_coefficients(24, 0.5 / factor, gain=factor)
+    limit = 2**17
+    hq = [max(-limit, min(limit - 1, int(round(c * limit)))) for c in h]
+
+    def reference(x, n, taps):
+        # sum h[k] x[n-k], rounded like the hardware
+        acc = sum(taps[k] * x[n - k] for k in range(len(taps)) if n - k >= 0)
+        return max(-2**19, min(2**19 - 1, (acc + 2**16) >> 17))
+
+    channels = 2
+    inputs = [[int(200000 * math.sin(2 * math.pi * n * (c + 1) / 17)) for n in range(12)] for c in range(channels)]
+
+    dut = PolyphaseFIR(h, channels=channels, factor=factor, mode="interpolate")
+    sim = Simulator(dut)
+    sim.add_clock(10e-9)
+
+    def interpolate():
+        for n in range(len(inputs[0]) * factor):
+            for c in range(channels):
+                yield dut.inputs[c].eq(inputs[c][n // factor])
+            yield dut.output_request.eq(1)
+            yield
+            yield dut.output_request.eq(0)
+            while not (yield dut.output_valid):
+                yield
+            yield
+            for c in range(channels):
+                upsampled = [v for x in inputs[c] for v in [x] + [0] * (factor - 1)]
+                expected = reference(upsampled, n, hq)
+                got = (yield dut.outputs[c])
+                assert got == expected, (n, c, got, expected)
+        print("interpolate: {} outputs match, {} cycles per output".format(n + 1, dut.compute_cycles))
+
+    sim.add_sync_process(interpolate)
+    with sim.write_vcd("polyphase_fir_waves.vcd"):
+        sim.run()
+
+    dut = PolyphaseFIR(h, channels=channels, factor=factor, mode="decimate")
+    sim = Simulator(dut)
+    sim.add_clock(10e-9)
+
+    def decimate():
+        outputs = 0
+        for n in range(len(inputs[0])):
+            for c in range(channels):
+                yield dut.inputs[c].eq(inputs[c][n])
+            yield dut.input_valid.eq(1)
+            yield
+            yield dut.input_valid.eq(0)
+            for _ in range(dut.compute_cycles + 2):
+                yield
+                if (yield dut.output_valid):
+                    yield
+                    for c in range(channels):
+                        expected = reference(inputs[c], n, hq)
+                        got = (yield dut.outputs[c])
+                        assert got == expected, (n, c, got, expected)
+                    outputs += 1
+        assert outputs == len(inputs[0]) // factor
+        print("decimate: {} outputs match".format(outputs))
+
+    sim.add_sync_process(decimate)
+    sim.run()
+
+    # the AC97 interpolator with the controller (its cycle accurate model): each
+    # frame carries the output computed for it, the controller waits for dac_sample_valid_o
+    from peripherals.ac97_model import AC97_CycleModel
+    interpolator = AC97_DAC_Interpolator()
+    controller = AC97_CycleModel()
+    m = Module()
+    m.submodules.interpolator = interpolator
+    m.submodules.controller = controller
+    m.d.comb += [
+        interpolator.dac_sample_written_i.eq(controller.dac_sample_written_o),
+        interpolator.dac_channels_i.dac_left_front.eq(100000),
+        controller.dac_channels_i.eq(interpolator.dac_channels_o),
+        controller.dac_sample_valid_i.eq(interpolator.dac_sample_valid_o),
+    ]
+    sim = Simulator(m)
+    sim.add_clock(10e-9)
+    sim.add_process(controller.process)
+    outputs = []
+
+    def ac97_interpolate():
+        while len(outputs) < 6:
+            yield
+            if (yield controller.dac_sample_written_o):
+                yield
+                while not (yield interpolator.dac_sample_valid_o):
+                    yield
+                outputs.append((yield interpolator.dac_channels_o.dac_left_front))
+
+    sim.add_sync_process(ac97_interpolate)
+    sim.run()
+    sent = [frame.dac_channels["dac_left_front"] for frame in controller.frames[1:]]
+    assert sent[:5] == outputs[:5], (sent, outputs)
+    print("ac97 interpolator with controller: ok")
+
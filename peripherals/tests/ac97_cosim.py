@@ -0,0 +1,151 @@
+import random
+import sys
+from nmigen import *
+from nmigen.sim import *
+
+from peripherals.ac97 import AC97_Controller, AC97_DAC_Channels
+from peripherals.ac97_model import AC97_CycleModel, FRAME_BITS, TAG, bits_to_frame, frame_to_bits
+
+# Co-simulation of AC97_Controller against AC97_CycleModel over a few frames. The same
+# sync side testbench runs on both: a source hands over a random sample after every
+# dac_sample_written_o, sometimes holding dac_sample_valid_i low for two frames, and
+# a reader takes the adc samples, sometimes holding adc_sample_ready_i low for two
+# frames. On the controller a codec process deserialises sdata_out and drives sdata_in
+# from random slots, the model gets the same slots. The cycles of every
+# dac_sample_written_o and adc_sample_received pulse, the adc samples and the frames
+# sent have to match.
+
+BIT_CLK_PERIOD = 81e-9
+SYNC_PERIOD = 10e-9
+LATE = 4500     # sync cycles, over two frames
+
+def random_dac_sample(rng):
+    return {name: rng.getrandbits(len(field)) for (name, field) in AC97_DAC_Channels().fields.items()}
+
+def random_input_slots(rng):
+    return [rng.getrandbits(16)] + [rng.getrandbits(20) for _ in range(12)]
+
+def testbench(sim, dut, frames, seed, reg_read):
+    # separate generators and lists, the two processes run in either order in a cycle
+    dac_rng = random.Random(seed)
+    adc_rng = random.Random(seed + 1)
+    written = []
+    received = []
+
+    def dac_source():
+        yield dut.reg_read.eq(reg_read)
+        cycle = 0
+        while len(received) < frames:
+            yield
+            cycle += 1
+            if (yield dut.dac_sample_written_o):
+                written.append(cycle)
+                if dac_rng.random() < 0.25:
+                    yield dut.dac_sample_valid_i.eq(0)
+                    for _ in range(LATE):
+                        yield
+                    cycle += LATE
+                for (name, value) in random_dac_sample(dac_rng).items():
+                    yield dut.dac_channels_i[name].eq(value)
+                yield dut.dac_sample_valid_i.eq(1)
+
+    def adc_reader():
+        cycle = 0
+        while len(received) < frames:
+            yield
+            cycle += 1
+            if (yield dut.adc_sample_received):
+                # adc_channels_o is updated on the edge ending the pulse
+                yield
+                cycle += 1
+                sample = {}
+                for name in ("adc_tag", "adc_left", "adc_right"):
+                    sample[name] = (yield dut.adc_channels_o[name])
+                received.append((cycle - 1, sample))
+                if adc_rng.random() < 0.25:
+                    yield dut.adc_sample_ready_i.eq(0)
+                    for _ in range(LATE):
+                        yield
+                    cycle += LATE
+                    yield dut.adc_sample_ready_i.eq(1)
+
+    sim.add_sync_process(dac_source)
+    sim.add_sync_process(adc_reader)
+    return (written, received)
+
+def run_controller(frames, seed, reg_read, input_slots):
+    dut = AC97_Controller()
+    sim = Simulator(dut)
+    sim.add_clock(SYNC_PERIOD)
+    sim.add_clock(BIT_CLK_PERIOD, domain="audio_bit_clk")
+    events = testbench(sim, dut, frames, seed, reg_read)
+    sent = []
+
+    def codec():
+        # a frame starts on the rising edge of sync, sdata_out follows a cycle later.
+        # sdata_in is sampled on the same edge it's driven for, so it leads by a bit
+        bits = [bit for slots in input_slots for bit in frame_to_bits(slots)] + [0]
+        position = None
+        output = []
+        previous_sync = 0
+        yield Passive()
+        yield dut.sdata_in.i1.eq(bits[0])
+        while True:
+            sync = (yield dut.sync_o.o)
+            if sync and not previous_sync and position is None:
+                position = 0
+            previous_sync = sync
+            if position is not None:
+                yield dut.sdata_in.i1.eq(bits[min(position + 1, len(bits) - 1)])
+                output.append((yield dut.sdata_out.o))
+                position += 1
+                if position % FRAME_BITS == 1 and position > 1:
+                    sent.append(bits_to_frame(output[position - FRAME_BITS:position]))
+            yield
+
+    sim.add_sync_process(codec, domain="audio_bit_clk")
+    sim.run()
+    return events, sent
+
+def run_model(frames, seed, reg_read, input_slots):
+    dut = AC97_CycleModel(lambda frame: input_slots[frame] if frame < len(input_slots) else None,
+        sync_period=SYNC_PERIOD, bit_clk_period=BIT_CLK_PERIOD)
+    sim = Simulator(dut)
+    sim.add_clock(SYNC_PERIOD)
+    events = testbench(sim, dut, frames, seed, reg_read)
+    sim.add_process(dut.process)
+    sim.run()
+    return events, [frame.slots for frame in dut.frames], dut
+
+def cosim(frames=6, seed=1, reg_read=0):
+    rng = random.Random(seed)
+    input_slots = [random_input_slots(rng) for _ in range(3 * frames)]
+
+    rtl_events, rtl_sent = run_controller(frames, seed, reg_read, input_slots)
+    model_events, model_sent, model = run_model(frames, seed, reg_read, input_slots)
+
+    for (name, rtl, expected) in zip(("dac_sample_written_o", "adc_sample_received"), rtl_events, model_events):
+        for (n, (rtl_event, model_event)) in enumerate(zip(rtl, expected)):
+            assert rtl_event == model_event, "{} {}:\n rtl   {}\n model {}".format(name, n, rtl_event, model_event)
+        assert len(rtl) == len(expected), "{}: {} pulses, model {}".format(name, len(rtl), len(expected))
+
+    # frames the controller finished sending before the testbench stopped, the first
+    # adc sample is the reset one and the last frame is cut short
+    assert len(rtl_sent) >= frames - 2, "{} frames sent".format(len(rtl_sent))
+    for n in range(len(rtl_sent)):
+        assert rtl_sent[n][0] == TAG, "frame {} tag {:x}".format(n, rtl_sent[n][0])
+        assert rtl_sent[n] == model_sent[n], "frame {}:\n rtl   {}\n model {}".format(
+            n, [hex(s) for s in rtl_sent[n]], [hex(s) for s in model_sent[n]])
+    return model.dac_underruns, model.adc_overruns
+
+
+if __name__ == "__main__":
+    frames = int(sys.argv[2]) if len(sys.argv) > 2 and sys.argv[1] == "sim" else 6
+    underruns = overruns = 0
+    for seed in (0, 1, 2):
+        (dac_underruns, adc_overruns) = cosim(frames, seed=seed, reg_read=seed & 1)
+        underruns += dac_underruns
+        overruns += adc_overruns
+    assert underruns and overruns
+    print("rtl and model agree over {} frames, {} dac underruns, {} adc overruns".format(
+        3 * frames, underruns, overruns))
@@ -9,6 +9,7 @@ from nmigen.lib.io import Pin
 from nmigen_boards.ml505 import ML505Platform
 
 from peripherals.ac97 import AC97_Controller
+from utility.build_cache import cached_build
 
 class AC97_loopback(Elaboratable):
     def __init__(self):
@@ -46,6 +47,6 @@ if __name__ == "__main__":
   
     tone = AC97_loopback()
  
-    if sys.argv[1] == "build":
-        ML505Platform().build(tone, do_build=False, do_program=False).execute_local(run_script=False)
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        cached_build(ML505Platform(), tone, run_script=False)
     
\ No newline at end of file
@@ -6,4 +6,13 @@ setup(
     python_requires="~=3.6",
     setup_requires=["wheel", "setuptools", "setuptools_scm"],
     packages=find_packages(exclude=["tests*"]),
+    extras_require={
+        # reading StreamingILA captures from a serial port (utility/ila_frontend.py)
+        "ila": ["numpy", "pyserial"],
+    },
+    entry_points={
+        "console_scripts": [
+            "useful-nmigen=utility.cli:main",
+        ],
+    },
 )
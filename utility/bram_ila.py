@@ -0,0 +1,316 @@
+from nmigen import *
+from nmigen.sim import *
+from nmigen.lib.fifo import AsyncFIFOBuffered, SyncFIFOBuffered
+
+from utility.bram_inst import BRAMWrapper
+from utility.stream import ByteStream
+from utility.ila_frontend import ILA_MAGIC, ILA_HEADER_BYTES
+
+import sys
+
+# Deep ILA storing run-length compressed samples in BRAM.
+# Each entry is Cat(run, sample): a sample and the number of cycles (1 to 2**run_bits-1)
+# it was held for, so a new entry is only written when the sample changes.
+# Samples are recorded into a ring until the trigger, and the capture stops once
+# sample_depth-samples_pretrigger entries have been recorded after it. Depth and
+# pretrigger are counted in entries, not cycles.
+#
+# The capture is then streamed out as bytes, in stream_domain, for USBSerialDevice.tx:
+#   header: b"RLE1", sample width (u16), run bits (u8), entry count (u32), trigger entry (u32)
+#   entries: oldest first, bytes_per_entry bytes each, little endian
+# The ILA re-arms once the capture has been sent.
+
+class StreamingILA(Elaboratable):
+    def __init__(self, signals, sample_depth=4096, domain="sync", stream_domain="usb",
+            samples_pretrigger=1, run_bits=16):
+        self.signals = signals
+        self.sample_width = len(Cat(*signals))
+        self.sample_depth = sample_depth
+        self.domain = domain
+        self.stream_domain = stream_domain
+        self.samples_pretrigger = samples_pretrigger
+        self.run_bits = run_bits
+        self.entry_width = self.sample_width + run_bits
+        self.bytes_per_entry = -(-self.entry_width // 8)
+
+        if not (0 <= samples_pretrigger < sample_depth):
+            raise ValueError("samples_pretrigger must be less than sample_depth")
+
+        self.trigger = Signal()
+        self.capturing = Signal()   # armed or triggered, not sending
+        self.stream = ByteStream()
+
+    def elaborate(self, platform):
+        m = Module()
+        cd = m.d[self.domain]
+
+        m.submodules.ram = ram = BRAMWrapper(width=self.entry_width, depth=self.sample_depth,
+            write_domain=self.domain, read_domain=self.domain)
+        if self.stream_domain == self.domain:
+            fifo = SyncFIFOBuffered(width=10, depth=64)
+            fifo = DomainRenamer(self.domain)(fifo)
+        else:
+            fifo = AsyncFIFOBuffered(width=10, depth=64, w_domain=self.domain, r_domain=self.stream_domain)
+        m.submodules.fifo = fifo
+
+        # bytes out, with first/last carried through the FIFO
+        fifo_byte = Signal(8)
+        fifo_first = Signal()
+        fifo_last = Signal()
+        m.d.comb += [
+            fifo.w_data.eq(Cat(fifo_byte, fifo_first, fifo_last)),
+            self.stream.payload.eq(fifo.r_data[0:8]),
+            self.stream.first.eq(fifo.r_data[8]),
+            self.stream.last.eq(fifo.r_data[9]),
+            self.stream.valid.eq(fifo.r_rdy),
+            fifo.r_en.eq(self.stream.ready),
+        ]
+
+        # Run length compression
+        sample = Cat(*self.signals)
+        prev_sample = Signal(self.sample_width)
+        run = Signal(self.run_bits, reset=1)
+        write_ptr = Signal(range(self.sample_depth))
+        wrapped = Signal()
+        flush = Signal()
+        record = Signal()
+        write = Signal()
+        m.d.comb += [
+            write.eq(record & ((sample != prev_sample) | (run == 2**self.run_bits - 1) | flush)),
+            ram.write_address.eq(write_ptr),
+            ram.write_data.eq(Cat(run, prev_sample)),
+            ram.write_en.eq(write),
+        ]
+        with m.If(record):
+            with m.If(write):
+                cd += [
+                    prev_sample.eq(sample),
+                    run.eq(1),
+                    write_ptr.eq(write_ptr + 1),
+                ]
+                with m.If(write_ptr == self.sample_depth - 1):
+                    cd += [
+                        write_ptr.eq(0),
+                        wrapped.eq(1),
+                    ]
+            with m.Else():
+                cd += run.eq(run + 1)
+
+        post_trigger = self.sample_depth - self.samples_pretrigger
+        post_count = Signal(range(post_trigger + 1))
+        trigger_ptr = Signal(range(self.sample_depth))
+
+        # Readout
+        read_ptr = Signal(range(self.sample_depth))
+        entry_count = Signal(32)
+        trigger_entry = Signal(32)
+        remaining = Signal(range(self.sample_depth + 1))
+        header = Signal(8*ILA_HEADER_BYTES)
+        m.d.comb += header.eq(Cat(
+            Const(int.from_bytes(ILA_MAGIC, "little"), 32),
+            Const(self.sample_width, 16),
+            Const(self.run_bits, 8),
+            entry_count,
+            trigger_entry,
+        ))
+        header_index = Signal(range(ILA_HEADER_BYTES))
+        byte_index = Signal(range(self.bytes_per_entry))
+        entry_shift = Signal(8*self.bytes_per_entry)
+        wait = Signal(range(ram.latency + 1))
+        m.d.comb += ram.read_address.eq(read_ptr)
+
+        with m.FSM(domain=self.domain):
+            with m.State("START"):
+                cd += [
+                    prev_sample.eq(sample),
+                    run.eq(1),
+                    write_ptr.eq(0),
+                    wrapped.eq(0),
+                    post_count.eq(0),
+                ]
+                m.next = "ARMED"
+            with m.State("ARMED"):
+                m.d.comb += [
+                    record.eq(1),
+                    self.capturing.eq(1),
+                ]
+                # close the current run so the trigger sample starts an entry
+                with m.If(self.trigger):
+                    m.d.comb += flush.eq(1)
+                    cd += trigger_ptr.eq(Mux(write_ptr == self.sample_depth - 1, 0, write_ptr + 1))
+                    m.next = "TRIGGERED"
+            with m.State("TRIGGERED"):
+                m.d.comb += [
+                    record.eq(1),
+                    self.capturing.eq(1),
+                ]
+                with m.If(write):
+                    cd += post_count.eq(post_count + 1)
+                    with m.If(post_count == post_trigger - 1):
+                        m.next = "HEADER"
+                        # oldest entry is at the write pointer once the ring has wrapped
+                        last_ptr = Mux(write_ptr == self.sample_depth - 1, 0, write_ptr + 1)
+                        with m.If(wrapped | (write_ptr == self.sample_depth - 1)):
+                            cd += [
+                                read_ptr.eq(last_ptr),
+                                entry_count.eq(self.sample_depth),
+                                remaining.eq(self.sample_depth),
+                                trigger_entry.eq(Mux(trigger_ptr >= last_ptr, trigger_ptr - last_ptr,
+                                    trigger_ptr + self.sample_depth - last_ptr)),
+                            ]
+                        with m.Else():
+                            cd += [
+                                read_ptr.eq(0),
+                                entry_count.eq(last_ptr),
+                                remaining.eq(last_ptr),
+                                trigger_entry.eq(trigger_ptr),
+                            ]
+                        cd += header_index.eq(0)
+            with m.State("HEADER"):
+                m.d.comb += [
+                    fifo_byte.eq(header.word_select(header_index, 8)),
+                    fifo_first.eq(header_index == 0),
+                    fifo.w_en.eq(1),
+                ]
+                with m.If(fifo.w_rdy):
+                    cd += header_index.eq(header_index + 1)
+                    with m.If(header_index == ILA_HEADER_BYTES - 1):
+                        cd += wait.eq(0)
+                        m.next = "READ"
+            with m.State("READ"):
+                cd += wait.eq(wait + 1)
+                with m.If(wait == ram.latency):
+                    cd += [
+                        entry_shift.eq(ram.read_port),
+                        byte_index.eq(0),
+                    ]
+                    m.next = "SEND"
+            with m.State("SEND"):
+                m.d.comb += [
+                    fifo_byte.eq(entry_shift[0:8]),
+                    fifo_last.eq((remaining == 1) & (byte_index == self.bytes_per_entry - 1)),
+                    fifo.w_en.eq(1),
+                ]
+                with m.If(fifo.w_rdy):
+                    cd += [
+                        entry_shift.eq(entry_shift >> 8),
+                        byte_index.eq(byte_index + 1),
+                    ]
+                    with m.If(byte_index == self.bytes_per_entry - 1):
+                        cd += [
+                            remaining.eq(remaining - 1),
+                            read_ptr.eq(Mux(read_ptr == self.sample_depth - 1, 0, read_ptr + 1)),
+                            wait.eq(0),
+                        ]
+                        m.next = "NEXT"
+            with m.State("NEXT"):
+                with m.If(remaining == 0):
+                    m.next = "START"
+                with m.Else():
+                    m.next = "READ"
+
+        return m
+
+
+class USBStreamingILATest(Elaboratable):
+    def __init__(self):
+        pass
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if (platform != None):
+            from utility.ml505_luna_clocking import ML505LunaClockDomains
+            m.submodules.clocks = ML505LunaClockDomains()
+
+        # Slow counter so runs compress well, with a faster one to trigger on
+        counter = Signal(32)
+        m.d.sync += counter.eq(counter + 1)
+        trigger = Signal()
+        m.d.comb += trigger.eq(counter[0:20] == 0)
+
+        m.submodules.ila = self.ila = ila = StreamingILA(signals=[counter[4:12]],
+            sample_depth=8192, domain="sync", stream_domain="usb", samples_pretrigger=1024)
+        m.d.comb += ila.trigger.eq(trigger)
+
+        if (platform != None):
+            from luna.full_devices import USBSerialDevice
+            from utility.usb_serial_bridge import add_usb_gpio
+            add_usb_gpio(platform)
+            m.submodules.usb_serial = usb_serial = \
+                USBSerialDevice(bus=platform.request("usb_gpio"), idVendor=0x16d0, idProduct=0x0f3b)
+            m.d.comb += [
+                usb_serial.tx.payload   .eq(ila.stream.payload),
+                usb_serial.tx.valid     .eq(ila.stream.valid),
+                usb_serial.tx.first     .eq(ila.stream.first),
+                usb_serial.tx.last      .eq(ila.stream.last),
+                ila.stream.ready        .eq(usb_serial.tx.ready),
+                usb_serial.rx.ready     .eq(1),
+                usb_serial.connect      .eq(1),
+            ]
+
+        return m
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        from nmigen_boards.ml505 import ML505Platform
+        from utility.build_cache import cached_build
+        cached_build(ML505Platform(), USBStreamingILATest())
+
+    else:
+        # Record a slow counter (each value held 8 cycles) and decode the capture
+        def capture(trigger_at):
+            m = Module()
+            counter = Signal(16)
+            trigger = Signal()
+            m.d.sync += counter.eq(counter + 1)
+            m.d.comb += trigger.eq(counter == trigger_at)
+            m.submodules.ila = ila = StreamingILA(signals=[counter[3:11]], sample_depth=64,
+                domain="sync", stream_domain="sync", samples_pretrigger=16)
+            m.d.comb += ila.trigger.eq(trigger)
+
+            sim = Simulator(m)
+            sim.add_clock(10e-9)
+            result = []
+
+            def receive():
+                data = bytearray()
+                yield ila.stream.ready.eq(1)
+                while True:
+                    yield
+                    if (yield ila.stream.valid):
+                        data.append((yield ila.stream.payload))
+                        if (yield ila.stream.last):
+                            break
+                assert data[0:4] == ILA_MAGIC
+                width = int.from_bytes(data[4:6], "little")
+                run_bits = data[6]
+                count = int.from_bytes(data[7:11], "little")
+                trigger_entry = int.from_bytes(data[11:15], "little")
+                entries = data[ILA_HEADER_BYTES:]
+                assert len(entries) == count * ila.bytes_per_entry
+                runs = []
+                for n in range(count):
+                    entry = int.from_bytes(entries[n*ila.bytes_per_entry:(n+1)*ila.bytes_per_entry], "little")
+                    runs.append((entry >> run_bits, entry & (2**run_bits - 1)))
+                result.extend([runs, trigger_entry])
+
+            sim.add_sync_process(receive)
+            with sim.write_vcd("bram_ila_waves.vcd"):
+                sim.run_until(3e-5)
+            return result
+
+        # the trigger sample (counter=1000) is on a change, so it starts its own entry
+        (runs, trigger_entry) = capture(1000)
+        for (n, (value, length)) in enumerate(runs[trigger_entry:]):
+            assert value == ((1000 >> 3) + n) & 0xff and length == 8, (n, value, length)
+        print("{} entries, trigger at {}".format(len(runs), trigger_entry))
+
+        # between changes (counter=1003) the pending run of 1000-1002 is flushed first,
+        # and the trigger entry holds the rest of that value
+        (runs, trigger_entry) = capture(1003)
+        assert runs[trigger_entry - 1] == (1000 >> 3, 3), runs[trigger_entry - 1]
+        assert runs[trigger_entry] == (1000 >> 3, 5), runs[trigger_entry]
+        for (n, (value, length)) in enumerate(runs[trigger_entry + 1:]):
+            assert value == ((1000 >> 3) + n + 1) & 0xff and length == 8, (n, value, length)
+        print("{} entries, trigger at {}, flushed run {}".format(len(runs), trigger_entry, runs[trigger_entry - 1]))
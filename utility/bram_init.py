@@ -0,0 +1,26 @@
+# INIT_xx parameter packing for the BRAM primitives. No nmigen imports here,
+# so ROM contents can be packed quickly from the command line.
+
+#copied direct from nco lut
+def twos_complement(decimal, bits=32):
+    if(decimal >= 0):
+        return decimal
+    else:
+        inverted = 2**bits + decimal
+        return twos_complement(inverted, bits)
+
+def generate_init_data(size, input_list, signed_output = True):
+    assert ~(size==16 | size==32)
+    init_data = {}
+    for line in range(0, 4*size):  # 64 for 18k BRAM
+        init_line = 0
+        for word in range(0, 8):    # each verilog parameter contains 8 32 bit words
+            decimal = input_list[(line*8 + word)]
+            if signed_output:
+                decimal = twos_complement(decimal, 32)  # BRAM has a native width of 32
+            init_line += (decimal << word*32)
+        line_string = str(hex(line)).upper()[2:]
+        while len(line_string) < 2:
+            line_string = '0' + line_string
+        init_data['p_INIT_'+ line_string] = init_line
+    return init_data
@@ -4,6 +4,8 @@ from nmigen.build.res import *
 
 import itertools
 
+from utility.bram_init import twos_complement, generate_init_data
+
 def get_xilinx_BRAM_SDP(address, data_in, data_out, write_en, clk, rst, size=16, init_data=None, pipeline_reg=True):
     # Signals:
     # address: 9/10 bit wide address bus, for 16 or 32k block respectively
@@ -36,30 +38,6 @@ def get_xilinx_BRAM_SDP(address, data_in, data_out, write_en, clk, rst, size=16,
         )
     return bram
 
-#copied direct from nco lut
-def twos_complement(decimal, bits=32):
-    if(decimal >= 0):
-        return decimal
-    else:
-        inverted = 2**bits + decimal
-        return twos_complement(inverted, bits)
-
-def generate_init_data(size, input_list, signed_output = True):
-    assert ~(size==16 | size==32)
-    init_data = {}
-    for line in range(0, 4*size):  # 64 for 18k BRAM
-        init_line = 0
-        for word in range(0, 8):    # each verilog parameter contains 8 32 bit words
-            decimal = input_list[(line*8 + word)]
-            if signed_output:
-                decimal = twos_complement(decimal, 32)  # BRAM has a native width of 32
-            init_line += (decimal << word*32)
-        line_string = str(hex(line)).upper()[2:]
-        while len(line_string) < 2:
-            line_string = '0' + line_string
-        init_data['p_INIT_'+ line_string] = init_line
-    return init_data
-
 # useful for making sure names don't clash and possibly confuse tool
 class BROMWrapper(Elaboratable):
     def __init__(self, ROM_data, size=16, pipeline_reg = True):
@@ -68,14 +46,17 @@ class BROMWrapper(Elaboratable):
         self.ROM_data = ROM_data
         self.pipeline_reg = pipeline_reg
         self.size = size
+        # cycles from address to read_port, 2 with the BRAM output register enabled
+        self.latency = 1 + int(pipeline_reg)
     def elaborate(self, platform):
         m = Module()
         if (platform != None):
             bram_prim = get_xilinx_BRAM_SDP(self.address, Const(0, unsigned(32)), self.read_port, 
                 Const(0, unsigned(4)), ClockSignal(), ResetSignal(), size=self.size, init_data=self.ROM_data, pipeline_reg=self.pipeline_reg)
             m.submodules.__brom_0 = bram_prim
-        else:   #  Probably actually needs an extra clock cycle delay to be accurate, be careful
+        else:   # Behavioural model, delayed to match the latency of the primitive
             full_line = Signal(256)       
+            read_data = Signal(32)
             with m.Switch(self.address):
                 for entry in range(0, len(self.ROM_data)):
                     line_string = str(hex(entry)).upper()[2:]
@@ -86,14 +67,87 @@ class BROMWrapper(Elaboratable):
                     for n in range(0, 8):
                         with m.Case(entry*8+n):
                             m.d.sync += [
-                                self.read_port.eq((line >> 32*n) % 2**32),
+                                read_data.eq((line >> 32*n) % 2**32),
                                 full_line.eq(line),
                             ]
+            if self.pipeline_reg:
+                m.d.sync += self.read_port.eq(read_data)
+            else:
+                m.d.comb += self.read_port.eq(read_data)
                             
                             
         
         return m
 
+# Simple dual port RAM with the write and read ports in (possibly) different clock domains.
+# Built from as many 512x32 RAMB18SDP blocks as needed for width and depth.
+class BRAMWrapper(Elaboratable):
+    def __init__(self, width=32, depth=512, write_domain="sync", read_domain="sync", pipeline_reg=True):
+        self.write_address = Signal(range(depth))
+        self.write_data = Signal(width)
+        self.write_en = Signal()
+
+        self.read_address = Signal(range(depth))
+        self.read_port = Signal(width)
+
+        self.width = width
+        self.depth = depth
+        self.write_domain = write_domain
+        self.read_domain = read_domain
+        self.pipeline_reg = pipeline_reg
+        # cycles of read_domain from read_address to read_port
+        self.latency = 1 + int(pipeline_reg)
+
+    def elaborate(self, platform):
+        m = Module()
+        if (platform != None):
+            rows = -(-self.depth // 512)
+            columns = -(-self.width // 32)
+            row_data = [Signal(32*columns, name="row_data_{}".format(row)) for row in range(rows)]
+
+            # which row is on the outputs, delayed to line up with the data
+            read_row = self.read_address[9:]
+            for stage in range(self.latency):
+                read_row_delayed = Signal.like(read_row, name="read_row_{}".format(stage))
+                m.d[self.read_domain] += read_row_delayed.eq(read_row)
+                read_row = read_row_delayed
+
+            for row in range(rows):
+                row_write_en = Signal(name="write_en_{}".format(row))
+                m.d.comb += row_write_en.eq(self.write_en & (self.write_address[9:] == row))
+                for column in range(columns):
+                    m.submodules["bram_{}_{}".format(row, column)] = Instance("RAMB18SDP",
+                        p_DO_REG = int(self.pipeline_reg),
+                        o_DO = row_data[row][32*column:32*(column+1)],
+                        i_WRADDR = self.write_address[0:9],
+                        i_RDADDR = self.read_address[0:9],
+                        i_WRCLK = ClockSignal(self.write_domain),
+                        i_RDCLK = ClockSignal(self.read_domain),
+                        i_DI = self.write_data[32*column:32*(column+1)],
+                        i_RDEN = Const(1, unsigned(1)),
+                        i_WREN = row_write_en,
+                        i_REGCE = Const(1, unsigned(1)),
+                        i_SSR = Const(0, unsigned(1)),
+                        i_WE = Const(0xf, unsigned(4)),
+                    )
+            m.d.comb += self.read_port.eq(Array(row_data)[read_row])
+        else:   # Behavioural model with the same latency
+            mem = Memory(width=self.width, depth=self.depth)
+            m.submodules.write_port = write_port = mem.write_port(domain=self.write_domain)
+            m.submodules.read_port = read_port = mem.read_port(domain=self.read_domain, transparent=False)
+            m.d.comb += [
+                write_port.addr.eq(self.write_address),
+                write_port.data.eq(self.write_data),
+                write_port.en.eq(self.write_en),
+                read_port.addr.eq(self.read_address),
+            ]
+            if self.pipeline_reg:
+                m.d[self.read_domain] += self.read_port.eq(read_port.data)
+            else:
+                m.d.comb += self.read_port.eq(read_port.data)
+
+        return m
+
 class BRAMTest(Elaboratable):
     def __init__(self):
         pass
@@ -130,4 +184,5 @@ if __name__=="__main__":
     bram_test = BRAMTest()
     from nmigen_boards.ml505 import ML505Platform
     from nmigen_boards.test.blinky import *
-    ML505Platform().build(bram_test, do_build=False, do_program=False).execute_local(run_script=False)
\ No newline at end of file
+    from utility.build_cache import cached_build
+    cached_build(ML505Platform(), bram_test, run_script=False)
\ No newline at end of file
@@ -0,0 +1,124 @@
+import hashlib
+import inspect
+import os
+import shutil
+
+# Build wrapper that skips elaboration, Verilog generation and the toolchain run
+# when an identical design has already been built.
+#
+# The key hashes the toolchain-independent inputs of a build: the installed versions
+# of nmigen and the other packages designs import, the platform class, the build
+# options, the parameters of the elaboratable (walked recursively through its
+# attributes and submodules) and the contents of every source file in this project
+# and the board definition. All project files are hashed, not just the loaded
+# modules, since elaborate() often imports what it needs only when it runs. A hit
+# reuses the products in cache_dir/<key>; otherwise the design is built there. Only
+# the max_builds most recently used builds are kept.
+
+_BUILD_DONE = "build.done"
+_PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+_SOURCE_EXTENSIONS = (".py", ".v", ".ucf")
+_DEPENDENCIES = ("nmigen", "amaranth", "nmigen-boards", "amaranth-boards", "nmigen-soc",
+    "amaranth-soc", "luna", "usb-protocol")
+
+def _dependency_versions():
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return "unknown"
+    versions = []
+    for package in _DEPENDENCIES:
+        try:
+            versions.append(package + " " + version(package))
+        except PackageNotFoundError:
+            pass
+    return ", ".join(versions)
+
+def _describe(obj, seen):
+    # a stable description of obj's parameters. Signals are described by shape,
+    # not identity, so a fresh instance of the same design hashes the same
+    from nmigen import Value, Signal, Const
+    if isinstance(obj, (bool, int, float, str, bytes, type(None))):
+        return repr(obj)
+    if isinstance(obj, Const):
+        return "Const({}, {})".format(obj.value, obj.shape())
+    if isinstance(obj, Signal):
+        return "Signal({}, reset={})".format(obj.shape(), obj.reset)
+    if isinstance(obj, Value):
+        return "{}({})".format(type(obj).__name__, obj.shape())
+    if isinstance(obj, (list, tuple)):
+        return "[" + ", ".join(_describe(item, seen) for item in obj) + "]"
+    if isinstance(obj, dict):
+        return "{" + ", ".join("{}: {}".format(_describe(key, seen), _describe(obj[key], seen))
+            for key in sorted(obj, key=repr)) + "}"
+    if id(obj) in seen:
+        return "<{}>".format(type(obj).__qualname__)
+    seen.add(id(obj))
+    name = type(obj).__module__ + "." + type(obj).__qualname__
+    if hasattr(obj, "__dict__"):
+        return name + _describe({key: value for (key, value) in vars(obj).items()
+            if not key.startswith("__")}, seen)
+    return name
+
+def _source_files(platform):
+    files = set()
+    for (directory, subdirectories, names) in os.walk(_PROJECT_ROOT):
+        # skip .git, caches and build products
+        subdirectories[:] = [d for d in subdirectories
+            if not d.startswith((".", "__pycache__", "build")) and not d.endswith(".egg-info")]
+        files.update(os.path.join(directory, name) for name in names if name.endswith(_SOURCE_EXTENSIONS))
+    try:
+        files.add(os.path.abspath(inspect.getsourcefile(type(platform))))
+    except TypeError:
+        pass
+    return sorted(path for path in files if os.path.isfile(path))
+
+def build_key(platform, elaboratable, name="top", **options):
+    key = hashlib.sha256()
+    key.update(_dependency_versions().encode())
+    key.update(name.encode())
+    key.update((type(platform).__module__ + "." + type(platform).__qualname__).encode())
+    key.update(_describe(options, set()).encode())
+    key.update(_describe(elaboratable, set()).encode())
+    for path in _source_files(platform):
+        key.update(os.path.relpath(path, _PROJECT_ROOT).encode())
+        with open(path, "rb") as f:
+            key.update(f.read())
+    return key.hexdigest()[:20]
+
+def _evict(cache_dir, max_builds):
+    builds = []
+    for entry in os.listdir(cache_dir):
+        marker = os.path.join(cache_dir, entry, _BUILD_DONE)
+        if os.path.exists(marker):
+            builds.append((os.path.getmtime(marker), entry))
+    for (_, entry) in sorted(builds)[:max(0, len(builds) - max_builds)]:
+        shutil.rmtree(os.path.join(cache_dir, entry), ignore_errors=True)
+
+def cached_build(platform, elaboratable, name="top", cache_dir="build_cache", max_builds=8,
+        run_script=True, do_program=False, program_opts=None, **kwargs):
+    # Same as platform.build(...) with build_dir=cache_dir/<key>.
+    # With run_script=False only the build files are generated (the toolchain isn't run).
+    from nmigen.build.run import LocalBuildProducts
+
+    key = build_key(platform, elaboratable, name, run_script=run_script, **kwargs)
+    build_dir = os.path.join(cache_dir, key)
+    marker = os.path.join(build_dir, _BUILD_DONE)
+
+    if os.path.exists(marker):
+        print("build cache hit:", build_dir)
+        os.utime(marker)
+        products = LocalBuildProducts(build_dir)
+    else:
+        print("build cache miss:", build_dir)
+        if os.path.exists(build_dir):
+            shutil.rmtree(build_dir)    # left over from an interrupted build
+        plan = platform.prepare(elaboratable, name, **kwargs)
+        products = plan.execute_local(build_dir, run_script=run_script)
+        with open(marker, "w") as f:
+            f.write(key + "\n")
+        _evict(cache_dir, max_builds)
+
+    if do_program:
+        platform.toolchain_program(products, name, **(program_opts or {}))
+    return products
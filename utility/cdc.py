@@ -0,0 +1,189 @@
+from nmigen import *
+from nmigen.sim import *
+from nmigen.lib.cdc import FFSynchronizer
+
+# Clock domain crossing helpers built on 2-phase (toggle) handshakes.
+# Only a single toggle bit is synchronized in each direction. Multi-bit data is
+# held in a register in the sending domain and is stable for `stages` cycles
+# before the receiving side can see the toggle, so it can be sampled directly.
+# On hardware the data path needs a max delay constraint shorter than that.
+#
+# latency is in cycles of the receiving domain, from the write (or input pulse)
+# to the data (or output pulse) being available there, not counting the phase
+# difference between the clocks.
+
+class TogglePulseSynchronizer(Elaboratable):
+    # a pulse on i becomes a one cycle pulse on o. Pulses closer together
+    # than 2 o_domain cycles can be merged
+    def __init__(self, i_domain="sync", o_domain="sync", stages=2):
+        self.i = Signal()
+        self.o = Signal()
+        self.i_domain = i_domain
+        self.o_domain = o_domain
+        self.stages = stages
+        self.latency = stages + 1
+
+    def elaborate(self, platform):
+        m = Module()
+
+        toggle = Signal()
+        toggle_sync = Signal()
+        toggle_prev = Signal()
+        with m.If(self.i):
+            m.d[self.i_domain] += toggle.eq(~toggle)
+        m.submodules.toggle_ff = FFSynchronizer(toggle, toggle_sync, o_domain=self.o_domain,
+            stages=self.stages)
+        m.d[self.o_domain] += toggle_prev.eq(toggle_sync)
+        m.d.comb += self.o.eq(toggle_sync ^ toggle_prev)
+
+        return m
+
+class Mailbox(Elaboratable):
+    # Single word mailbox from w_domain to r_domain.
+    # Writer: when w_rdy, w_stb writes w_data. w_done pulses when the reader has taken it,
+    #   and w_rdy is high again from the same cycle.
+    # Reader: r_rdy when a word is waiting in r_data, r_stb takes it.
+    # A new word can be sent every handshake round trip, about 2*(stages+1) cycles.
+    def __init__(self, width, w_domain="sync", r_domain="sync", stages=2):
+        self.w_data = Signal(width)
+        self.w_stb = Signal()
+        self.w_rdy = Signal()
+        self.w_done = Signal()
+
+        self.r_data = Signal(width)
+        self.r_stb = Signal()
+        self.r_rdy = Signal()
+
+        self.width = width
+        self.w_domain = w_domain
+        self.r_domain = r_domain
+        self.stages = stages
+        # r_domain cycles from w_stb to r_rdy
+        self.latency = stages + 1
+
+    def elaborate(self, platform):
+        m = Module()
+
+        data = Signal(self.width)
+        req = Signal()
+        ack = Signal()
+        req_sync = Signal()
+        ack_sync = Signal()
+        ack_prev = Signal()
+        m.submodules.req_ff = FFSynchronizer(req, req_sync, o_domain=self.r_domain, stages=self.stages)
+        m.submodules.ack_ff = FFSynchronizer(ack, ack_sync, o_domain=self.w_domain, stages=self.stages)
+
+        # write side
+        m.d.comb += [
+            self.w_rdy.eq(req == ack_sync),
+            self.w_done.eq(ack_sync != ack_prev),
+        ]
+        m.d[self.w_domain] += ack_prev.eq(ack_sync)
+        with m.If(self.w_stb & self.w_rdy):
+            m.d[self.w_domain] += [
+                data.eq(self.w_data),
+                req.eq(~req),
+            ]
+
+        # read side
+        m.d.comb += [
+            self.r_rdy.eq(req_sync != ack),
+            self.r_data.eq(data),
+        ]
+        with m.If(self.r_stb & self.r_rdy):
+            m.d[self.r_domain] += ack.eq(~ack)
+
+        return m
+
+class BusSynchronizer(Elaboratable):
+    # o follows i, updated with a consistent snapshot of i every mailbox round trip
+    def __init__(self, width, i_domain="sync", o_domain="sync", stages=2):
+        self.i = Signal(width)
+        self.o = Signal(width)
+        self.mailbox = Mailbox(width, w_domain=i_domain, r_domain=o_domain, stages=stages)
+        self.o_domain = o_domain
+        self.latency = self.mailbox.latency + 1
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.mailbox = mailbox = self.mailbox
+
+        m.d.comb += [
+            mailbox.w_data.eq(self.i),
+            mailbox.w_stb.eq(1),
+            mailbox.r_stb.eq(1),
+        ]
+        with m.If(mailbox.r_rdy):
+            m.d[self.o_domain] += self.o.eq(mailbox.r_data)
+
+        return m
+
+
+if __name__=="__main__":
+    m = Module()
+    m.domains += ClockDomain("slow")
+    m.submodules.mailbox = mailbox = Mailbox(16, w_domain="sync", r_domain="slow")
+    m.submodules.pulse = pulse = TogglePulseSynchronizer(i_domain="slow", o_domain="sync", stages=3)
+    m.submodules.bus = bus = BusSynchronizer(16, i_domain="sync", o_domain="slow")
+    sim = Simulator(m)
+    sim.add_clock(10e-9)
+    sim.add_clock(81e-9, domain="slow")
+
+    words = [0x1234 + 7*n for n in range(20)]
+    def writer():
+        for word in words:
+            yield mailbox.w_data.eq(word)
+            yield mailbox.w_stb.eq(1)
+            yield
+            while not (yield mailbox.w_rdy):
+                yield
+            yield mailbox.w_stb.eq(0)
+            yield
+            while not (yield mailbox.w_done):
+                yield
+        for n in range(2000):
+            yield bus.i.eq(n)
+            yield
+
+    def reader():
+        received = []
+        yield mailbox.r_stb.eq(1)
+        while len(received) < len(words):
+            yield
+            if (yield mailbox.r_rdy):
+                received.append((yield mailbox.r_data))
+        assert received == words, received
+        print("mailbox: {} words, latency {} cycles".format(len(received), mailbox.latency))
+        seen = []
+        for _ in range(50):
+            yield
+            seen.append((yield bus.o))
+        assert seen == sorted(seen) and seen[-1] > seen[0]
+        print("bus synchronizer: {} updates in 50 cycles".format(len(set(seen))))
+
+    def pulses():
+        for _ in range(5):
+            yield pulse.i.eq(1)
+            yield
+            yield pulse.i.eq(0)
+            for _ in range(3):
+                yield
+        for _ in range(30):
+            yield
+        print("pulse synchronizer: 5 pulses sent")
+
+    def pulse_counter():
+        count = 0
+        while True:
+            yield
+            count += (yield pulse.o)
+            if count == 5:
+                print("pulse synchronizer: 5 pulses received")
+                return
+
+    sim.add_sync_process(writer)
+    sim.add_sync_process(reader, domain="slow")
+    sim.add_sync_process(pulses, domain="slow")
+    sim.add_sync_process(pulse_counter)
+    with sim.write_vcd("cdc_waves.vcd"):
+        sim.run_until(2e-5)
@@ -0,0 +1,164 @@
+import argparse
+import importlib
+import runpy
+import sys
+import time
+
+# useful-nmigen command line entry point.
+# Nothing heavy is imported at module level: nmigen, the board files and LUNA are
+# only imported by the subcommands (and targets) that need them, so pll-solve and
+# rom-pack start without paying for them.
+
+# build targets: name -> (module, elaboratable class)
+BUILD_TARGETS = {
+    "ac97-loopback":    ("peripherals.tests.ac97_loopback", "AC97_loopback"),
+    "bram-test":        ("utility.bram_inst", "BRAMTest"),
+    "luna-ila":         ("utility.luna_ila_test", "USBSerialLoopback"),
+    "luna-serial":      ("utility.luna_serial_test", "USBSerialLoopback"),
+    "streaming-ila":    ("utility.bram_ila", "USBStreamingILATest"),
+    "usb-bridge":       ("utility.usb_serial_bridge", "USBSerialBridgeTest"),
+}
+
+# simulation targets: name -> module whose __main__ runs the testbench with argv "sim"
+SIM_TARGETS = {
+    "ac97":             "peripherals.ac97",
+    "ac97-cosim":       "peripherals.tests.ac97_cosim",
+    "ac97-model":       "peripherals.ac97_model",
+    "cdc":              "utility.cdc",
+    "framebuffer":      "peripherals.framebuffer",
+    "i2c":              "peripherals.i2c",
+    "instrumentation":  "utility.instrumentation",
+    "luna-ila":         "utility.luna_ila_test",
+    "luna-serial":      "utility.luna_serial_test",
+    "nco":              "peripherals.nco",
+    "polyphase-fir":    "peripherals.polyphase_fir",
+    "sim-capture":      "utility.sim_capture",
+    "streaming-ila":    "utility.bram_ila",
+    "uart-rx":          "utility.uart_rx",
+    "uart-tx":          "utility.uart_tx",
+    "usb-bridge":       "utility.usb_serial_bridge",
+}
+
+def build(args):
+    (module, name) = BUILD_TARGETS[args.target]
+    elaboratable = getattr(importlib.import_module(module), name)()
+    from nmigen_boards.ml505 import ML505Platform
+    from utility.build_cache import cached_build
+    cached_build(ML505Platform(), elaboratable, cache_dir=args.cache_dir,
+        run_script=not args.generate_only, do_program=args.program)
+
+def run_sim(target):
+    module = SIM_TARGETS[target]
+    argv = sys.argv
+    sys.argv = [module, "sim"]
+    try:
+        runpy.run_module(module, run_name="__main__", alter_sys=True)
+    finally:
+        sys.argv = argv
+
+def sim(args):
+    run_sim(args.target)
+
+def bench(args):
+    if args.target == "ila-decode":
+        bench_ila_decode(args.entries)
+        return
+    start = time.perf_counter()
+    run_sim(args.target)
+    print("{}: {:.2f} s".format(args.target, time.perf_counter() - start))
+
+def bench_ila_decode(entries):
+    import io
+    import numpy as np
+    from utility.ila_frontend import StreamingILAFrontend, encode_capture
+
+    signals = [("a", 8), ("b", 1), ("c", 20)]
+    rng = np.random.default_rng(0)
+    values = [rng.integers(0, 2**width, entries) for (_, width) in signals]
+    capture = encode_capture(signals, values, rng.integers(1, 100, entries))
+    output = io.BytesIO()
+    start = time.perf_counter()
+    StreamingILAFrontend(signals=signals, stream=io.BytesIO(capture)).write_vcd(output)
+    elapsed = time.perf_counter() - start
+    print("ila-decode: {} entries, {:.1f} MB capture -> {:.1f} MB VCD in {:.3f} s".format(
+        entries, len(capture)/1e6, len(output.getvalue())/1e6, elapsed))
+
+def formal(args):
+    from utility.formal import main as formal_main
+    argv = args.harnesses + ["--workdir", args.workdir]
+    argv += sum((["--depth", str(depth)] for depth in args.depth or []), [])
+    if args.jobs:
+        argv += ["--jobs", str(args.jobs)]
+    if args.generate_only:
+        argv.append("--generate-only")
+    formal_main(argv)
+
+def pll_solve(args):
+    from utility.pll_solve import pll_solve_virtex5
+    for values in pll_solve_virtex5(input_frequency=args.input, output_frequency=args.output,
+            max_error_allowed=args.error):
+        print(values)
+
+def rom_pack(args):
+    # one value per line, decimal or 0x hex, blank lines and # comments ignored
+    from utility.bram_init import generate_init_data
+    values = []
+    with (open(args.file) if args.file != "-" else sys.stdin) as f:
+        for line in f:
+            line = line.split("#")[0].strip()
+            if line:
+                values.append(int(line, 0))
+    words = 32*args.size
+    if len(values) > words:
+        raise SystemExit("{} values don't fit in a {}k BRAM ({} words)".format(len(values), args.size, words))
+    values += [0] * (words - len(values))
+    init_data = generate_init_data(args.size, values, signed_output=not args.unsigned)
+    for (name, line) in init_data.items():
+        print("{} = 256'h{:064X}".format(name[2:], line))
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="useful-nmigen")
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    p = commands.add_parser("build", help="build a design for the ML505")
+    p.add_argument("target", choices=sorted(BUILD_TARGETS))
+    p.add_argument("--generate-only", action="store_true", help="write the build files without running ISE")
+    p.add_argument("--program", action="store_true", help="program the board after building")
+    p.add_argument("--cache-dir", default="build_cache")
+    p.set_defaults(func=build)
+
+    p = commands.add_parser("sim", help="run a simulation testbench")
+    p.add_argument("target", choices=sorted(SIM_TARGETS))
+    p.set_defaults(func=sim)
+
+    p = commands.add_parser("bench", help="time a testbench, or the ILA decoder (ila-decode)")
+    p.add_argument("target", choices=sorted(SIM_TARGETS) + ["ila-decode"])
+    p.add_argument("--entries", type=int, default=1000000, help="capture size for ila-decode")
+    p.set_defaults(func=bench)
+
+    p = commands.add_parser("formal", help="run the SymbiYosys property checks")
+    p.add_argument("harnesses", nargs="*", help="default: all")
+    p.add_argument("--depth", type=int, action="append", help="BMC depth, can be repeated")
+    p.add_argument("--jobs", type=int, default=None)
+    p.add_argument("--workdir", default="formal")
+    p.add_argument("--generate-only", action="store_true", help="write the .il and .sby files without running sby")
+    p.set_defaults(func=formal)
+
+    p = commands.add_parser("pll-solve", help="find Virtex-5 PLL settings")
+    p.add_argument("--input", type=float, default=100e6, help="input frequency (Hz)")
+    p.add_argument("--output", type=float, required=True, help="output frequency (Hz)")
+    p.add_argument("--error", type=float, default=0, help="max frequency error (Hz)")
+    p.set_defaults(func=pll_solve)
+
+    p = commands.add_parser("rom-pack", help="pack values into BRAM INIT_xx parameters")
+    p.add_argument("file", help="one value per line, or - for stdin")
+    p.add_argument("--size", type=int, choices=[16, 32], default=16, help="BRAM size in kilobits")
+    p.add_argument("--unsigned", action="store_true", help="values are unsigned (default two's complement)")
+    p.set_defaults(func=rom_pack)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,358 @@
+import os
+import shutil
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from nmigen import *
+from nmigen.asserts import *
+from nmigen.back import rtlil
+
+# Formal property harnesses for the protocol cores, and a SymbiYosys runner.
+# Each harness wraps a core with Assume/Assert/Cover statements in a single reset-less
+# sync domain (registers start at their reset values). Designs with two clock
+# domains are checked with both domains on the formal clock, each ticking only
+# when an unconstrained enable is set, so every ratio and phase of the two clocks is
+# explored without multiclock mode.
+#
+# The runner writes <name>.il and <name>.sby into workdir and runs one sby process
+# per task (a BMC per depth, plus a cover) in parallel:
+#   python -m utility.formal [harness...] [--depth N ...] [--jobs N] [--generate-only]
+
+class UART_RX_Formal(Elaboratable):
+    # Two back to back clean 8N1 frames of arbitrary bytes, starting at an arbitrary
+    # time, must be received as those bytes in order, with valid set and error clear
+    def __init__(self, divider=1):
+        from utility.uart_rx import UART_RX
+        # fclk/baud = 6*divider
+        self.uart = UART_RX(baud_rate=1, fclk=6*divider)
+        # the receiver's baud counter wraps one count after the divider
+        self.bit_period = 6 * (self.uart.divider + 1)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.domains.sync = ClockDomain(reset_less=True)
+        m.submodules.uart = uart = self.uart
+
+        bytes_ = [AnyConst(8), AnyConst(8)]
+        start = AnySeq(1)
+        frames = Cat(*(Cat(C(0, 1), byte, C(1, 1)) for byte in bytes_))
+        bit = Signal(range(len(frames) + 1))
+        count = Signal(range(self.bit_period))
+        sending = Signal()
+        sent = Signal()
+        # the line has to idle high through the input synchronizer first
+        idle = Signal(range(4))
+        m.d.comb += uart.rx.eq(Mux(sending, frames.bit_select(bit, 1), 1))
+        with m.If(idle != 3):
+            m.d.sync += idle.eq(idle + 1)
+        with m.Elif(~sending & ~sent & start):
+            m.d.sync += sending.eq(1)
+        with m.If(sending):
+            m.d.sync += count.eq(count + 1)
+            with m.If(count == self.bit_period - 1):
+                m.d.sync += [
+                    count.eq(0),
+                    bit.eq(bit + 1),
+                ]
+                with m.If(bit == len(frames) - 1):
+                    m.d.sync += [
+                        sending.eq(0),
+                        sent.eq(1),
+                    ]
+
+        # bytes received so far, counted on the rising edge of valid
+        received = Signal(2)
+        valid_prev = Signal()
+        m.d.sync += valid_prev.eq(uart.valid)
+        with m.If(uart.valid & ~valid_prev):
+            m.d.sync += received.eq(received + 1)
+            m.d.comb += [
+                Assert(received != 2),
+                Assert(uart.data == Mux(received == 0, bytes_[0], bytes_[1])),
+            ]
+
+        m.d.comb += Assert(~(uart.valid & uart.error))
+        with m.If(sent):
+            m.d.comb += Assert(~uart.error)
+        m.d.comb += Cover((received == 2) & (bytes_[0] == 0xa5) & (bytes_[1] == 0x5a))
+
+        return m
+
+class MailboxFormal(Elaboratable):
+    # Every word written is read exactly once, in order, with the data it was written with.
+    # With the default widths this is the DAC path of AC97_Controller
+    def __init__(self, width=None, stages=2):
+        from utility.cdc import Mailbox
+        if width is None:
+            from peripherals.ac97 import AC97_DAC_Channels
+            width = len(AC97_DAC_Channels())
+        self.mailbox = Mailbox(width, w_domain="write", r_domain="read", stages=stages)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.domains.sync = ClockDomain(reset_less=True)
+        m.domains.write = ClockDomain(reset_less=True)
+        m.domains.read = ClockDomain(reset_less=True)
+        w_en = AnySeq(1)
+        r_en = AnySeq(1)
+        mailbox = self.mailbox
+        m.submodules.mailbox = EnableInserter({"write": w_en, "read": r_en})(mailbox)
+        m.d.comb += [
+            ClockSignal("write").eq(ClockSignal("sync")),
+            ClockSignal("read").eq(ClockSignal("sync")),
+            mailbox.w_data.eq(AnySeq(mailbox.width)),
+            mailbox.w_stb.eq(AnySeq(1)),
+            mailbox.r_stb.eq(AnySeq(1)),
+        ]
+
+        written = Signal(mailbox.width)
+        outstanding = Signal()
+        transfers = Signal(2)
+        write = Signal()
+        read = Signal()
+        m.d.comb += [
+            write.eq(w_en & mailbox.w_stb & mailbox.w_rdy),
+            read.eq(r_en & mailbox.r_stb & mailbox.r_rdy),
+        ]
+        with m.If(write):
+            m.d.sync += [
+                written.eq(mailbox.w_data),
+                outstanding.eq(1),
+            ]
+        with m.If(read):
+            m.d.sync += [
+                outstanding.eq(0),
+                transfers.eq(transfers + (transfers != 3)),
+            ]
+
+        # no overrun, no duplicate or phantom reads, no corruption
+        with m.If(mailbox.w_rdy):
+            m.d.comb += Assert(~outstanding)
+        with m.If(mailbox.r_rdy):
+            m.d.comb += [
+                Assert(outstanding),
+                Assert(mailbox.r_data == written),
+            ]
+        m.d.comb += Assert(~(write & read))
+        m.d.comb += Cover(transfers == 3)
+
+        return m
+
+class AC97_DAC_Formal(Elaboratable):
+    # The dac mailbox wired as AC97_Controller wires it (ac97_dac_handshake), with a
+    # source that follows its contract: on dac_sample_written_o present the next sample,
+    # or drop valid until it's ready. The reader takes a sample at the end of each
+    # frame's tag if one is waiting, otherwise the frame is an underrun. Every sample
+    # must be played once, in order, and written pulses once for each sample played
+    def __init__(self, stages=2):
+        from utility.cdc import Mailbox
+        from peripherals.ac97 import AC97_DAC_Channels
+        self.channels = AC97_DAC_Channels(name="dac_channels_i")
+        self.mailbox = Mailbox(len(self.channels), w_domain="write", r_domain="read", stages=stages)
+
+    def elaborate(self, platform):
+        from peripherals.ac97 import AC97_DAC_Channels, ac97_dac_handshake
+        m = Module()
+        m.domains.sync = ClockDomain(reset_less=True)
+        m.domains.write = ClockDomain(reset_less=True)
+        m.domains.read = ClockDomain(reset_less=True)
+        w_en = AnySeq(1)
+        r_en = AnySeq(1)
+        mailbox = self.mailbox
+        m.submodules.mailbox = EnableInserter({"write": w_en, "read": r_en})(mailbox)
+        m.d.comb += [
+            ClockSignal("write").eq(ClockSignal("sync")),
+            ClockSignal("read").eq(ClockSignal("sync")),
+        ]
+
+        # source, sample n carries n in dac_left_front. While valid is low the inputs
+        # are anything, the sample isn't ready yet
+        valid = Signal(reset=1)
+        written = Signal()
+        sample = Signal(4)
+        m.d.comb += [
+            mailbox.w_data.eq(self.channels),
+            self.channels.dac_left_front.eq(Mux(valid, sample, AnySeq(len(self.channels.dac_left_front)))),
+        ]
+        ac97_dac_handshake(m, mailbox, valid, written)
+        with m.If(w_en):
+            with m.If(written):
+                m.d.sync += [
+                    sample.eq(sample + 1),
+                    valid.eq(AnySeq(1)),
+                ]
+            with m.Elif(~valid & AnySeq(1)):
+                m.d.sync += valid.eq(1)
+
+        # reader, tag_end is the last bit of a frame's tag
+        tag_end = AnySeq(1)
+        played = AC97_DAC_Channels(name="played")
+        m.d.comb += [
+            mailbox.r_stb.eq(tag_end & mailbox.r_rdy),
+            played.eq(mailbox.r_data),
+        ]
+        take = Signal()
+        underrun = Signal()
+        written_event = Signal()
+        m.d.comb += [
+            take.eq(r_en & mailbox.r_stb),
+            underrun.eq(r_en & tag_end & ~mailbox.r_rdy),
+            written_event.eq(w_en & written),
+        ]
+
+        expected = Signal(4)
+        takes = Signal(2)
+        outstanding = Signal()      # played, written not seen yet
+        with m.If(take):
+            m.d.comb += Assert(played.dac_left_front == expected)
+            m.d.sync += [
+                expected.eq(expected + 1),
+                takes.eq(takes + (takes != 3)),
+            ]
+        with m.If(written_event & ~take):
+            m.d.comb += Assert(outstanding)
+        with m.If(take & ~written_event):
+            m.d.comb += Assert(~outstanding)
+        with m.If(take != written_event):
+            m.d.sync += outstanding.eq(take)
+
+        m.d.comb += [
+            Cover(takes == 3),
+            Cover(underrun & (takes == 2)),
+        ]
+
+        return m
+
+class BROMFormal(Elaboratable):
+    # read_port is the ROM word at the address presented `latency` cycles earlier
+    def __init__(self, pipeline_reg=True):
+        from utility.bram_inst import BROMWrapper, generate_init_data
+        self.values = [(n * 0x9e3779b1) & 0xffffffff for n in range(512)]
+        self.rom = BROMWrapper(generate_init_data(16, self.values, signed_output=False),
+            size=16, pipeline_reg=pipeline_reg)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.domains.sync = ClockDomain(reset_less=True)
+        m.submodules.rom = rom = self.rom
+
+        m.d.comb += rom.address.eq(AnySeq(len(rom.address)))
+        table = Array(Const(value, 32) for value in self.values)
+        cycles = Signal(range(rom.latency + 1))
+        with m.If(cycles != rom.latency):
+            m.d.sync += cycles.eq(cycles + 1)
+        with m.Else():
+            m.d.comb += Assert(rom.read_port == table[Past(rom.address, rom.latency)])
+        m.d.comb += Cover((cycles == rom.latency) & (rom.read_port == self.values[511]))
+
+        return m
+
+class BRAMFormal(Elaboratable):
+    # Reading an arbitrary watched address returns the last value written there before
+    # the read (reads are not transparent), `latency` cycles later
+    def __init__(self, width=8, depth=16, pipeline_reg=True):
+        from utility.bram_inst import BRAMWrapper
+        self.ram = BRAMWrapper(width=width, depth=depth, pipeline_reg=pipeline_reg)
+
+    def elaborate(self, platform):
+        m = Module()
+        m.domains.sync = ClockDomain(reset_less=True)
+        m.submodules.ram = ram = self.ram
+
+        m.d.comb += [
+            ram.write_address.eq(AnySeq(len(ram.write_address))),
+            ram.write_data.eq(AnySeq(ram.width)),
+            ram.write_en.eq(AnySeq(1)),
+            ram.read_address.eq(AnySeq(len(ram.read_address))),
+        ]
+        watch = AnyConst(len(ram.read_address))
+        shadow = Signal(ram.width)
+        with m.If(ram.write_en & (ram.write_address == watch)):
+            m.d.sync += shadow.eq(ram.write_data)
+
+        cycles = Signal(range(ram.latency + 1))
+        with m.If(cycles != ram.latency):
+            m.d.sync += cycles.eq(cycles + 1)
+        with m.Elif(Past(ram.read_address, ram.latency) == watch):
+            m.d.comb += Assert(ram.read_port == Past(shadow, ram.latency))
+        m.d.comb += Cover((cycles == ram.latency) & (Past(ram.read_address, ram.latency) == watch)
+            & (ram.read_port != 0))
+
+        return m
+
+# name -> (harness factory, default BMC depth, cover depth). A BMC checks every
+# step up to its depth, so one depth covers the shorter ones
+HARNESSES = {
+    "uart_rx":  (UART_RX_Formal, 300, 300),
+    "mailbox":  (MailboxFormal, 24, 24),
+    "ac97_dac": (AC97_DAC_Formal, 32, 32),
+    "brom":     (BROMFormal, 6, 6),
+    "bram":     (BRAMFormal, 24, 12),
+}
+
+def write_files(name, workdir="formal", depths=None):
+    # writes <name>.il and <name>.sby, returns the list of sby task names
+    (factory, default_depth, cover_depth) = HARNESSES[name]
+    depths = depths or [default_depth]
+    os.makedirs(workdir, exist_ok=True)
+    with open(os.path.join(workdir, name + ".il"), "w") as f:
+        f.write(rtlil.convert(factory(), name=name, ports=[]))
+
+    tasks = ["bmc_{}".format(depth) for depth in depths] + ["cover"]
+    options = ["bmc_{}: mode bmc\nbmc_{}: depth {}".format(depth, depth, depth) for depth in depths]
+    options.append("cover: mode cover\ncover: depth {}".format(cover_depth))
+    with open(os.path.join(workdir, name + ".sby"), "w") as f:
+        f.write("[tasks]\n{}\n\n".format("\n".join(tasks)))
+        f.write("[options]\n{}\n\n".format("\n".join(options)))
+        f.write("[engines]\nsmtbmc\n\n")
+        f.write("[script]\nread_ilang {0}.il\nprep -top {0}\n\n".format(name))
+        f.write("[files]\n{}.il\n".format(name))
+    return tasks
+
+def _run_task(workdir, name, task):
+    result = subprocess.run(["sby", "-f", name + ".sby", task], cwd=workdir,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return (name, task, result.returncode == 0, result.stdout)
+
+def run_formal(names, workdir="formal", depths=None, jobs=None):
+    # returns [(harness, task, passed, log)]
+    if shutil.which("sby") is None:
+        raise FileNotFoundError("sby (SymbiYosys) not found on PATH")
+    work = []
+    for name in names:
+        for task in write_files(name, workdir, depths):
+            work.append((name, task))
+    with ThreadPoolExecutor(max_workers=jobs or os.cpu_count()) as executor:
+        return list(executor.map(lambda item: _run_task(workdir, *item), work))
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog="formal")
+    parser.add_argument("harnesses", nargs="*", help="any of " + ", ".join(sorted(HARNESSES)))
+    parser.add_argument("--depth", type=int, action="append", help="BMC depth, can be repeated")
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--workdir", default="formal")
+    parser.add_argument("--generate-only", action="store_true", help="write the .il and .sby files without running sby")
+    args = parser.parse_args(argv)
+
+    names = args.harnesses or sorted(HARNESSES)
+    for name in names:
+        if name not in HARNESSES:
+            parser.error("unknown harness " + name)
+    if args.generate_only:
+        for name in names:
+            print(name, " ".join(write_files(name, args.workdir, args.depth)))
+        return
+
+    failed = False
+    for (name, task, passed, log) in run_formal(names, args.workdir, args.depth, args.jobs):
+        print("{} {}: {}".format(name, task, "PASS" if passed else "FAIL"))
+        if not passed:
+            failed = True
+            print(log)
+    if failed:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
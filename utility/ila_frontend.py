@@ -0,0 +1,211 @@
+import sys
+import time
+
+import numpy as np
+
+# Host side of the StreamingILA: reads captures from a serial port, or any file like
+# object (a saved capture, a pipe, or io.BytesIO in tests), and decodes them to VCD.
+# Entries are decoded a chunk at a time with NumPy, so memory use is bounded by
+# chunk_entries however long the capture is.
+#
+# signals is a list of (name, width) in the same order as the ILA's signals list
+# (the first one is in the LSBs of the sample). Nothing here needs nmigen, the
+# capture format is defined below and used by StreamingILA.
+
+ILA_MAGIC = b"RLE1"
+ILA_HEADER_BYTES = 15
+
+class StreamingILAFrontend:
+    def __init__(self, signals=None, ila=None, stream=None, port=None, baudrate=115200,
+            sample_period=10e-9, chunk_entries=1 << 14):
+        if ila is not None:
+            # slices and concatenations have no name
+            signals = [(getattr(signal, "name", None) or "sig{}".format(n), len(signal))
+                for (n, signal) in enumerate(ila.signals)]
+        if signals is None:
+            raise ValueError("Please specify signals or ila")
+        if stream is None:
+            if port is None:
+                raise ValueError("Please specify stream or port")
+            import serial
+            stream = serial.Serial(port=port, baudrate=baudrate, timeout=None)
+        self.signals = signals
+        self.stream = stream
+        self.sample_period = sample_period
+        self.chunk_entries = chunk_entries
+
+    def _read(self, count):
+        data = bytearray()
+        while len(data) < count:
+            block = self.stream.read(count - len(data))
+            if not block:
+                raise EOFError("capture ended after {} of {} bytes".format(len(data), count))
+            data += block
+        return bytes(data)
+
+    def read_header(self):
+        # skip anything before the magic, e.g. the tail of a previous capture
+        window = b""
+        while window != ILA_MAGIC:
+            window = (window + self._read(1))[-len(ILA_MAGIC):]
+        header = ILA_MAGIC + self._read(ILA_HEADER_BYTES - len(ILA_MAGIC))
+        self.sample_width = int.from_bytes(header[4:6], "little")
+        self.run_bits = header[6]
+        self.entry_count = int.from_bytes(header[7:11], "little")
+        self.trigger_entry = int.from_bytes(header[11:15], "little")
+        self.bytes_per_entry = -(-(self.sample_width + self.run_bits) // 8)
+        if sum(width for (_, width) in self.signals) != self.sample_width:
+            raise ValueError("signals are {} bits wide, capture samples are {}"
+                .format(sum(width for (_, width) in self.signals), self.sample_width))
+
+    def read_chunks(self):
+        # yields (entry index of the first row, run lengths, per signal bit arrays MSB first)
+        self.read_header()
+        first = 0
+        while first < self.entry_count:
+            count = min(self.chunk_entries, self.entry_count - first)
+            raw = np.frombuffer(self._read(count * self.bytes_per_entry), dtype=np.uint8)
+            bits = np.unpackbits(raw.reshape(count, self.bytes_per_entry), axis=1, bitorder="little")
+            weights = np.left_shift(np.uint64(1), np.arange(self.run_bits, dtype=np.uint64))
+            runs = bits[:, 0:self.run_bits].astype(np.uint64) @ weights
+            fields = []
+            offset = self.run_bits
+            for (_, width) in self.signals:
+                fields.append(bits[:, offset:offset+width][:, ::-1])
+                offset += width
+            yield (first, runs, fields)
+            first += count
+
+    def read_capture(self):
+        # whole capture as (runs, [integer values per signal]), for small captures
+        runs = []
+        values = [[] for _ in self.signals]
+        for (_, chunk_runs, fields) in self.read_chunks():
+            runs.append(chunk_runs)
+            for (n, field) in enumerate(fields):
+                weights = [1 << bit for bit in reversed(range(field.shape[1]))]
+                values[n].append(field.astype(object) @ weights if field.shape[1] > 63
+                    else field.astype(np.uint64) @ np.array(weights, dtype=np.uint64))
+        return (np.concatenate(runs), [np.concatenate(v) for v in values])
+
+    def write_vcd(self, output):
+        # output is a path or a binary file object
+        if isinstance(output, str):
+            with open(output, "wb") as f:
+                return self.write_vcd(f)
+
+        timescale_ps = max(1, int(round(self.sample_period * 1e12)))
+        identifiers = [_vcd_identifier(n) for n in range(len(self.signals) + 1)]
+        names = [name for (name, _) in self.signals] + ["trigger"]
+        widths = [width for (_, width) in self.signals] + [1]
+
+        chunks = self.read_chunks()     # reads the header
+        output.write(b"$timescale 1 ps $end\n$scope module ila $end\n")
+        for (name, width, identifier) in zip(names, widths, identifiers):
+            output.write("$var wire {} {} {} $end\n".format(width, identifier, name).encode())
+        output.write(b"$upscope $end\n$enddefinitions $end\n")
+
+        time_now = 0
+        previous = [None] * len(names)
+        for (first, runs, fields) in chunks:
+            count = len(runs)
+            index = np.arange(first, first + count)
+            fields = fields + [(index == self.trigger_entry).astype(np.uint8)[:, None]]
+            starts = np.uint64(time_now) + np.concatenate((np.zeros(1, np.uint64), np.cumsum(runs[:-1], dtype=np.uint64)))
+            time_now += int(runs.sum())
+
+            segments = []
+            changed_any = np.zeros(count, dtype=bool)
+            for (n, field) in enumerate(fields):
+                # changed against the row above, and the last row of the previous chunk
+                above = np.vstack((previous[n] if previous[n] is not None
+                    else np.full((1, field.shape[1]), 2, dtype=np.uint8), field[:-1]))
+                changed = (field != above).any(axis=1)
+                previous[n] = field[-1:]
+                changed_any |= changed
+                segments.append((_vcd_value_columns(field, identifiers[n]), changed))
+
+            times = _decimal_columns(starts * np.uint64(timescale_ps))
+            rows = [_column(b"#", count), times[0], _column(b"\n", count)]
+            keep = [changed_any[:, None], times[1] & changed_any[:, None], changed_any[:, None]]
+            for (columns, changed) in segments:
+                rows.append(columns)
+                keep.append(np.broadcast_to(changed[:, None], columns.shape))
+            rows = np.concatenate(rows, axis=1)
+            keep = np.concatenate(keep, axis=1)
+            output.write(rows[keep].tobytes())
+
+        output.write("#{}\n".format(time_now * timescale_ps).encode())
+
+def _vcd_identifier(n):
+    identifier = ""
+    while True:
+        identifier += chr(33 + n % 94)
+        n //= 94
+        if n == 0:
+            return identifier
+
+def _column(char, count):
+    return np.full((count, 1), ord(char), dtype=np.uint8)
+
+def _vcd_value_columns(field, identifier):
+    # "0!\n" for 1 bit signals, "b0101 !\n" for vectors
+    count = field.shape[0]
+    ident = np.tile(np.frombuffer(identifier.encode(), dtype=np.uint8), (count, 1))
+    value = field + np.uint8(ord("0"))
+    if field.shape[1] == 1:
+        return np.concatenate((value, ident, _column(b"\n", count)), axis=1)
+    return np.concatenate((_column(b"b", count), value, _column(b" ", count), ident,
+        _column(b"\n", count)), axis=1)
+
+def _decimal_columns(values):
+    # ASCII digits of each value, and a mask without the leading zeros.
+    # floor(v / 10**k) is exact in float64 while v < 2**53, and much faster than integer
+    # division, which is only used past that
+    digits = len(str(int(values.max())))
+    if values.max() < 2**53:
+        powers = 10.0 ** np.arange(digits, -1, -1)
+        quotients = np.floor(values.astype(np.float64)[:, None] / powers)
+    else:
+        powers = np.array([10**k for k in range(digits, -1, -1)], dtype=np.uint64)
+        quotients = values.astype(np.uint64)[:, None] // powers
+    decimal = quotients[:, 1:] - 10 * quotients[:, :-1]
+    keep = np.maximum.accumulate(decimal != 0, axis=1)
+    keep[:, -1] = True
+    return (decimal.astype(np.uint8) + np.uint8(ord("0")), keep)
+
+# Encode a capture the way the StreamingILA sends it, for testing without hardware
+def encode_capture(signals, values, runs, trigger_entry=0, run_bits=16):
+    sample_width = sum(width for (_, width) in signals)
+    bytes_per_entry = -(-(sample_width + run_bits) // 8)
+    entries = np.asarray(runs, dtype=object)
+    offset = run_bits
+    for ((_, width), value) in zip(signals, values):
+        entries = entries + (np.asarray(value, dtype=object) << offset)
+        offset += width
+    header = ILA_MAGIC + sample_width.to_bytes(2, "little") + bytes([run_bits]) + \
+        len(runs).to_bytes(4, "little") + trigger_entry.to_bytes(4, "little")
+    return header + b"".join(int(entry).to_bytes(bytes_per_entry, "little") for entry in entries)
+
+
+if __name__ == "__main__":
+    # python -m utility.ila_frontend <capture file or serial port> <name:width>... -o out.vcd
+    args = sys.argv[1:]
+    if len(args) < 2:
+        print("usage: ila_frontend.py <capture file | serial port> <name:width>... [-o out.vcd]")
+        sys.exit(1)
+    output = "ila.vcd"
+    if "-o" in args:
+        output = args[args.index("-o") + 1]
+        del args[args.index("-o"):args.index("-o") + 2]
+    source, signals = args[0], [(s.split(":")[0], int(s.split(":")[1])) for s in args[1:]]
+
+    start = time.perf_counter()
+    try:
+        stream = open(source, "rb")
+        frontend = StreamingILAFrontend(signals=signals, stream=stream)
+    except OSError:
+        frontend = StreamingILAFrontend(signals=signals, port=source)
+    frontend.write_vcd(output)
+    print("{} entries written to {} in {:.3f} s".format(frontend.entry_count, output,
+        time.perf_counter() - start))
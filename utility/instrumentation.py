@@ -0,0 +1,308 @@
+import struct
+
+from nmigen import *
+from nmigen.sim import *
+
+from utility.cdc import BusSynchronizer, TogglePulseSynchronizer
+from utility.stream import ByteStream
+
+# Instrumentation counters for the cores, readable through a small CSR bank and
+# dumpable over a byte stream (UART_TX.stream or USBSerialBridge.tx).
+#
+# A core creates an Instrumentation in __init__ and adds entries for signals it
+# already has, so the register map is known before elaboration:
+#   counter(name, event)            saturating count of cycles (or rising edges) of event
+#   max_latency(name, start, stop)  longest start -> stop time, in cycles of its domain
+#   maximum(name, value)            high water mark of value
+# Each entry is measured in the domain of its signals and, if that isn't the bank's
+# domain, moved across with a BusSynchronizer. clear is pulse-synchronized back.
+#
+# Registers are read at `address`, with read_data one cycle later. CSRDumper sends
+# them all as a frame: DUMP_MAGIC, register count, then 4 bytes per register
+# little endian. decode_dump() reads one back on the host.
+
+DUMP_MAGIC = b"CSR1"
+
+class SaturatingCounter(Elaboratable):
+    def __init__(self, width=32, domain="sync"):
+        self.inc = Signal()
+        self.clear = Signal()
+        self.value = Signal(width)
+        self.domain = domain
+
+    def elaborate(self, platform):
+        m = Module()
+        with m.If(self.clear):
+            m.d[self.domain] += self.value.eq(0)
+        with m.Elif(self.inc & (self.value != 2**len(self.value) - 1)):
+            m.d[self.domain] += self.value.eq(self.value + 1)
+        return m
+
+class MaxLatency(Elaboratable):
+    # cycles from start to stop, saturating. A start while one is pending restarts it
+    def __init__(self, width=16, domain="sync"):
+        self.start = Signal()
+        self.stop = Signal()
+        self.clear = Signal()
+        self.latest = Signal(width)
+        self.value = Signal(width)
+        self.domain = domain
+
+    def elaborate(self, platform):
+        m = Module()
+        running = Signal()
+        count = Signal.like(self.value)
+        maximum = 2**len(self.value) - 1
+        with m.If(self.start):
+            m.d[self.domain] += [
+                running.eq(1),
+                count.eq(1),
+            ]
+        with m.Elif(running):
+            with m.If(self.stop):
+                m.d[self.domain] += [
+                    running.eq(0),
+                    self.latest.eq(count),
+                ]
+                with m.If(count > self.value):
+                    m.d[self.domain] += self.value.eq(count)
+            with m.Elif(count != maximum):
+                m.d[self.domain] += count.eq(count + 1)
+        with m.If(self.clear):
+            m.d[self.domain] += self.value.eq(0)
+        return m
+
+class Maximum(Elaboratable):
+    def __init__(self, width=32, domain="sync"):
+        self.input = Signal(width)
+        self.clear = Signal()
+        self.value = Signal(width)
+        self.domain = domain
+
+    def elaborate(self, platform):
+        m = Module()
+        with m.If(self.clear):
+            m.d[self.domain] += self.value.eq(0)
+        with m.Elif(self.input > self.value):
+            m.d[self.domain] += self.value.eq(self.input)
+        return m
+
+class Instrumentation(Elaboratable):
+    def __init__(self, domain="sync", width=32):
+        self.domain = domain
+        self.width = width
+        self.entries = []       # (name, elaboratable, domain, signal connections)
+
+        self.address = Signal(8)
+        self.read_data = Signal(width)
+        self.clear = Signal()
+
+    @property
+    def names(self):
+        return [name for (name, _, _, _) in self.entries]
+
+    def _add(self, name, core, domain, connections):
+        if name in self.names:
+            raise NameError("instrumentation entry {} already exists".format(name))
+        if len(self.entries) == 2**len(self.address):
+            raise ValueError("CSR bank is full")
+        self.entries.append((name, core, domain or self.domain, connections))
+
+    def counter(self, name, event, domain=None, edge=False):
+        core = SaturatingCounter(self.width, domain or self.domain)
+        self._add(name, core, domain, [(core.inc, event, edge)])
+
+    def max_latency(self, name, start, stop, domain=None, width=16):
+        core = MaxLatency(width, domain or self.domain)
+        self._add(name, core, domain, [(core.start, start, False), (core.stop, stop, False)])
+
+    def maximum(self, name, value, domain=None):
+        core = Maximum(len(value), domain or self.domain)
+        self._add(name, core, domain, [(core.input, value, False)])
+
+    def register(self, name):
+        return self.names.index(name)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        registers = []
+        clears = {}
+        for (name, core, domain, connections) in self.entries:
+            m.submodules[name] = core
+            for (port, value, edge) in connections:
+                if edge:
+                    previous = Signal(name="{}_previous".format(name))
+                    m.d[domain] += previous.eq(value)
+                    m.d.comb += port.eq(value & ~previous)
+                else:
+                    m.d.comb += port.eq(value)
+
+            if domain == self.domain:
+                m.d.comb += core.clear.eq(self.clear)
+                registers.append(core.value)
+            else:
+                if domain not in clears:
+                    clears[domain] = clear_sync = TogglePulseSynchronizer(i_domain=self.domain, o_domain=domain)
+                    m.submodules["clear_" + domain] = clear_sync
+                    m.d.comb += clear_sync.i.eq(self.clear)
+                m.d.comb += core.clear.eq(clears[domain].o)
+                m.submodules[name + "_cdc"] = bus = BusSynchronizer(len(core.value),
+                    i_domain=domain, o_domain=self.domain)
+                m.d.comb += bus.i.eq(core.value)
+                registers.append(bus.o)
+
+        if registers:
+            m.d[self.domain] += self.read_data.eq(Array(registers)[self.address])
+
+        return m
+
+class CSRDumper(Elaboratable):
+    # Sends every register of an Instrumentation when start is pulsed, or every
+    # period cycles if period is given
+    def __init__(self, instrumentation, period=None):
+        self.instrumentation = instrumentation
+        self.period = period
+        self.start = Signal()
+        self.stream = ByteStream(name="stream")
+        self.busy = Signal()
+
+    def elaborate(self, platform):
+        m = Module()
+        bank = self.instrumentation
+        domain = bank.domain
+        count = len(bank.entries)
+        header = list(DUMP_MAGIC) + [count]
+
+        start = Signal()
+        m.d.comb += start.eq(self.start)
+        if self.period is not None:
+            timer = Signal(range(self.period))
+            m.d[domain] += timer.eq(Mux(timer == self.period - 1, 0, timer + 1))
+            m.d.comb += start.eq(self.start | (timer == self.period - 1))
+
+        index = Signal(range(max(len(header), count) + 1))
+        byte = Signal(2)
+        word = Signal(bank.width)
+        m.d.comb += bank.address.eq(index)
+        with m.FSM(domain=domain):
+            with m.State("IDLE"):
+                with m.If(start):
+                    m.d[domain] += index.eq(0)
+                    m.next = "HEADER"
+            with m.State("HEADER"):
+                m.d.comb += [
+                    self.busy.eq(1),
+                    self.stream.valid.eq(1),
+                    self.stream.payload.eq(Array(Const(b, 8) for b in header)[index]),
+                    self.stream.first.eq(index == 0),
+                    self.stream.last.eq((index == len(header) - 1) & (count == 0)),
+                ]
+                with m.If(self.stream.ready):
+                    m.d[domain] += index.eq(index + 1)
+                    with m.If(index == len(header) - 1):
+                        m.d[domain] += index.eq(0)
+                        m.next = "READ" if count else "IDLE"
+            with m.State("READ"):
+                # bank.read_data is valid the cycle after the address
+                m.d.comb += self.busy.eq(1)
+                m.next = "LATCH"
+            with m.State("LATCH"):
+                m.d.comb += self.busy.eq(1)
+                m.d[domain] += [
+                    word.eq(bank.read_data),
+                    byte.eq(0),
+                ]
+                m.next = "SEND"
+            with m.State("SEND"):
+                m.d.comb += [
+                    self.busy.eq(1),
+                    self.stream.valid.eq(1),
+                    self.stream.payload.eq(word[0:8]),
+                    self.stream.last.eq((index == count - 1) & (byte == 3)),
+                ]
+                with m.If(self.stream.ready):
+                    m.d[domain] += [
+                        word.eq(word >> 8),
+                        byte.eq(byte + 1),
+                    ]
+                    with m.If(byte == 3):
+                        m.d[domain] += index.eq(index + 1)
+                        m.next = "NEXT"
+            with m.State("NEXT"):
+                m.d.comb += self.busy.eq(1)
+                with m.If(index == count):
+                    m.next = "IDLE"
+                with m.Else():
+                    m.next = "READ"
+
+        return m
+
+def decode_dump(data, names):
+    # {name: value} from one dump frame (bytes starting with DUMP_MAGIC)
+    if data[:len(DUMP_MAGIC)] != DUMP_MAGIC:
+        raise ValueError("not a CSR dump")
+    count = data[len(DUMP_MAGIC)]
+    if count != len(names):
+        raise ValueError("dump has {} registers, expected {}".format(count, len(names)))
+    offset = len(DUMP_MAGIC) + 1
+    values = struct.unpack("<{}I".format(count), data[offset:offset + 4*count])
+    return dict(zip(names, values))
+
+
+if __name__=="__main__":
+    m = Module()
+    m.domains += ClockDomain("slow")
+    bank = Instrumentation()
+    event = Signal()
+    slow_event = Signal()
+    start = Signal()
+    stop = Signal()
+    level = Signal(10)
+    bank.counter("events", event)
+    bank.counter("slow_edges", slow_event, domain="slow", edge=True)
+    bank.max_latency("latency", start, stop)
+    bank.maximum("max_level", level)
+    m.submodules.bank = bank
+    m.submodules.dumper = dumper = CSRDumper(bank)
+    sim = Simulator(m)
+    sim.add_clock(10e-9)
+    sim.add_clock(33e-9, domain="slow")
+
+    def events():
+        for n in range(40):
+            yield event.eq(n % 3 == 0)
+            yield level.eq((n * 37) % 200)
+            yield start.eq(n in (2, 20))
+            yield stop.eq(n in (9, 35))
+            yield
+        yield event.eq(0)
+        yield start.eq(0)
+        yield stop.eq(0)
+        for _ in range(100):
+            yield
+        yield dumper.start.eq(1)
+        yield
+        yield dumper.start.eq(0)
+        data = []
+        yield dumper.stream.ready.eq(1)
+        while True:
+            yield
+            if (yield dumper.stream.valid):
+                data.append((yield dumper.stream.payload))
+                if (yield dumper.stream.last):
+                    break
+        values = decode_dump(bytes(data), bank.names)
+        print(values)
+        assert values == {"events": 14, "slow_edges": 5, "latency": 15,
+            "max_level": max((n * 37) % 200 for n in range(40))}, values
+
+    def slow_events():
+        for n in range(10):
+            yield slow_event.eq(n % 2)
+            yield
+
+    sim.add_sync_process(events)
+    sim.add_sync_process(slow_events, domain="slow")
+    with sim.write_vcd("instrumentation_waves.vcd"):
+        sim.run()
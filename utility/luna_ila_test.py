@@ -6,7 +6,8 @@ from nmigen.lib.io import Pin
 from nmigen_boards.ml505 import ML505Platform
 from nmigen_boards.resources import *
 
-from ml505_luna_clocking import *
+from utility.ml505_luna_clocking import *
+from utility.build_cache import cached_build
 
 from luna.full_devices import USBSerialDevice
 from luna.gateware.debug.ila import *
@@ -63,9 +64,12 @@ class USBSerialLoopback(Elaboratable):
         return m
 
 if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in ("build", "sim"):
+        print("usage: python -m {} build|sim".format(__spec__.name if __spec__ else __file__))
+        sys.exit(1)
     usb = USBSerialLoopback()
     if sys.argv[1] == "build":
-        ML505Platform().build(usb)
+        cached_build(ML505Platform(), usb)
         #ila_frontend = AsyncSerialILAFrontend(port="COM8", ila=usb.serial_ila)
         #while True:
         #    ila_frontend.print_samples()
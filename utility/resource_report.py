@@ -0,0 +1,243 @@
+import json
+import os
+import re
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+# Resource and timing summary for each core, built on its own for the ML505.
+# Each core is wrapped in a harness that feeds its inputs from a shift register and
+# XORs its outputs together onto an LED, so nothing is trimmed. The builds run in
+# parallel processes (through the build cache), then the ISE map report and the
+# timing summary are parsed into
+#   {core: {"luts", "ffs", "slices", "brams", "dsps", "fmax_mhz"}}
+# and compared against a stored baseline.
+#
+# The parsers only need report text, so summaries can be made from canned report
+# files without the toolchain: see summarize_reports() and --from-dir, and the
+# excerpts in utility/tests/reports. The baseline is kept at BASELINE and is only
+# written with --update-baseline; without one the summary is printed and nothing
+# is compared.
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resource_baseline.json")
+
+# core name -> factory returning (elaboratable, inputs, outputs, extra clock domains)
+def _ac97():
+    from peripherals.ac97 import AC97_Controller
+    core = AC97_Controller()
+    return (core, [core.dac_channels_i, core.dac_sample_valid_i, core.sdata_in.i1, core.reg_read,
+            core.adc_sample_ready_i],
+        [core.adc_channels_o, core.sdata_out.o, core.sync_o.o, core.dac_sample_written_o,
+            core.adc_sample_received, core.addr_echo], ["audio_bit_clk"])
+
+def _uart_rx():
+    from utility.uart_rx import UART_RX
+    core = UART_RX(baud_rate=115200, fclk=100e6)
+    return (core, [core.rx], [core.data, core.valid, core.error], [])
+
+def _brom():
+    from utility.bram_inst import BROMWrapper, generate_init_data
+    core = BROMWrapper(generate_init_data(16, list(range(512))), size=16)
+    return (core, [core.address], [core.read_port], [])
+
+def _bram():
+    from utility.bram_inst import BRAMWrapper
+    core = BRAMWrapper(width=32, depth=2048)
+    return (core, [core.write_address, core.write_data, core.write_en, core.read_address],
+        [core.read_port], [])
+
+def _i2c_master():
+    from peripherals.i2c import I2C_Master
+    core = I2C_Master(fclk=100e6)
+    return (core, [core.start, core.dev_addr, core.reg_addr, core.data, core.scl.i, core.sda.i],
+        [core.scl.oe, core.sda.oe, core.busy, core.done, core.ack_error], [])
+
+def _nco():
+    from peripherals.nco import NCO
+    core = NCO(taylor=True)
+    return (core, core.frequency + [core.en], [core.sample, core.valid], [])
+
+def _polyphase_fir():
+    from peripherals.polyphase_fir import AC97_DAC_Interpolator
+    core = AC97_DAC_Interpolator()
+    return (core, [core.dac_channels_i, core.dac_sample_written_i],
+        [core.dac_channels_o, core.dac_sample_valid_o, core.sample_consumed], [])
+
+CORES = {
+    "ac97": _ac97,
+    "uart_rx": _uart_rx,
+    "brom": _brom,
+    "bram": _bram,
+    "i2c_master": _i2c_master,
+    "nco": _nco,
+    "polyphase_fir": _polyphase_fir,
+}
+
+METRICS = ["luts", "ffs", "slices", "brams", "dsps", "fmax_mhz"]
+
+_MAP_PATTERNS = {
+    "ffs":      r"Number of Slice Registers:\s+([\d,]+) out of",
+    "luts":     r"Number of Slice LUTs:\s+([\d,]+) out of",
+    "slices":   r"Number of occupied Slices:\s+([\d,]+) out of",
+    "brams":    r"Number of BlockRAM/FIFO:\s+([\d,]+) out of",
+    "dsps":     r"Number of DSP48Es:\s+([\d,]+) out of",
+}
+
+def parse_map_report(text):
+    summary = {}
+    for (metric, pattern) in _MAP_PATTERNS.items():
+        match = re.search(pattern, text)
+        summary[metric] = int(match.group(1).replace(",", "")) if match else 0
+    return summary
+
+def parse_timing(par_text=None, twr_text=None):
+    # fmax of the slowest clock, from a trce report if there is one, otherwise from
+    # the "Best Case Achievable" column of PAR's constraint summary
+    periods = []
+    if twr_text:
+        periods = [float(p) for p in re.findall(r"Minimum period:\s+([\d.]+)ns", twr_text)]
+    if not periods and par_text:
+        periods = [float(p) for p in re.findall(
+            r"\|\s*SETUP\s*\|\s*-?[\d.]+ns\|\s*([\d.]+)ns\|", par_text)]
+    if not periods:
+        return None
+    return round(1000 / max(periods), 3)
+
+def summarize_reports(mrp_text, par_text=None, twr_text=None):
+    summary = parse_map_report(mrp_text)
+    summary["fmax_mhz"] = parse_timing(par_text, twr_text)
+    return summary
+
+def summarize_build_dir(path, name):
+    def read(filename):
+        try:
+            with open(os.path.join(path, filename)) as f:
+                return f.read()
+        except OSError:
+            return None
+    mrp = read(name + "_map.mrp")
+    if mrp is None:
+        raise FileNotFoundError("no map report {}_map.mrp in {}".format(name, path))
+    return summarize_reports(mrp, read(name + "_par.par"), read(name + ".twr"))
+
+class CoreHarness:
+    # the core and its ports are attributes, so the build cache key follows the
+    # core's constructor parameters
+    def __init__(self, core, inputs, outputs, domains):
+        self.core = core
+        self.inputs = inputs
+        self.outputs = outputs
+        self.domains = domains
+
+    def elaborate(self, platform):
+        from nmigen import Module, Signal, Cat, ClockDomain, ClockSignal
+        m = Module()
+        m.submodules.core = self.core
+        # every other domain runs from the board clock, for utilisation and fmax
+        for domain in self.domains:
+            m.domains += ClockDomain(domain)
+            m.d.comb += ClockSignal(domain).eq(ClockSignal("sync"))
+
+        serial_in = platform.request("switch", 0).i
+        led = platform.request("led", 0).o
+        inputs_cat = Cat(*self.inputs)
+        outputs_cat = Cat(*self.outputs)
+        shift = Signal(len(inputs_cat))
+        parity = Signal()
+        m.d.sync += [
+            shift.eq(Cat(serial_in, shift[:-1])),
+            inputs_cat.eq(shift),
+            parity.eq(outputs_cat.xor()),
+        ]
+        m.d.comb += led.eq(parity)
+        return m
+
+def _harness(name):
+    return CoreHarness(*CORES[name]())
+
+def _build_core(name, cache_dir):
+    import subprocess
+    from nmigen_boards.ml505 import ML505Platform
+    from utility.build_cache import cached_build, build_key
+
+    platform = ML505Platform()
+    harness = _harness(name)
+    # same key cached_build uses, taken before elaboration
+    build_dir = os.path.join(cache_dir, build_key(platform, harness, name, run_script=True))
+    cached_build(platform, harness, name=name, cache_dir=cache_dir)
+    # trce isn't part of the ISE flow, run it for a full timing report if it's available
+    if not os.path.exists(os.path.join(build_dir, name + ".twr")):
+        try:
+            subprocess.run(["trce", "-v", "3", "-o", name + ".twr", name + "_par.ncd", name + ".pcf"],
+                cwd=build_dir, check=False, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except OSError:
+            pass
+    return summarize_build_dir(build_dir, name)
+
+def build_summaries(names, cache_dir="build_cache", jobs=None):
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = {name: executor.submit(_build_core, name, cache_dir) for name in names}
+        return {name: future.result() for (name, future) in futures.items()}
+
+def compare(summary, baseline, tolerance=0.05):
+    # list of (core, metric, baseline value, new value) that got worse by more than tolerance
+    regressions = []
+    for (core, metrics) in summary.items():
+        if core not in baseline:
+            continue
+        for metric in METRICS:
+            old = baseline[core].get(metric)
+            new = metrics.get(metric)
+            if old is None or new is None:
+                continue
+            if metric == "fmax_mhz":
+                worse = new < old * (1 - tolerance)
+            else:
+                worse = new > old * (1 + tolerance) and new - old >= 1
+            if worse:
+                regressions.append((core, metric, old, new))
+    return regressions
+
+
+if __name__ == "__main__":
+    # python -m utility.resource_report [core...] [--jobs N] [--from-dir DIR]
+    #     [--baseline FILE] [--update-baseline] [-o summary.json]
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("cores", nargs="*", help="any of " + ", ".join(sorted(CORES)))
+    parser.add_argument("--jobs", type=int, default=None)
+    parser.add_argument("--cache-dir", default="build_cache")
+    parser.add_argument("--from-dir", help="read <core>_map.mrp etc. from this directory instead of building")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--update-baseline", action="store_true", help="write the summary as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.05)
+    parser.add_argument("-o", "--output")
+    args = parser.parse_args()
+
+    names = args.cores or sorted(CORES)
+    for name in names:
+        if name not in CORES:
+            parser.error("unknown core " + name)
+    if args.from_dir:
+        summary = {name: summarize_build_dir(args.from_dir, name) for name in names}
+    else:
+        summary = build_summaries(names, args.cache_dir, args.jobs)
+
+    text = json.dumps(summary, indent=2, sort_keys=True)
+    print(text)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+
+    if args.update_baseline:
+        with open(args.baseline, "w") as f:
+            f.write(text + "\n")
+        print("baseline written to", args.baseline)
+    elif not os.path.exists(args.baseline):
+        print("no baseline at {}, nothing compared. Create it with --update-baseline".format(args.baseline))
+    else:
+        with open(args.baseline) as f:
+            regressions = compare(summary, json.load(f), args.tolerance)
+        for (core, metric, old, new) in regressions:
+            print("REGRESSION {}: {} {} -> {}".format(core, metric, old, new))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,261 @@
+import collections
+import sys
+
+import numpy as np
+
+from nmigen import *
+from nmigen.sim import *
+from nmigen.hdl.ast import SignalDict
+
+# Compact waveform capture for long simulations, instead of sim.write_vcd().
+# Only the selected signals are recorded, as value changes observed directly from the
+# simulator (the same hook sim.write_vcd() uses), so nothing is formatted as text and
+# no testbench process runs per cycle. With a trigger signal only the last
+# `pretrigger` seconds are kept in a ring until it rises, then recording stops
+# `posttrigger` seconds later.
+#
+# The result is columnar: for each signal an array of change times (ps) and an array
+# of values (uint64 words, least significant first), saved with numpy to .npz and
+# converted to VCD afterwards if needed:
+#
+#   capture = SimCapture([dut.valid, ("count", dut.count)], trigger=dut.valid,
+#       pretrigger=10e-6, posttrigger=50e-6)
+#   capture.add_to(sim)
+#   sim.run()
+#   capture.save("capture.npz")
+#   Capture.load("capture.npz").write_vcd("capture.vcd")
+#
+# The simulator doesn't offer a public way to observe value changes, so add_to()
+# registers the capture as one of the python engine's VCD writers. That is only done
+# on the nmigen/amaranth versions it was written against (SUPPORTED_VERSIONS), anything
+# else raises an error instead of recording nothing.
+
+SUPPORTED_VERSIONS = ("0.3",)
+
+def _simulator_version():
+    try:
+        from importlib.metadata import version, PackageNotFoundError
+    except ImportError:
+        return None
+    for package in ("nmigen", "amaranth"):
+        try:
+            return (package, version(package))
+        except PackageNotFoundError:
+            pass
+    return None
+
+class Capture:
+    def __init__(self, names, widths, times, values, trigger=None, trigger_end=None):
+        self.names = list(names)
+        self.widths = list(widths)
+        self.times = times          # per signal, int64 ps of each change
+        self.values = values        # per signal, uint64 array (changes, words)
+        self.trigger = trigger      # ps the trigger rose, or None
+        self.trigger_end = trigger_end  # ps it fell again, or None
+
+    def value_changes(self, name):
+        # [(ps, int value)] of one signal
+        n = self.names.index(name)
+        weights = [1 << (64 * word) for word in range(self.values[n].shape[1])]
+        return [(int(t), sum(int(w) * weight for (w, weight) in zip(row, weights)))
+            for (t, row) in zip(self.times[n], self.values[n])]
+
+    def save(self, path):
+        arrays = {
+            "names": np.array(self.names),
+            "widths": np.array(self.widths, dtype=np.int64),
+            "trigger": np.array(-1 if self.trigger is None else self.trigger, dtype=np.int64),
+            "trigger_end": np.array(-1 if self.trigger_end is None else self.trigger_end, dtype=np.int64),
+        }
+        for n in range(len(self.names)):
+            arrays["t{}".format(n)] = self.times[n]
+            arrays["v{}".format(n)] = self.values[n]
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            count = len(f["names"])
+            trigger = int(f["trigger"])
+            trigger_end = int(f["trigger_end"]) if "trigger_end" in f else -1
+            return cls([str(name) for name in f["names"]], [int(w) for w in f["widths"]],
+                [f["t{}".format(n)] for n in range(count)], [f["v{}".format(n)] for n in range(count)],
+                None if trigger < 0 else trigger, None if trigger_end < 0 else trigger_end)
+
+    def write_vcd(self, path):
+        from vcd import VCDWriter
+        start = min((int(t[0]) for t in self.times if len(t)), default=0)
+        events = []
+        for n in range(len(self.names)):
+            for (t, value) in self.value_changes(self.names[n]):
+                events.append((t, n, value))
+        if self.trigger is not None:
+            events.append((self.trigger, len(self.names), 1))
+            # back to 0 when the trigger fell, or failing that at the next change
+            end = self.trigger_end
+            if end is None or end <= self.trigger:
+                end = min((t for (t, _, _) in events if t > self.trigger), default=self.trigger + 1)
+            events.append((end, len(self.names), 0))
+        events.sort(key=lambda event: event[0])
+
+        with open(path, "w") as f:
+            with VCDWriter(f, timescale="1 ps") as writer:
+                variables = [writer.register_var("capture", name, "wire", size=width)
+                    for (name, width) in zip(self.names, self.widths)]
+                variables.append(writer.register_var("capture", "trigger", "wire", size=1, init=0))
+                for (t, n, value) in events:
+                    writer.change(variables[n], t - start, value)
+
+class SimCapture:
+    def __init__(self, signals, trigger=None, pretrigger=0, posttrigger=None):
+        # signals are Signals (named by their name) or (name, Signal)
+        self.names = []
+        self.signals = []
+        for signal in signals:
+            if isinstance(signal, tuple):
+                (name, signal) = signal
+            else:
+                name = signal.name
+            self.names.append(name)
+            self.signals.append(signal)
+        self.widths = [len(signal) for signal in self.signals]
+        self.index = SignalDict((signal, n) for (n, signal) in enumerate(self.signals))
+        self.trigger = trigger
+        self.pretrigger = int(round(pretrigger * 1e12))
+        self.posttrigger = None if posttrigger is None else int(round(posttrigger * 1e12))
+
+        # per signal (ps, value), starting from the reset values
+        self.changes = [collections.deque([(0, signal.reset)]) for signal in self.signals]
+        self.trigger_time = None
+        self.trigger_end = None
+        self.now = 0
+
+    def add_to(self, sim):
+        # attach to the simulator next to its VCD writers, until the simulator is discarded
+        version = _simulator_version()
+        if version is None or not version[1].startswith(SUPPORTED_VERSIONS):
+            raise RuntimeError("SimCapture hooks the simulator internals of nmigen/amaranth {}, "
+                "not {}; use sim.write_vcd() instead".format(" or ".join(SUPPORTED_VERSIONS),
+                    " ".join(version) if version else "an unknown version"))
+        engine = getattr(sim, "_engine", None)
+        if not isinstance(getattr(engine, "_vcd_writers", None), list):
+            raise RuntimeError("SimCapture needs the python simulator engine, not {}; "
+                "use sim.write_vcd() instead".format(type(engine).__name__))
+        engine._vcd_writers.append(self)
+
+    # called by the simulator for every changed signal after each delta cycle, time in ps
+    def update(self, timestamp, signal, value):
+        now = int(timestamp)
+        self.now = now
+        if self.trigger is not None and self.trigger_time is None:
+            if signal is self.trigger and value:
+                self.trigger_time = now
+        elif signal is self.trigger and self.trigger_end is None and not value:
+            self.trigger_end = now
+        if self.trigger_time is not None and self.posttrigger is not None and now > self.trigger_time + self.posttrigger:
+            return
+        n = self.index.get(signal)
+        if n is None:
+            return
+        changes = self.changes[n]
+        if changes[-1][0] == now:
+            changes.pop()
+        changes.append((now, value))
+        if self.trigger is not None and self.trigger_time is None:
+            # keep the value in effect at the start of the window
+            while len(changes) > 1 and changes[1][0] <= now - self.pretrigger:
+                changes.popleft()
+
+    def close(self, timestamp):
+        pass
+
+    def capture(self):
+        if self.trigger is None:
+            start = 0
+        else:
+            start = max(0, (self.trigger_time if self.trigger_time is not None else self.now) - self.pretrigger)
+        times = []
+        values = []
+        for (width, changes) in zip(self.widths, self.changes):
+            words = -(-width // 64)
+            column = np.empty((len(changes), words), dtype=np.uint64)
+            for word in range(words):
+                bits = min(64, width - 64*word)
+                mask = (1 << bits) - 1
+                column[:, word] = [(value >> (64*word)) & mask for (_, value) in changes]
+            time = np.array([t for (t, _) in changes], dtype=np.int64)
+            time[0] = max(time[0], start)
+            # drop changes back to the same value within a delta cycle
+            changed = np.ones(len(changes), dtype=bool)
+            changed[1:] = (column[1:] != column[:-1]).any(axis=1)
+            times.append(time[changed])
+            values.append(column[changed])
+        return Capture(self.names, self.widths, times, values, self.trigger_time, self.trigger_end)
+
+    def save(self, path):
+        self.capture().save(path)
+
+    def write_vcd(self, path):
+        self.capture().write_vcd(path)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] != "sim":
+        # python -m utility.sim_capture capture.npz [-o capture.vcd]
+        path = sys.argv[1]
+        output = sys.argv[sys.argv.index("-o") + 1] if "-o" in sys.argv else path.rsplit(".", 1)[0] + ".vcd"
+        Capture.load(path).write_vcd(output)
+        sys.exit(0)
+
+    # compares a capture of a small design against the full VCD
+    import os
+    import time
+    import tempfile
+    m = Module()
+    count = Signal(16)
+    slow = Signal(8)
+    wide = Signal(100)
+    trigger = Signal()
+    m.d.comb += trigger.eq(count == 50000)
+    m.d.sync += [
+        count.eq(count + 1),
+        wide.eq(Cat(count, count, count, count, count, count, count)),
+    ]
+    with m.If(count[:6] == 0):
+        m.d.sync += slow.eq(slow + 1)
+
+    cycles = 200000
+    directory = tempfile.mkdtemp()
+    sim = Simulator(m)
+    sim.add_clock(10e-9)
+    start = time.perf_counter()
+    with sim.write_vcd(os.path.join(directory, "full.vcd")):
+        sim.run_until(10e-9 * cycles, run_passive=True)
+    full_time = time.perf_counter() - start
+
+    capture = SimCapture([slow, ("wide", wide)], trigger=trigger, pretrigger=10e-6, posttrigger=30e-6)
+    sim = Simulator(m)
+    sim.add_clock(10e-9)
+    capture.add_to(sim)
+    start = time.perf_counter()
+    sim.run_until(10e-9 * cycles, run_passive=True)
+    capture_time = time.perf_counter() - start
+    capture.save(os.path.join(directory, "capture.npz"))
+
+    loaded = Capture.load(os.path.join(directory, "capture.npz"))
+    slow_changes = loaded.value_changes("slow")
+    assert loaded.trigger is not None
+    assert loaded.trigger_end == loaded.trigger + 10000, (loaded.trigger, loaded.trigger_end)
+    assert all(loaded.trigger - 10e6 <= t <= loaded.trigger + 30e6 for (t, _) in slow_changes)
+    assert len(slow_changes) in (1 + 4000 // 64, 2 + 4000 // 64), len(slow_changes)
+    (t, value) = loaded.value_changes("wide")[-1]
+    assert value >> 96 == (value & 0xf), hex(value)
+    loaded.write_vcd(os.path.join(directory, "capture.vcd"))
+    with open(os.path.join(directory, "capture.vcd")) as f:
+        vcd = f.read()
+    trigger_id = vcd.split(" trigger $end")[0].split()[-1]
+    assert vcd.count("1" + trigger_id + "\n") == 1 and vcd.count("0" + trigger_id + "\n") == 2, "trigger not reset"
+
+    for name in ("full.vcd", "capture.npz", "capture.vcd"):
+        print("{}: {:.1f} kB".format(name, os.path.getsize(os.path.join(directory, name)) / 1e3))
+    print("full vcd {:.2f} s, capture {:.2f} s".format(full_time, capture_time))
@@ -0,0 +1,24 @@
+from nmigen import *
+from nmigen.hdl.rec import Direction
+
+# Byte stream with the same fields as LUNA's StreamInterface, so it can be
+# connected straight to USBSerialDevice.tx/rx or a UART transmitter.
+class ByteStream(Record):
+    def __init__(self, name=None):
+        layout = [
+            ("payload", 8, Direction.FANOUT),
+            ("valid", 1, Direction.FANOUT),
+            ("first", 1, Direction.FANOUT),
+            ("last", 1, Direction.FANOUT),
+            ("ready", 1, Direction.FANIN),
+        ]
+        super().__init__(layout, name=name, src_loc_at=1)
+
+def byte_stream_connect(domain, source, sink):
+    domain += [
+        sink.payload.eq(source.payload),
+        sink.valid.eq(source.valid),
+        sink.first.eq(source.first),
+        sink.last.eq(source.last),
+        source.ready.eq(sink.ready),
+    ]
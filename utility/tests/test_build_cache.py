@@ -0,0 +1,49 @@
+import os
+import shutil
+import sys
+import tempfile
+
+import utility.build_cache as build_cache
+
+# The key has to follow every source file a build can use, including modules that
+# elaborate() only imports while it runs
+
+class Platform:
+    pass
+
+class Design:
+    def __init__(self, width=8):
+        self.width = width
+
+def test_lazily_imported_module():
+    assert "utility.ml505_luna_clocking" not in sys.modules
+    project = tempfile.mkdtemp()
+    try:
+        shutil.copytree(os.path.join(build_cache._PROJECT_ROOT, "utility"), os.path.join(project, "utility"),
+            ignore=shutil.ignore_patterns("__pycache__"))
+        os.makedirs(os.path.join(project, "build_cache", "old"))
+        root = build_cache._PROJECT_ROOT
+        build_cache._PROJECT_ROOT = project
+        try:
+            key = build_cache.build_key(Platform(), Design())
+            assert build_cache.build_key(Platform(), Design()) == key
+            assert build_cache.build_key(Platform(), Design(width=9)) != key
+
+            # build products don't change the key
+            with open(os.path.join(project, "build_cache", "old", "top.py"), "w") as f:
+                f.write("# generated\n")
+            assert build_cache.build_key(Platform(), Design()) == key
+
+            with open(os.path.join(project, "utility", "ml505_luna_clocking.py"), "a") as f:
+                f.write("\n# edited\n")
+            assert build_cache.build_key(Platform(), Design()) != key
+        finally:
+            build_cache._PROJECT_ROOT = root
+    finally:
+        shutil.rmtree(project)
+    assert "utility.ml505_luna_clocking" not in sys.modules
+
+
+if __name__ == "__main__":
+    test_lazily_imported_module()
+    print("test_lazily_imported_module ok")
@@ -0,0 +1,93 @@
+import os
+import re
+import shutil
+import tempfile
+
+from utility.formal import HARNESSES, main, write_files
+
+# sby isn't needed here: the driver writes every harness's .il and .sby, and both are
+# checked for the structure yosys and sby expect
+
+def parse_sby(text):
+    sections = {}
+    section = None
+    for line in text.splitlines():
+        if line.startswith("["):
+            section = line.strip("[]")
+            sections[section] = []
+        elif line.strip():
+            sections[section].append(line)
+    return sections
+
+def check_rtlil(text, top):
+    # blocks nest and close, and every signal used in a module is one of its wires
+    blocks = []
+    modules = {}
+    for line in text.splitlines():
+        tokens = line.split()
+        if not tokens or tokens[0] == "attribute":
+            continue
+        if tokens[0] in ("module", "cell", "process", "switch"):
+            if tokens[0] == "module":
+                assert not blocks, line
+                module = tokens[1]
+                modules[module] = {"wires": set(), "used": set(), "cells": []}
+            else:
+                assert blocks, line
+                if tokens[0] == "cell":
+                    modules[module]["cells"].append(tokens[1])
+            blocks.append(tokens[0])
+        elif tokens[0] == "end":
+            assert blocks, "end outside a block"
+            blocks.pop()
+        elif tokens[0] == "wire":
+            modules[module]["wires"].add(tokens[-1])
+        elif tokens[0] in ("connect", "assign", "update"):
+            # a cell's connect names its port first
+            sigspec = tokens[2:] if blocks[-1] == "cell" else tokens[1:]
+            modules[module]["used"].update(t for t in sigspec if t.startswith("\\"))
+    assert not blocks, "unclosed " + " ".join(blocks)
+    assert "\\" + top in modules, "no top module " + top
+    for (module, contents) in modules.items():
+        undeclared = contents["used"] - contents["wires"]
+        assert not undeclared, (module, undeclared)
+    return [cell for contents in modules.values() for cell in contents["cells"]]
+
+def test_generated_files():
+    workdir = tempfile.mkdtemp()
+    try:
+        for (name, (_, depth, cover_depth)) in HARNESSES.items():
+            tasks = write_files(name, workdir)
+            assert tasks == ["bmc_{}".format(depth), "cover"]
+            with open(os.path.join(workdir, name + ".sby")) as f:
+                sby = parse_sby(f.read())
+            assert list(sby) == ["tasks", "options", "engines", "script", "files"]
+            assert sby["tasks"] == tasks
+            assert sby["options"] == ["bmc_{0}: mode bmc".format(depth), "bmc_{0}: depth {0}".format(depth),
+                "cover: mode cover", "cover: depth {}".format(cover_depth)]
+            assert sby["script"] == ["read_ilang {}.il".format(name), "prep -top {}".format(name)]
+            assert sby["files"] == [name + ".il"]
+
+            with open(os.path.join(workdir, name + ".il")) as f:
+                cells = check_rtlil(f.read(), name)
+            # the properties made it into the netlist
+            assert "$assert" in cells and "$cover" in cells, name
+    finally:
+        shutil.rmtree(workdir)
+
+def test_generate_only():
+    workdir = tempfile.mkdtemp()
+    try:
+        main(["mailbox", "--generate-only", "--workdir", workdir, "--depth", "8", "--depth", "40"])
+        with open(os.path.join(workdir, "mailbox.sby")) as f:
+            assert parse_sby(f.read())["tasks"] == ["bmc_8", "bmc_40", "cover"]
+        assert sorted(os.listdir(workdir)) == ["mailbox.il", "mailbox.sby"]
+    finally:
+        shutil.rmtree(workdir)
+
+
+if __name__ == "__main__":
+    for (name, test) in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
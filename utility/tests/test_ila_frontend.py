@@ -0,0 +1,84 @@
+import io
+import os
+import subprocess
+import sys
+
+from utility.ila_frontend import StreamingILAFrontend, encode_capture
+
+# A 4 entry capture of a 4 bit and a 1 bit signal, triggered on the third entry
+
+SIGNALS = [("a", 4), ("b", 1)]
+VALUES = [[3, 3, 10, 0], [0, 1, 1, 0]]
+RUNS = [2, 5, 1, 3]
+
+CAPTURE = bytes.fromhex("524c4531" "0500" "10" "04000000" "02000000"
+    "020003" "050013" "01001a" "030000")
+
+VCD = """$timescale 1 ps $end
+$scope module ila $end
+$var wire 4 ! a $end
+$var wire 1 " b $end
+$var wire 1 # trigger $end
+$upscope $end
+$enddefinitions $end
+#0
+b0011 !
+0"
+0#
+#20000
+1"
+#70000
+b1010 !
+1#
+#80000
+b0000 !
+0"
+0#
+#110000
+"""
+
+def decode(capture, **kwargs):
+    output = io.BytesIO()
+    StreamingILAFrontend(signals=SIGNALS, stream=io.BytesIO(capture), sample_period=10e-9,
+        **kwargs).write_vcd(output)
+    return output.getvalue().decode()
+
+def test_encode_capture():
+    assert encode_capture(SIGNALS, VALUES, RUNS, trigger_entry=2) == CAPTURE
+
+def test_vcd():
+    assert decode(CAPTURE) == VCD
+
+def test_vcd_across_chunks():
+    # a change is still found against the last row of the previous chunk
+    assert decode(CAPTURE, chunk_entries=1) == VCD
+    assert decode(b"tail of an earlier capture" + CAPTURE, chunk_entries=3) == VCD
+
+def test_long_capture_times():
+    # times past 2**53 ps stay exact
+    runs = [(1 << 47) + 1, (1 << 47) + 3, 5]
+    capture = encode_capture(SIGNALS, [[1, 2, 3], [0, 1, 0]], runs, run_bits=48)
+    times = [line for line in decode(capture).splitlines() if line.startswith("#")]
+    assert times == ["#0", "#{}".format(runs[0] * 10000), "#{}".format((runs[0] + runs[1]) * 10000),
+        "#{}".format(sum(runs) * 10000)]
+
+def test_no_nmigen():
+    # the host side decoder doesn't pull in the gateware
+    subprocess.run([sys.executable, "-c", "import sys, utility.ila_frontend; assert 'nmigen' not in sys.modules"],
+        check=True, cwd=os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+def test_ila_signal_names():
+    from nmigen import Signal
+    from utility.bram_ila import StreamingILA
+    counter = Signal(16)
+    valid = Signal()
+    ila = StreamingILA(signals=[counter[4:12], valid])
+    frontend = StreamingILAFrontend(ila=ila, stream=io.BytesIO())
+    assert frontend.signals == [("sig0", 8), ("valid", 1)]
+
+
+if __name__ == "__main__":
+    for (name, test) in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
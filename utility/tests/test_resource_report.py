@@ -0,0 +1,73 @@
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+from utility.resource_report import CoreHarness, summarize_build_dir, compare
+
+# The reports here are SYNTHETIC: hand-written excerpts in the layout ISE 14.7 uses for
+# the ML505 (xc5vlx50t), with made up figures. No toolchain run produced them, they
+# only pin down what the parsers pick out. ac97 has a trce report, nco only PAR's
+# constraint summary (with a failed constraint)
+
+REPORTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "reports")
+ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+EXPECTED = {
+    # fmax from trce's minimum period of 4.812ns, not PAR's 4.763ns
+    "ac97": {"ffs": 412, "luts": 287, "slices": 178, "brams": 0, "dsps": 0, "fmax_mhz": 207.814},
+    "nco": {"ffs": 1067, "luts": 358, "slices": 341, "brams": 2, "dsps": 1, "fmax_mhz": 96.043},
+}
+
+def test_summaries():
+    for (name, expected) in EXPECTED.items():
+        assert summarize_build_dir(REPORTS, name) == expected, name
+
+def test_compare():
+    baseline = {"nco": dict(EXPECTED["nco"], fmax_mhz=105.0, luts=300)}
+    assert compare(EXPECTED, baseline) == [("nco", "luts", 300, 358), ("nco", "fmax_mhz", 105.0, 96.043)]
+
+def report(*args):
+    return subprocess.run([sys.executable, "-m", "utility.resource_report", "--from-dir", REPORTS] + list(args),
+        cwd=ROOT, stdout=subprocess.PIPE, universal_newlines=True)
+
+def test_baseline():
+    directory = tempfile.mkdtemp()
+    baseline = os.path.join(directory, "baseline.json")
+    # without a baseline nothing is compared, and none is created
+    result = report("ac97", "nco", "--baseline", baseline)
+    assert result.returncode == 0 and "nothing compared" in result.stdout
+    assert not os.path.exists(baseline)
+    assert report("ac97", "nco", "--baseline", baseline, "--update-baseline").returncode == 0
+    with open(baseline) as f:
+        assert json.load(f) == EXPECTED
+    assert report("ac97", "nco", "--baseline", baseline).returncode == 0
+    # a regression fails
+    with open(baseline, "w") as f:
+        json.dump({"nco": dict(EXPECTED["nco"], luts=300)}, f)
+    assert report("ac97", "nco", "--baseline", baseline).returncode == 1
+    os.remove(baseline)
+    os.rmdir(directory)
+
+def test_harness_key():
+    # the core's parameters are part of the build key
+    from utility.build_cache import build_key
+    from utility.uart_rx import UART_RX
+
+    class Platform:
+        pass
+
+    def key(baud_rate):
+        core = UART_RX(baud_rate=baud_rate, fclk=100e6)
+        return build_key(Platform(), CoreHarness(core, [core.rx], [core.data, core.valid, core.error], []),
+            "uart_rx", run_script=True)
+    assert key(115200) == key(115200)
+    assert key(115200) != key(9600)
+
+
+if __name__ == "__main__":
+    for (name, test) in list(globals().items()):
+        if name.startswith("test_"):
+            test()
+            print(name, "ok")
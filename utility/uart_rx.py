@@ -4,7 +4,7 @@ from nmigen.lib.cdc import *
 
 # A UART RX using oversampling
 class UART_RX(Elaboratable):
-    def __init__(self, baud_rate=9600, fclk=None):
+    def __init__(self, baud_rate=9600, fclk=None, instrument=False):
         self.rx = Signal()
         
         self.error  = Signal()
@@ -15,6 +15,14 @@ class UART_RX(Elaboratable):
             raise ValueError("Please specify fclk")
         else:
             self.divider = int((fclk/baud_rate)/6)
+
+        # Optional counters, see utility/instrumentation.py
+        self.instrumentation = None
+        if instrument:
+            from utility.instrumentation import Instrumentation
+            self.instrumentation = Instrumentation()
+            self.instrumentation.counter("bytes", self.valid, edge=True)
+            self.instrumentation.counter("framing_errors", self.error, edge=True)
                 
     def elaborate(self, platform):
         m = Module()
@@ -23,7 +31,7 @@ class UART_RX(Elaboratable):
         m.submodules.rx_2ff = FFSynchronizer(i=self.rx, o=rx_sync, o_domain="sync")
 
         # Generate the sampling strobe 3 times per bit        
-        baud_divide = Signal(range(self.divider))
+        baud_divide = Signal(range(self.divider + 1))
         oversample_counter = Signal(3)
         sample_strobe = Signal()
         bit_count = Signal(4)
@@ -87,6 +95,8 @@ class UART_RX(Elaboratable):
             with m.Else():
                 m.d.sync += self.data.eq(Cat(self.data[1:8], vote))
 
+        if self.instrumentation is not None:
+            m.submodules.instrumentation = self.instrumentation
 
         return m
 
@@ -0,0 +1,77 @@
+from nmigen import *
+from nmigen.sim import *
+
+from utility.stream import ByteStream
+
+# A UART TX (8N1) taking bytes from a ByteStream
+class UART_TX(Elaboratable):
+    def __init__(self, baud_rate=9600, fclk=None):
+        self.tx = Signal(reset=1)
+        self.stream = ByteStream(name="stream")
+
+        if(fclk==None):
+            raise ValueError("Please specify fclk")
+        else:
+            self.divider = int(fclk/baud_rate)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        baud_divide = Signal(range(self.divider))
+        shift = Signal(10)      # start bit, data lsb first, stop bit
+        bit_count = Signal(range(11))
+
+        m.d.comb += self.stream.ready.eq(bit_count == 0)
+        with m.If(self.stream.valid & self.stream.ready):
+            m.d.sync += [
+                shift.eq(Cat(Const(0, 1), self.stream.payload, Const(1, 1))),
+                bit_count.eq(10),
+                baud_divide.eq(0),
+            ]
+        with m.Elif(bit_count != 0):
+            m.d.sync += baud_divide.eq(baud_divide + 1)
+            with m.If(baud_divide == self.divider - 1):
+                m.d.sync += [
+                    baud_divide.eq(0),
+                    shift.eq(shift >> 1),
+                    bit_count.eq(bit_count - 1),
+                ]
+        m.d.comb += self.tx.eq(Mux(bit_count != 0, shift[0], 1))
+
+        return m
+
+if __name__=="__main__":
+    from utility.uart_rx import UART_RX
+    m = Module()
+    m.submodules.uart_tx = uart_tx = UART_TX(baud_rate=115200, fclk=50e6)
+    m.submodules.uart_rx = uart_rx = UART_RX(baud_rate=115200, fclk=50e6)
+    m.d.comb += uart_rx.rx.eq(uart_tx.tx)
+    sim = Simulator(m)
+    sim.add_clock(20e-9)
+
+    message = b"useful"
+    def send():
+        for byte in message:
+            yield uart_tx.stream.payload.eq(byte)
+            yield uart_tx.stream.valid.eq(1)
+            yield
+            while not (yield uart_tx.stream.ready):
+                yield
+        yield uart_tx.stream.valid.eq(0)
+
+    def receive():
+        received = []
+        valid = 0
+        while len(received) < len(message):
+            yield
+            previous = valid
+            valid = (yield uart_rx.valid)
+            if valid and not previous:
+                received.append((yield uart_rx.data))
+        assert bytes(received) == message, received
+        print("received", bytes(received))
+
+    sim.add_sync_process(send)
+    sim.add_sync_process(receive)
+    with sim.write_vcd("uart_tx_waves.vcd"):
+        sim.run()
@@ -0,0 +1,287 @@
+from nmigen import *
+from nmigen.sim import *
+from nmigen.lib.fifo import AsyncFIFOBuffered
+
+from utility.stream import ByteStream, byte_stream_connect
+
+import sys
+
+# USB CDC serial link for user logic in the sync domain.
+# Both directions go through BRAM async FIFOs between the usb and sync domains,
+# so neither side stalls the other. Bytes to the host are held back until a full
+# packet is buffered (or flush_timeout usb cycles pass with data waiting), then sent
+# as one packet with first/last set, so the link is kept busy with full bulk packets.
+#
+# On hardware this creates the ML505 clock domains and the LUNA USBSerialDevice.
+# Without a platform the usb side streams (usb_tx, usb_rx) are left for a testbench.
+
+def add_usb_gpio(platform):
+    # USB D+/D- and the pullup on the ML505's gpio header, as "usb_gpio"
+    from nmigen.build import Resource, Subsignal, Pins, Attrs
+    platform.add_resources([
+        Resource("usb_gpio", 0,
+            Subsignal("d_p",    Pins("12", conn=("gpio", 0) )),
+            Subsignal("d_n",    Pins("14", conn=("gpio", 0) )),
+            Subsignal("pullup", Pins("16", conn=("gpio", 0), dir="o")),
+            Attrs(IOSTANDARD="LVCMOS33"),
+        ),
+    ])
+
+class USBSerialBridge(Elaboratable):
+    def __init__(self, fifo_depth=512, packet_size=64, flush_timeout=12000, sync_frequency=100e6,
+            create_clocks=True, idVendor=0x16d0, idProduct=0x0f3b, instrument=False):
+        self.fifo_depth = fifo_depth
+        self.packet_size = packet_size
+        self.flush_timeout = flush_timeout
+        self.sync_frequency = int(sync_frequency)
+        self.create_clocks = create_clocks
+        self.idVendor = idVendor
+        self.idProduct = idProduct
+
+        # sync domain streams for the user. first/last on tx are ignored, packets are reframed
+        self.tx = ByteStream(name="tx")
+        self.rx = ByteStream(name="rx")
+
+        # usb domain streams, to USBSerialDevice
+        self.usb_tx = ByteStream(name="usb_tx")
+        self.usb_rx = ByteStream(name="usb_rx")
+
+        # throughput counters, sync domain. per second values update once a second
+        self.tx_bytes = Signal(32)
+        self.rx_bytes = Signal(32)
+        self.tx_bytes_per_second = Signal(32)
+        self.rx_bytes_per_second = Signal(32)
+        # usb domain
+        self.tx_packets = Signal(32)
+        self.tx_short_packets = Signal(32)
+
+        # Optional counters, see utility/instrumentation.py
+        self.tx_level = Signal(range(fifo_depth + 2))
+        self.rx_level = Signal(range(fifo_depth + 2))
+        self.instrumentation = None
+        if instrument:
+            from utility.instrumentation import Instrumentation
+            self.instrumentation = Instrumentation()
+            self.instrumentation.counter("tx_bytes", self.tx.valid & self.tx.ready)
+            self.instrumentation.counter("tx_stalls", self.tx.valid & ~self.tx.ready)
+            self.instrumentation.counter("rx_bytes", self.rx.valid & self.rx.ready)
+            # host data held off because the rx FIFO is full
+            self.instrumentation.counter("rx_stalls", self.usb_rx.valid & ~self.usb_rx.ready, domain="usb")
+            self.instrumentation.maximum("tx_fifo_max_level", self.tx_level)
+            self.instrumentation.maximum("rx_fifo_max_level", self.rx_level)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        if (platform != None):
+            if self.create_clocks:
+                from utility.ml505_luna_clocking import ML505LunaClockDomains
+                m.submodules.clocks = ML505LunaClockDomains()
+
+            from luna.full_devices import USBSerialDevice
+            add_usb_gpio(platform)
+            m.submodules.usb_serial = usb_serial = USBSerialDevice(bus=platform.request("usb_gpio"),
+                idVendor=self.idVendor, idProduct=self.idProduct, max_packet_size=self.packet_size)
+            byte_stream_connect(m.d.comb, self.usb_tx, usb_serial.tx)
+            byte_stream_connect(m.d.comb, usb_serial.rx, self.usb_rx)
+            m.d.comb += usb_serial.connect.eq(1)
+
+        # Host to device
+        m.submodules.rx_fifo = rx_fifo = AsyncFIFOBuffered(width=10, depth=self.fifo_depth,
+            w_domain="usb", r_domain="sync")
+        m.d.comb += [
+            rx_fifo.w_data.eq(Cat(self.usb_rx.payload, self.usb_rx.first, self.usb_rx.last)),
+            rx_fifo.w_en.eq(self.usb_rx.valid),
+            self.usb_rx.ready.eq(rx_fifo.w_rdy),
+
+            self.rx.payload.eq(rx_fifo.r_data[0:8]),
+            self.rx.first.eq(rx_fifo.r_data[8]),
+            self.rx.last.eq(rx_fifo.r_data[9]),
+            self.rx.valid.eq(rx_fifo.r_rdy),
+            rx_fifo.r_en.eq(self.rx.ready),
+        ]
+
+        # Device to host
+        m.submodules.tx_fifo = tx_fifo = AsyncFIFOBuffered(width=8, depth=self.fifo_depth,
+            w_domain="sync", r_domain="usb")
+        m.d.comb += [
+            tx_fifo.w_data.eq(self.tx.payload),
+            tx_fifo.w_en.eq(self.tx.valid),
+            self.tx.ready.eq(tx_fifo.w_rdy),
+            self.usb_tx.payload.eq(tx_fifo.r_data),
+        ]
+        m.d.comb += [
+            self.tx_level.eq(tx_fifo.w_level),
+            self.rx_level.eq(rx_fifo.r_level),
+        ]
+
+        # Packet aggregation, usb domain. Bytes counted in the FIFO level are
+        # always readable, so a packet never stalls once started
+        packet_length = Signal(range(self.packet_size + 1))
+        remaining = Signal(range(self.packet_size + 1))
+        timeout = Signal(range(self.flush_timeout + 1))
+        with m.FSM(domain="usb"):
+            with m.State("IDLE"):
+                with m.If(tx_fifo.r_level == 0):
+                    m.d.usb += timeout.eq(0)
+                with m.Elif(timeout != self.flush_timeout):
+                    m.d.usb += timeout.eq(timeout + 1)
+                with m.If(tx_fifo.r_level >= self.packet_size):
+                    m.d.usb += [
+                        packet_length.eq(self.packet_size),
+                        remaining.eq(self.packet_size),
+                    ]
+                    m.next = "PACKET"
+                with m.Elif((tx_fifo.r_level != 0) & (timeout == self.flush_timeout)):
+                    m.d.usb += [
+                        packet_length.eq(tx_fifo.r_level),
+                        remaining.eq(tx_fifo.r_level),
+                        self.tx_short_packets.eq(self.tx_short_packets + 1),
+                    ]
+                    m.next = "PACKET"
+            with m.State("PACKET"):
+                m.d.comb += [
+                    self.usb_tx.valid.eq(1),
+                    self.usb_tx.first.eq(remaining == packet_length),
+                    self.usb_tx.last.eq(remaining == 1),
+                    tx_fifo.r_en.eq(self.usb_tx.ready),
+                ]
+                with m.If(self.usb_tx.ready):
+                    m.d.usb += remaining.eq(remaining - 1)
+                    with m.If(remaining == 1):
+                        m.d.usb += [
+                            self.tx_packets.eq(self.tx_packets + 1),
+                            timeout.eq(0),
+                        ]
+                        m.next = "IDLE"
+
+        # Throughput counters
+        window = Signal(range(self.sync_frequency))
+        tx_window_bytes = Signal(32)
+        rx_window_bytes = Signal(32)
+        tx_byte = Signal()
+        rx_byte = Signal()
+        m.d.comb += [
+            tx_byte.eq(self.tx.valid & self.tx.ready),
+            rx_byte.eq(self.rx.valid & self.rx.ready),
+        ]
+        m.d.sync += [
+            self.tx_bytes.eq(self.tx_bytes + tx_byte),
+            self.rx_bytes.eq(self.rx_bytes + rx_byte),
+            tx_window_bytes.eq(tx_window_bytes + tx_byte),
+            rx_window_bytes.eq(rx_window_bytes + rx_byte),
+            window.eq(window + 1),
+        ]
+        with m.If(window == self.sync_frequency - 1):
+            m.d.sync += [
+                window.eq(0),
+                self.tx_bytes_per_second.eq(tx_window_bytes + tx_byte),
+                self.rx_bytes_per_second.eq(rx_window_bytes + rx_byte),
+                tx_window_bytes.eq(0),
+                rx_window_bytes.eq(0),
+            ]
+
+        if self.instrumentation is not None:
+            m.submodules.instrumentation = self.instrumentation
+
+        return m
+
+
+# Sends a counting pattern to the host as fast as the link allows, and reports
+# the throughput on the LEDs. Read it with any serial terminal or a script.
+class USBSerialBridgeTest(Elaboratable):
+    def __init__(self):
+        pass
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.bridge = bridge = USBSerialBridge()
+        count = Signal(8)
+        m.d.comb += [
+            bridge.tx.payload.eq(count),
+            bridge.tx.valid.eq(1),
+            bridge.rx.ready.eq(1),
+        ]
+        with m.If(bridge.tx.ready):
+            m.d.sync += count.eq(count + 1)
+
+        if (platform != None):
+            leds = Cat(platform.request("led", n).o for n in range(8))
+            # roughly kB/s
+            m.d.comb += leds.eq(bridge.tx_bytes_per_second[10:18])
+
+        return m
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "build":
+        from nmigen_boards.ml505 import ML505Platform
+        from utility.build_cache import cached_build
+        cached_build(ML505Platform(), USBSerialBridgeTest())
+
+    else:
+        m = Module()
+        m.domains.usb = ClockDomain()
+        m.submodules.bridge = bridge = USBSerialBridge(fifo_depth=128, flush_timeout=200,
+            sync_frequency=10000)
+        sim = Simulator(m)
+        sim.add_clock(10e-9)
+        sim.add_clock(1/12e6, domain="usb")
+
+        total = 300
+        def source():
+            for n in range(total):
+                yield bridge.tx.payload.eq(n % 256)
+                yield bridge.tx.valid.eq(1)
+                yield
+                while not (yield bridge.tx.ready):
+                    yield
+            yield bridge.tx.valid.eq(0)
+
+        def host():
+            # accepts bytes in bursts like the USB device, and checks the packet framing
+            received = []
+            packets = []
+            yield bridge.usb_tx.ready.eq(1)
+            while len(received) < total:
+                yield
+                if (yield bridge.usb_tx.valid):
+                    if (yield bridge.usb_tx.first):
+                        packets.append(0)
+                    packets[-1] += 1
+                    received.append((yield bridge.usb_tx.payload))
+                    if (yield bridge.usb_tx.last):
+                        assert packets[-1] in (64, total % 64), packets
+            assert received == [n % 256 for n in range(total)]
+            print("packets of", packets)
+
+        def to_device():
+            for n in range(10):
+                yield bridge.usb_rx.payload.eq(n)
+                yield bridge.usb_rx.valid.eq(1)
+                yield bridge.usb_rx.first.eq(n == 0)
+                yield bridge.usb_rx.last.eq(n == 9)
+                yield
+                while not (yield bridge.usb_rx.ready):
+                    yield
+            yield bridge.usb_rx.valid.eq(0)
+
+        def user_rx():
+            received = []
+            yield bridge.rx.ready.eq(1)
+            while len(received) < 10:
+                yield
+                if (yield bridge.rx.valid):
+                    received.append((yield bridge.rx.payload))
+            assert received == list(range(10))
+            for _ in range(10000):
+                yield
+            print("tx bytes/window", (yield bridge.tx_bytes_per_second),
+                "rx bytes", (yield bridge.rx_bytes))
+
+        sim.add_sync_process(source)
+        sim.add_sync_process(host, domain="usb")
+        sim.add_sync_process(to_device, domain="usb")
+        sim.add_sync_process(user_rx)
+        with sim.write_vcd("usb_bridge_waves.vcd"):
+            sim.run_until(4e-4)